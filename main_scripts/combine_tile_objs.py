@@ -4,38 +4,300 @@
 
 import argparse
 import geojson
+import json
+import numpy as np
 import os
 import shapely
-import subprocess
+import shutil
 import sys
 import time
 
 sys.path.insert(1, 'C:/Users/mse93/Documents/simple-cities-digital-twins/utility_scripts')
 from configuration import *
+from file_utils import *
 from general_utils import *
 from geojson_utils import *
+from image_utils import *
 from latlon_to_utm import *
+from material_utils import *
+from mesh_utils import *
+from obj_utils import *
 from svg_utils import *
 from tile_id import *
 
+# Size of the buffers used to stream tile OBJs into the combined OBJ
+OBJ_BUFFER_SIZE = 1 << 20
+
+def read_tile_materials(mtl_path, texture_filename):
+    """
+    Read the materials of a tile MTL file, except for the one that uses
+    the tile texture. Returns a map from material name to its lines.
+    """
+    materials = {}
+    material_name = None
+    f = open(mtl_path, 'r')
+    for line in f:
+        if line.startswith("newmtl"):
+            material_name = line.split()[-1].strip()
+            materials[material_name] = [line]
+        elif material_name is not None:
+            materials[material_name].append(line)
+    f.close()
+    return {name : lines for name, lines in materials.items() if not any(line.strip().endswith(texture_filename) for line in lines)}
+
+class QuadtreeBuilder:
+    """
+    Builds a quadtree of merged and simplified meshes above the tile grid.
+    A node at level L covers 2^L x 2^L tiles. Level 0 nodes are the tiles
+    themselves, and every parent merges its four children, simplifies the
+    result by vertex clustering and gets a downsampled texture mosaic.
+    Every node is written as its own OBJ, and tileset.json indexes them
+    (in the style of 3D Tiles) so a viewer can stream detail by distance.
+    """
+    def __init__(self, city_directory, min_i, min_j, max_i, max_j, zone, output_dir, output_filename, texture_size, cell_size):
+        self.city_directory = city_directory
+        self.min_i = min_i
+        self.min_j = min_j
+        self.max_i = max_i
+        self.max_j = max_j
+        self.zone = zone
+        self.output_dir = output_dir
+        self.output_filename = output_filename
+        self.texture_size = texture_size
+        self.cell_size = cell_size
+        self.shared_mtl_filename = "%s_lod_materials.mtl" % (output_filename)
+        self.shared_materials = {}
+        num_tiles_across = max(max_i - min_i + 1, max_j - min_j + 1)
+        self.max_level = int(np.ceil(np.log2(num_tiles_across))) if num_tiles_across > 1 else 0
+        self.num_complete = 0
+        self.num_nodes = sum([int(np.ceil((max_i - min_i + 1) / 2 ** level)) * int(np.ceil((max_j - min_j + 1) / 2 ** level)) for level in range(self.max_level + 1)])
+        self.start_time = time.time()
+
+    def node_name(self, level, a, b):
+        return "%s_lod%d_%d_%d" % (self.output_filename, level, a, b)
+
+    def node_exists(self, level, a, b):
+        return a * 2 ** level <= self.max_i - self.min_i and b * 2 ** level <= self.max_j - self.min_j
+
+    def read_leaf(self, a, b):
+        """
+        Read a tile's OBJ and copy its texture. Returns the mesh, the name of
+        its texture material and the path to its texture.
+        """
+        i = self.min_i + a
+        j = self.min_j + b
+        tile_path = os.path.join(self.city_directory, "%d_%d_%d" % (i, j, self.zone))
+        if not os.path.exists(os.path.join(self.city_directory, CITY_MTL_FILENAME)):
+            # Older tiles have every material in their own MTL file
+            self.shared_materials.update(read_tile_materials(os.path.join(tile_path, TILE_MTL_FILENAME), TILE_TEXTURE_FILENAME))
+        mesh = read_obj(os.path.join(tile_path, TILE_OBJ_FILENAME))
+        # Reverse the building faces, the same as when combining OBJs
+        mesh.faces[mesh.building_faces] = mesh.faces[mesh.building_faces][:, ::-1]
+        mesh.face_uvs[mesh.building_faces] = mesh.face_uvs[mesh.building_faces][:, ::-1]
+        mesh.building_faces[:] = False
+        texture_path = os.path.join(self.output_dir, self.node_name(0, a, b) + ".jpg")
+        link_or_copy_file(os.path.join(tile_path, TILE_TEXTURE_FILENAME), texture_path)
+        return mesh, "%d_%d_%d" % (i, j, self.zone), texture_path
+
+    def write_node(self, level, a, b, mesh, texture_material_name):
+        name = self.node_name(level, a, b)
+        mtl_file = open(os.path.join(self.output_dir, name + ".mtl"), 'w')
+        write_texture_material(mtl_file, name, name + ".jpg")
+        mtl_file.close()
+        mesh.materials = [name if material_name == texture_material_name else material_name for material_name in mesh.materials]
+        obj_file = open(os.path.join(self.output_dir, name + ".obj"), 'w')
+        write_obj(obj_file, mesh, [name + ".mtl", self.shared_mtl_filename])
+        obj_file.close()
+
+        self.num_complete += 1
+        print(get_time_estimate_string(time.time() - self.start_time, self.num_complete, self.num_nodes))
+
+    def build_node(self, level, a, b):
+        """
+        Recursively build a node and everything below it. Returns the node's
+        mesh, texture path and tileset.json entry.
+        """
+        node_size = TileID.TILE_SIZE * 2 ** level
+        if level == 0:
+            mesh, texture_material_name, texture_path = self.read_leaf(a, b)
+            children_json = []
+            geometric_error = 0.
+        else:
+            # Merge the children, putting each one in its quadrant of this node
+            child_meshes = []
+            offsets = []
+            children_json = []
+            texture_rows = [[None, None], [None, None]]
+            for child_a in (2 * a, 2 * a + 1):
+                for child_b in (2 * b, 2 * b + 1):
+                    if not self.node_exists(level - 1, child_a, child_b):
+                        continue
+                    child_mesh, child_texture_path, child_json = self.build_node(level - 1, child_a, child_b)
+                    quadrant_x = child_a - 2 * a
+                    quadrant_y = child_b - 2 * b
+                    # Squeeze the child's UVs into its quadrant of the mosaic
+                    child_mesh.uvs = (child_mesh.uvs + (quadrant_x, quadrant_y)) / 2
+                    child_mesh.materials = [self.node_name(level, a, b) if material_name == self.node_name(level - 1, child_a, child_b) else material_name for material_name in child_mesh.materials]
+                    child_meshes.append(child_mesh)
+                    offsets.append((quadrant_x * node_size / 2, 0., node_size / 2 * (1 - quadrant_y)))
+                    children_json.append(child_json)
+                    texture_rows[1 - quadrant_y][quadrant_x] = child_texture_path
+            geometric_error = self.cell_size * 2 ** (level - 1)
+            mesh = cluster_decimate(merge_obj_meshes(child_meshes, offsets), geometric_error)
+            texture_material_name = self.node_name(level, a, b)
+            texture_path = os.path.join(self.output_dir, self.node_name(level, a, b) + ".jpg")
+            create_image_mosaic(texture_rows, self.texture_size // 2, texture_path)
+
+        self.write_node(level, a, b, mesh, texture_material_name)
+
+        # The node's bounding box, in its own coordinates. The transform moves it
+        # into the coordinates of the flat combined OBJ.
+        min_elevation = mesh.vertices[:, 1].min() if len(mesh.vertices) > 0 else 0.
+        max_elevation = mesh.vertices[:, 1].max() if len(mesh.vertices) > 0 else 0.
+        half_size = node_size / 2
+        half_height = (max_elevation - min_elevation) / 2
+        offset_x = a * node_size
+        offset_z = (self.max_j - self.min_j + 1) * TileID.TILE_SIZE - (b + 1) * node_size
+        node_json = {"boundingVolume" : {"box" : [half_size, min_elevation + half_height, half_size,\
+                half_size, 0, 0, 0, half_height, 0, 0, 0, half_size]},\
+                "transform" : [1, 0, 0, 0, 0, 1, 0, 0, 0, 0, 1, 0, offset_x, 0, offset_z, 1],\
+                "geometricError" : geometric_error,\
+                "refine" : "REPLACE",\
+                "content" : {"uri" : self.node_name(level, a, b) + ".obj"}}
+        if len(children_json) > 0:
+            # Children are positioned relative to their parent
+            for child_json in children_json:
+                child_json["transform"][12] -= offset_x
+                child_json["transform"][14] -= offset_z
+            node_json["children"] = children_json
+        return mesh, texture_path, node_json
+
+    def build(self):
+        _, _, root_json = self.build_node(self.max_level, 0, 0)
+
+        # Write the materials every node shares
+        city_mtl_path = os.path.join(self.city_directory, CITY_MTL_FILENAME)
+        if os.path.exists(city_mtl_path):
+            link_or_copy_file(city_mtl_path, os.path.join(self.output_dir, self.shared_mtl_filename))
+        else:
+            f = open(os.path.join(self.output_dir, self.shared_mtl_filename), 'w')
+            for lines in self.shared_materials.values():
+                f.writelines(lines)
+            f.close()
+
+        tileset = {"asset" : {"version" : "1.0"},\
+                "geometricError" : self.cell_size * 2 ** self.max_level,\
+                "root" : root_json}
+        f = open(os.path.join(self.output_dir, "%s_tileset.json" % (self.output_filename)), 'w')
+        json.dump(tileset, f, indent=1)
+        f.close()
+
+class ObjPartWriter:
+    """
+    Writes the combined OBJ, either as one file or split into several parts.
+    A new part is started when the tiles move into a new block of
+    part_tiles x part_tiles tiles, or when the current part is bigger than
+    max_part_bytes (a value of 0 turns either one off). Every part has its
+    own vertex and UV numbering, and they all use the same MTL file. When
+    there is more than one part, a manifest of the parts is written.
+    """
+    def __init__(self, output_dir, output_filename, part_tiles, max_part_bytes):
+        self.output_dir = output_dir
+        self.output_filename = output_filename
+        self.part_tiles = part_tiles
+        self.max_part_bytes = max_part_bytes
+        self.split = part_tiles > 0 or max_part_bytes > 0
+        self.parts = []
+        self.obj_file = None
+        self.block = None
+
+    def part_block(self, a, b):
+        if self.part_tiles <= 0:
+            return None
+        return (a // self.part_tiles, b // self.part_tiles)
+
+    def start_part(self, block):
+        self.finish_part()
+        name = "%s_part%d" % (self.output_filename, len(self.parts)) if self.split else self.output_filename
+        self.obj_file = open(os.path.join(self.output_dir, name + ".obj"), 'w', buffering=OBJ_BUFFER_SIZE)
+        self.block = block
+        self.vertex_num = 0
+        self.uv_num = 0
+        self.num_bytes = 0
+        self.tiles = []
+        self.min_corner = [np.inf, np.inf, np.inf]
+        self.max_corner = [-np.inf, -np.inf, -np.inf]
+        self.parts.append({"obj" : name + ".obj"})
+        self.write("mtllib %s.mtl\n" % (self.output_filename))
+
+    def finish_part(self):
+        if self.obj_file is None:
+            return
+        self.obj_file.close()
+        self.obj_file = None
+        self.parts[-1].update({"tiles" : self.tiles,\
+                "vertices" : self.vertex_num,\
+                "uvs" : self.uv_num,\
+                "bytes" : self.num_bytes,\
+                "min" : self.min_corner if self.vertex_num > 0 else None,\
+                "max" : self.max_corner if self.vertex_num > 0 else None})
+
+    def start_tile(self, i, j, a, b):
+        """
+        Call before writing the tile that is a tiles east and b tiles
+        north of the SW tile. Starts a new part if needed.
+        """
+        block = self.part_block(a, b)
+        if self.obj_file is None or block != self.block or (self.max_part_bytes > 0 and self.num_bytes >= self.max_part_bytes):
+            self.start_part(block)
+        self.tiles.append([i, j])
+
+    def write(self, line):
+        self.obj_file.write(line)
+        self.num_bytes += len(line)
+
+    def add_vertex(self, x, y, z):
+        self.write("v    %.6f    %.6f    %.6f\n" % (x, y, z))
+        self.vertex_num += 1
+        self.min_corner = [min(self.min_corner[0], x), min(self.min_corner[1], y), min(self.min_corner[2], z)]
+        self.max_corner = [max(self.max_corner[0], x), max(self.max_corner[1], y), max(self.max_corner[2], z)]
+
+    def add_uv(self, u, v):
+        self.write("vt %.6f %.6f\n" % (u, v))
+        self.uv_num += 1
+
+    def finish(self):
+        self.finish_part()
+        if len(self.parts) > 1:
+            f = open(os.path.join(self.output_dir, "%s_manifest.json" % (self.output_filename)), 'w')
+            json.dump({"mtl" : self.output_filename + ".mtl", "parts" : self.parts}, f, indent=1)
+            f.close()
+
 def main():
     parser = argparse.ArgumentParser(description="Combine OBJ files from tiles.")
     parser.add_argument("-t", "--tile-directory", required=True, help="Name of tile directory")
     parser.add_argument("--city-name", required=True, help="Name of city (sub-directory of tile directory)")
     parser.add_argument("--sw", required=True, help='SW corner formatted as "lat,lon" or "lat, lon"')
     parser.add_argument("--ne", required=True, help='NE corner formatted as "lat,lon" or "lat, lon"')
+    parser.add_argument("--utm-zone", required=False, type=int, default=0, help='Project everything into this UTM zone, so the area can cross zone boundaries')
     parser.add_argument("--output-dir", required=True, help='Directory to write output OBJ, MTL, and JPGs')
     parser.add_argument("--output-filename", required=True, help='Name of combined OBJ and MTL files')
+    parser.add_argument("--quadtree", action='store_true', help='Write a quadtree of merged and simplified OBJs with a tileset.json index instead of one OBJ')
+    parser.add_argument("--quadtree-texture-size", required=False, type=int, default=2048, help='Size in pixels of the texture mosaic of each quadtree node')
+    parser.add_argument("--atlas", action='store_true', help='Pack the tile textures into a few large texture atlases, with one material per atlas')
+    parser.add_argument("--atlas-tiles", required=False, type=int, default=4, help='Number of tiles along each side of an atlas')
+    parser.add_argument("--atlas-tile-size", required=False, type=int, default=1024, help='Size in pixels of each tile texture inside an atlas')
+    parser.add_argument("--quadtree-cell-size", required=False, type=float, default=50., help='Vertex clustering cell size (meters) of the first quadtree level. It doubles every level.')
+    parser.add_argument("--part-tiles", required=False, type=int, default=0, help='Split the combined OBJ into one part per block of this many tiles on a side')
+    parser.add_argument("--max-part-mb", required=False, type=float, default=0., help='Start a new part of the combined OBJ once the current one is bigger than this many megabytes')
 
     args = parser.parse_args()
 
     # Get the min/max tile IDs from the lat/lon
     lat1, lon1 = parse_latlon_string(args.sw)
     lat2, lon2 = parse_latlon_string(args.ne)
-    tile_min = TileID(lat1, lon1)
-    tile_max = TileID(lat2, lon2)
-    if tile_min.zone != tile_max.zone:
-        print("Crossing from UTM zone %d to %d. Quitting." % (tile_min.zone, tile_max.zone))
+    tile_min, tile_max = tile_area(lat1, lon1, lat2, lon2, args.utm_zone)
+    if tile_min is None:
         return
     min_i = tile_min.i
     min_j = tile_min.j
@@ -46,38 +308,67 @@ def main():
 
     city_directory = os.path.join(args.tile_directory, args.city_name)
     output_mtl_filepath = os.path.join(args.output_dir, args.output_filename + ".mtl")
-    output_obj_filepath = os.path.join(args.output_dir, args.output_filename + ".obj")
     #TILE_TEXTURE_FILENAME = "tile_texture.jpg"
     #TILE_MTL_FILENAME = "tile.mtl"
     #TILE_OBJ_FILENAME = "tile.obj"
 
     # Create the output directory
-    p = subprocess.run(['mkdir', args.output_dir], shell=True)
+    os.makedirs(args.output_dir, exist_ok=True)
 
-    # Create both files
-    mtl_file = open(output_mtl_filepath, 'w')
-    obj_file = open(output_obj_filepath, 'w')
+    if args.quadtree:
+        builder = QuadtreeBuilder(city_directory, min_i, min_j, max_i, max_j, tile_min.zone, args.output_dir,\
+                args.output_filename, args.quadtree_texture_size, args.quadtree_cell_size)
+        builder.build()
+        return
 
-    # The header of the OBJ file
-    obj_file.write("mtllib %s.mtl\n" % (args.output_filename))
+    # Create the MTL file. The OBJ parts are created as the tiles are added.
+    mtl_file = open(output_mtl_filepath, 'w')
+    obj_writer = ObjPartWriter(args.output_dir, args.output_filename, args.part_tiles, int(args.max_part_mb * 1e6))
 
     # Keep track of which materials have already been added so we don't duplicate them
     material_names = set()
 
-    # Keep track of the number of vertices and UVs we've seen
-    vertex_num = 0
-    uv_num = 0
+    # Tiles from create_tile_mesh share one material library, so it only
+    # needs to be copied once. Otherwise every tile's MTL has to be read.
+    city_mtl_path = os.path.join(city_directory, CITY_MTL_FILENAME)
+    use_city_mtl = os.path.exists(city_mtl_path)
+    if use_city_mtl:
+        f = open(city_mtl_path, 'r')
+        shutil.copyfileobj(f, mtl_file)
+        f.close()
+        mtl_file.write("\n")
+
+    # In atlas mode, each tile's texture goes in a slot of an atlas.
+    # This maps each atlas to the tile textures in it, from north to south.
+    atlas_to_texture_rows = {}
  
-    # Iterate over every tile, read the tile's OBJ and MTL and add to the output files.
+    # Go through the tiles one block of parts at a time, so each part's tiles are next to each other
+    tile_keys = [(i, j) for i in range(min_i, max_i + 1) for j in range(min_j, max_j + 1)]
+    if args.part_tiles > 0:
+        tile_keys.sort(key=lambda tile_key: obj_writer.part_block(tile_key[0] - min_i, tile_key[1] - min_j))
+
+    # Iterate over every tile, stream the tile's OBJ and MTL into the output files.
     # Also copy the tile textures to the output directory.
     start_time = time.time()
     num_complete = 0
-    for i in range(min_i, max_i + 1):
-        for j in range(min_j, max_j + 1):
-            current_tile = TileID.tile_indices_to_object(i, j, tile_min.zone)
-            tile_path = os.path.join(city_directory, "%d_%d_%d" % (i, j, tile_min.zone))
-            
-            # Add to the MTL file
+    for i, j in tile_keys:
+        current_tile = TileID.tile_indices_to_object(i, j, tile_min.zone)
+        tile_path = os.path.join(city_directory, "%d_%d_%d" % (i, j, tile_min.zone))
+        tile_material_name = "%d_%d_%d" % (i, j, tile_min.zone)
+        if args.atlas:
+            atlas_i, slot_i = divmod(i - min_i, args.atlas_tiles)
+            atlas_j, slot_j = divmod(j - min_j, args.atlas_tiles)
+            atlas_material_name = "atlas_%d_%d" % (atlas_i, atlas_j)
+            if not atlas_material_name in atlas_to_texture_rows:
+                atlas_to_texture_rows[atlas_material_name] = [[None] * args.atlas_tiles for _ in range(args.atlas_tiles)]
+            atlas_to_texture_rows[atlas_material_name][args.atlas_tiles - 1 - slot_j][slot_i] = os.path.join(tile_path, TILE_TEXTURE_FILENAME)
+        
+        # Add to the MTL file
+        if use_city_mtl:
+            # Only the tile's texture material is missing
+            if not args.atlas:
+                write_texture_material(mtl_file, tile_material_name, "%d_%d_%d.jpg" % (i, j, tile_min.zone))
+        else:
             mtl_path = os.path.join(tile_path, TILE_MTL_FILENAME)
             f = open(mtl_path, 'r')
             lines = f.readlines()
@@ -89,7 +380,10 @@ def main():
             for line in lines:
                 if line.startswith("newmtl"):
                     material_name = line.split()[-1].strip()
-                    if not material_name in material_names:
+                    if args.atlas and material_name == tile_material_name:
+                        # The atlas's material replaces the tile's
+                        skip_line = True
+                    elif not material_name in material_names:
                         skip_line = False
                         material_names.add(material_name)
                         mtl_file.write(line)
@@ -103,84 +397,95 @@ def main():
                 else:
                     mtl_file.write(line)
 
-            # Copy the tile texture into the output directory
+        # Copy the tile texture into the output directory
+        if not args.atlas:
             tile_texture_path = os.path.join(tile_path, TILE_TEXTURE_FILENAME)
             output_texture_path = os.path.join(args.output_dir, "%d_%d_%d.jpg" % (i, j, tile_min.zone))
-            # TODO why is subprocess not working here?
-            os.system("copy %s %s" % (tile_texture_path, output_texture_path))
+            link_or_copy_file(tile_texture_path, output_texture_path)
 
-            # Do the OBJ file
-            obj_path = os.path.join(tile_path, TILE_OBJ_FILENAME)
-            f = open(obj_path, 'r')
-            lines = f.readlines()
-            f.close()
+        # Do the OBJ file
+        obj_writer.start_tile(i, j, i - min_i, j - min_j)
+        obj_path = os.path.join(tile_path, TILE_OBJ_FILENAME)
 
-            # Every point needs to be offset by a certain amount
-            # Flip over the y-axis because OBJs have -z up, I think
-            vertex_offset_x = (i - min_i) * TileID.TILE_SIZE
-            vertex_offset_z = (max_j - j) * TileID.TILE_SIZE
-            target_tile = TileID.tile_indices_to_object(i - min_i, max_j - j, tile_min.zone)
+        # Every point needs to be offset by a certain amount
+        # Flip over the y-axis because OBJs have -z up, I think
+        vertex_offset_x = (i - min_i) * TileID.TILE_SIZE
+        vertex_offset_z = (max_j - j) * TileID.TILE_SIZE
+        target_tile = TileID.tile_indices_to_object(i - min_i, max_j - j, tile_min.zone)
 
-            # The number of vertices already added to the OBJ is how much to offset
-            # each index by here
-            # Same with UVs
-            vertex_offset = vertex_num
-            uv_offset = uv_num
+        # The number of vertices already added to the OBJ part is how much to offset
+        # each index by here
+        # Same with UVs
+        vertex_offset = obj_writer.vertex_num
+        uv_offset = obj_writer.uv_num
 
-            # Look through the tile's OBJ file and add things to the combined OBJ file.
-            is_building_vertex = False
-            for line in lines:
-                if line.startswith("mtllib"):
-                    continue
-                elif line.startswith("# Building"):
-                    is_building_vertex = True
-                elif line.startswith("# Terrain"):
-                    is_building_vertex = False
-                elif line.startswith("v "):
-                    point_coords = line.split()[1:]
-                    x = float(point_coords[0]) + vertex_offset_x
-                    y = float(point_coords[1])
-                    z = float(point_coords[2]) + vertex_offset_z
-                    obj_file.write("v    %.6f    %.6f    %.6f\n" % (x, y, z))
-                    vertex_num += 1
-                elif line.startswith("vt"):
-                    u,v = line.split()[1:]
-                    u = float(u.strip())
-                    v = float(v.strip())
-                    obj_file.write("vt %.6f %.6f\n" % (u, v))
-                    uv_num += 1
-                elif line.startswith("g "):
-                    group_name = line[2:]
-                    obj_file.write("g %s %d_%d_%d\n" % (group_name.strip(), i, j, tile_min.zone))
-                elif line.startswith("usemtl"):
-                    obj_file.write(line)
-                elif line.startswith("f "):
-                    vertices = line.split()[1:]
-                    new_line = "f"
-                    # I don't know why reversing the building's face orientation when combining
-                    # the OBJs magically makes them correct
-                    if is_building_vertex:
-                        vertices.reverse()
-                    for vertex in vertices:
-                        new_line += " "
-                        # The vertex may or may not contain a UV index
-                        if '/' in vertex:
-                            vertex_index, uv_index = vertex.split('/')
-                            vertex_index = int(vertex_index) + vertex_offset
-                            uv_index = int(uv_index) + uv_offset
-                            new_line += "%d/%d" % (vertex_index, uv_index)
-                        else:
-                            vertex_index = int(vertex) + vertex_offset
-                            new_line += str(vertex_index)
-                    obj_file.write(new_line + "\n")
-
-            # Log the status
-            time_elapsed = time.time() - start_time
-            num_complete += 1
-            print(get_time_estimate_string(time_elapsed, num_complete, num_tiles))
+        # Stream through the tile's OBJ file and add things to the combined OBJ file.
+        is_building_vertex = False
+        f = open(obj_path, 'r', buffering=OBJ_BUFFER_SIZE)
+        for line in f:
+            if line.startswith("mtllib"):
+                continue
+            elif line.startswith("# Building"):
+                is_building_vertex = True
+            elif line.startswith("# Terrain"):
+                is_building_vertex = False
+            elif line.startswith("v "):
+                point_coords = line.split()[1:]
+                x = float(point_coords[0]) + vertex_offset_x
+                y = float(point_coords[1])
+                z = float(point_coords[2]) + vertex_offset_z
+                obj_writer.add_vertex(x, y, z)
+            elif line.startswith("vt"):
+                u,v = line.split()[1:]
+                u = float(u.strip())
+                v = float(v.strip())
+                if args.atlas:
+                    # Move the UV into the tile's slot of the atlas
+                    u = (slot_i + u) / args.atlas_tiles
+                    v = (slot_j + v) / args.atlas_tiles
+                obj_writer.add_uv(u, v)
+            elif line.startswith("g "):
+                group_name = line[2:]
+                obj_writer.write("g %s %d_%d_%d\n" % (group_name.strip(), i, j, tile_min.zone))
+            elif line.startswith("usemtl"):
+                if args.atlas and line.split()[-1].strip() == tile_material_name:
+                    obj_writer.write("usemtl %s\n" % (atlas_material_name))
+                else:
+                    obj_writer.write(line)
+            elif line.startswith("f "):
+                vertices = line.split()[1:]
+                new_line = "f"
+                # I don't know why reversing the building's face orientation when combining
+                # the OBJs magically makes them correct
+                if is_building_vertex:
+                    vertices.reverse()
+                for vertex in vertices:
+                    new_line += " "
+                    # The vertex may or may not contain a UV index
+                    if '/' in vertex:
+                        vertex_index, uv_index = vertex.split('/')
+                        vertex_index = int(vertex_index) + vertex_offset
+                        uv_index = int(uv_index) + uv_offset
+                        new_line += "%d/%d" % (vertex_index, uv_index)
+                    else:
+                        vertex_index = int(vertex) + vertex_offset
+                        new_line += str(vertex_index)
+                obj_writer.write(new_line + "\n")
+        f.close()
+
+        # Log the status
+        time_elapsed = time.time() - start_time
+        num_complete += 1
+        print(get_time_estimate_string(time_elapsed, num_complete, num_tiles))
+
+    # Write a material for each atlas and build the atlas textures
+    for atlas_material_name, texture_rows in atlas_to_texture_rows.items():
+        atlas_texture_filename = "%s_%s.jpg" % (args.output_filename, atlas_material_name)
+        write_texture_material(mtl_file, atlas_material_name, atlas_texture_filename)
+        create_image_mosaic(texture_rows, args.atlas_tile_size, os.path.join(args.output_dir, atlas_texture_filename))
 
     mtl_file.close()
-    obj_file.close()
+    obj_writer.finish()
 
 if __name__ == "__main__":
     main()
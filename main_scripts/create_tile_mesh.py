@@ -11,12 +11,21 @@ import sys
 import time
 
 sys.path.insert(1, 'C:/Users/mse93/Documents/simple-cities-digital-twins/utility_scripts')
+from checkpoint_utils import *
 from configuration import *
+from file_utils import *
 from general_utils import *
 from geojson_utils import *
 from latlon_to_utm import *
+from material_utils import *
+from mesh_utils import *
+from model_cache import *
+from random_utils import *
+from spatial_sort import *
 from svg_utils import *
+from terrain_utils import *
 from tile_id import *
+from tree_lod import *
 from tiff_utils import *
 
 def get_property_or_default(properties, key, default):
@@ -31,14 +40,10 @@ def query_building_elevations(shapely_building_polygon, dem_interpolater):
     the building. This only queries at vertices and does not get the
     exact answer.
     """
-    lowest = sys.float_info.max
-    highest = sys.float_info.min
-    for x, y in shapely_building_polygon.exterior.coords:
-        elevation = dem_interpolater.interpolate(x, y)
-        lowest = min(lowest, elevation)
-        highest = max(highest, elevation)
+    coords = np.array(shapely_building_polygon.exterior.coords)
+    elevations = dem_interpolater.interpolate_many(coords[:, 0], coords[:, 1])
 
-    return (lowest, highest)
+    return (float(elevations.min()), float(elevations.max()))
 
 def get_convex_hull_reflected_across_tile_x(polygon, tile):
     sw_x, sw_y = tile.sw_corner()
@@ -60,14 +65,90 @@ def get_convex_hull_reflected_across_tile_y(polygon, tile):
         reflected_convex_hull.append((x, new_y))
     return shapely.Polygon(reflected_convex_hull)
 
+def load_tile_inputs(full_path, model_cache, custom_building_max_faces):
+    """
+    Read and parse everything create_tile_mesh needs from a tile's
+    directory. Returns (building_pwps, osm_ids_to_ignore,
+    custom_building_filenames_to_centers, custom_building_meshes,
+    tree_points), where custom_building_meshes maps each custom building's
+    filename to its ObjMesh (from model_cache, decimated to
+    custom_building_max_faces), or None if it's missing.
+    """
+    # Load the buildings geojson file
+    building_pwps = []
+    try:
+        f = open(os.path.join(full_path, BUILDINGS_FILENAME))
+        buildings_geojson_contents = geojson.loads(f.read())
+        f.close()
+        for pwps in geojson_features_to_pwps(buildings_geojson_contents['features']):
+            building_pwps += pwps
+    except FileNotFoundError:
+        pass
+
+    # Load the info about custom buildings
+    osm_ids_to_ignore = []
+    custom_building_filenames_to_centers = {}
+    custom_buildings_full_path = os.path.join(full_path, CUSTOM_BUILDINGS_FILENAME)
+    try:
+        f = open(custom_buildings_full_path)
+        for line in f.readlines():
+            if line.startswith("filename"):
+                name, x, y = line.split()[1:]
+                custom_building_filenames_to_centers[name] = (float(x), float(y.strip()))
+            elif line.startswith("id"):
+                osm_ids_to_ignore.append(int(line.split()[1].strip()))
+            else:
+                print("Unknown line prefix %s in %s" % (line, custom_buildings_full_path))
+    except FileNotFoundError:
+        pass
+
+    # Load the trees geojson file
+    tree_points = []
+    try:
+        f = open(os.path.join(full_path, "trees.geojson"))
+        tree_geojson_contents = geojson.loads(f.read())
+        f.close()
+        tree_points = list(geojson_features_to_shapely_array(tree_geojson_contents['features'])[0])
+    except FileNotFoundError:
+        pass
+
+    # Get the custom buildings' meshes
+    custom_building_meshes = {}
+    for filename in custom_building_filenames_to_centers:
+        try:
+            custom_building_meshes[filename] = model_cache.get(os.path.join(full_path, filename), custom_building_max_faces)
+        except FileNotFoundError:
+            custom_building_meshes[filename] = None
+
+    return building_pwps, osm_ids_to_ignore, custom_building_filenames_to_centers, custom_building_meshes, tree_points
+
 def main():
     parser = argparse.ArgumentParser(description="Create tile mesh OBJ files.")
     parser.add_argument("--config-file", required=True, help="Path to the configuration file")
     parser.add_argument("-t", "--tile-directory", required=True, help="Name of tile directory")
     parser.add_argument("--city-name", required=True, help="Name of city (sub-directory of output directory)")
-    parser.add_argument("--dem-path", required=True, help="Path to GeoTIFF DEM file")
+    dem_group = parser.add_mutually_exclusive_group(required=True)
+    dem_group.add_argument("--dem-path", nargs='+', help="Path to GeoTIFF DEM file, or several GeoTIFFs (or directories of them) that make up the DEM")
+    dem_group.add_argument("--dem-tiles", action='store_true', help='Read the DEM from the per-tile arrays that cut_dem_into_tiles.py made')
+    parser.add_argument("--dem-nodata", required=False, type=float, default=None, help='Value of the DEM samples that have no data. They are filled in from the nearest samples that have data.')
+    parser.add_argument("--no-terrain-edge-cache", action='store_true', help="Don't share the elevations along tile edges between tiles through the city's edge cache")
     parser.add_argument("--sw", required=True, help='SW corner formatted as "lat,lon" or "lat, lon"')
     parser.add_argument("--ne", required=True, help='NE corner formatted as "lat,lon" or "lat, lon"')
+    parser.add_argument("--utm-zone", required=False, type=int, default=0, help='Project everything into this UTM zone, so the area can cross zone boundaries')
+    parser.add_argument("--true-footprints", action='store_true', help='Extrude the real building footprints (holes included) instead of their convex hulls')
+    parser.add_argument("--footprint-simplify-tolerance", required=False, type=float, default=0., help='Simplify footprints by this many meters before extruding them')
+    parser.add_argument("--max-footprint-vertices", required=False, type=int, default=0, help='Footprints with more vertices than this are simplified further (0 means no limit)')
+    parser.add_argument("--terrain-lod", action='store_true', help='Build simplified terrain meshes instead of a uniform grid')
+    parser.add_argument("--terrain-lod-grid-size", required=False, type=int, default=257, help='Number of DEM samples along a tile edge for the finest LOD (must be 2^k + 1)')
+    parser.add_argument("--terrain-lod-errors", required=False, default="1,4,16", help='Comma-separated max vertical error (meters) of each LOD. LOD 0 goes in the tile OBJ, the rest in their own OBJs.')
+    parser.add_argument("--custom-building-max-faces", required=False, type=int, default=0, help='Simplify custom building OBJs with more faces than this down to this many faces (0 keeps every face)')
+    parser.add_argument("--tree-models", required=False, nargs='+', default=[DEFAULT_TREE_MODEL_PATH], help='OBJ models of the tree species to use. Each tree gets one of them, picked from where it is. Their materials are read from the MTL files next to them.')
+    parser.add_argument("--tree-model-weights", required=False, default=None, help='Comma-separated weights of how often each tree model is used (the same for every model by default)')
+    parser.add_argument("--max-tile-triangles", required=False, type=int, default=0, help='Keep each tile under this many triangles by drawing the trees where they are densest as impostors, and thinning them out if that is not enough (0 means no limit)')
+    parser.add_argument("--tree-impostor", required=False, choices=TREE_IMPOSTOR_SHAPES, default="cone", help='Shape of the cheap trees used to stay under --max-tile-triangles')
+    parser.add_argument("--spatial-sort", required=False, choices=SPATIAL_SORT_CURVES, default="none", help='Go through the tiles along a space-filling curve instead of row by row, so consecutive tiles are neighbors')
+    parser.add_argument("--prefetch", required=False, type=int, default=2, help='Number of tiles whose inputs are read ahead in background threads (0 reads each tile when it is reached)')
+    parser.add_argument("--resume", action='store_true', help='Skip the tiles that a previous run with the same arguments finished before it crashed')
 
     args = parser.parse_args()
 
@@ -76,10 +157,8 @@ def main():
     # Get the min/max tile IDs from the lat/lon
     lat1, lon1 = parse_latlon_string(args.sw)
     lat2, lon2 = parse_latlon_string(args.ne)
-    tile_min = TileID(lat1, lon1)
-    tile_max = TileID(lat2, lon2)
-    if tile_min.zone != tile_max.zone:
-        print("Crossing from UTM zone %d to %d. Quitting." % (tile_min.zone, tile_max.zone))
+    tile_min, tile_max = tile_area(lat1, lon1, lat2, lon2, args.utm_zone)
+    if tile_min is None:
         return
     min_i = tile_min.i
     min_j = tile_min.j
@@ -89,118 +168,110 @@ def main():
     print("You have specified %d tile%s." % (num_tiles,  "s" if num_tiles > 1 else ""))
 
     city_directory = os.path.join(args.tile_directory, args.city_name)
-    TERRAIN_MESH_RES = config.at["TERRAIN_MESH_RES"]
+    TERRAIN_MESH_RES = config.terrain_mesh_res
     TERRAIN_MESH_ROW_SIZE = int(TileID.TILE_SIZE / TERRAIN_MESH_RES)
+    terrain_lod_errors = [float(error) for error in args.terrain_lod_errors.split(',')]
+    terrain_lod_tile_size = args.terrain_lod_grid_size - 1
+    if args.terrain_lod and (terrain_lod_tile_size < 2 or terrain_lod_tile_size & (terrain_lod_tile_size - 1) != 0):
+        print("The terrain LOD grid size must be 2^k + 1 (like 129 or 257), not %d. Quitting." % (args.terrain_lod_grid_size))
+        return
+    if args.terrain_lod and terrain_lod_tile_size < 2 ** len(terrain_lod_errors):
+        print("The terrain LOD grid size is too small for %d LODs. Quitting." % (len(terrain_lod_errors)))
+        return
 
     # Load the DEM
-    dem = GeoTiffInterpolater(args.dem_path)
-
-    # Load the tree mesh
-    f = open("models/tree.obj", 'r')
-    tree_obj_lines = f.readlines()
-    f.close()
-    f = open("models/tree.mtl", 'r')
-    tree_mtl_lines = f.readlines()
-    f.close()
-
-    # Count the number of vertices in the tree file
-    num_tree_points = sum([1 for line in tree_obj_lines if line.startswith('v')])
-
-    # Iterate over every tile, creating an OBJ manually.
+    if args.dem_tiles:
+        dem = DemTileInterpolater(city_directory, tile_min.zone)
+        if not dem.covers_tiles(tile_min.i, tile_min.j, tile_max.i, tile_max.j):
+            print("The DEM wasn't cut for every tile of the area. Run cut_dem_into_tiles.py with the same area. Quitting.")
+            return
+    else:
+        dem = open_dem(args.dem_path, args.dem_nodata)
+    # Neighboring tiles use the same elevations along their shared edges
+    edge_cache = None if args.no_terrain_edge_cache else TerrainEdgeCache(city_directory, dem.source_key)
+
+    # Load the tree models. Models (and custom buildings) are parsed once and
+    # shared between tiles, runs and processes through the model cache.
+    tree_model_weights = [1.] * len(args.tree_models) if args.tree_model_weights is None else [float(weight) for weight in args.tree_model_weights.split(',')]
+    if len(tree_model_weights) != len(args.tree_models):
+        print("There are %d tree models but %d tree model weights. Quitting." % (len(args.tree_models), len(tree_model_weights)))
+        return
+    model_cache = ModelCache(city_directory)
+    tree_models = [model_cache.get(model_path) for model_path in args.tree_models]
+    # Every tree model can be drawn in full or as an impostor. Each way has its
+    # mesh, its material groups, and which autumn random number each group uses.
+    tree_lods = []
+    for tree_model in tree_models:
+        group_starts, group_materials = material_groups(tree_model)
+        impostor, impostor_group_index = tree_impostor_mesh(tree_model, args.tree_impostor)
+        impostor_starts, impostor_materials = material_groups(impostor)
+        tree_lods.append([(tree_model, group_starts, group_materials, np.arange(len(group_materials))),\
+                (impostor, impostor_starts, impostor_materials, np.full(len(impostor_materials), impostor_group_index))])
+    tree_lod_face_counts = np.array([[lod[0].num_triangles() for lod in lods] for lods in tree_lods])
+    tree_model_cdf = np.cumsum(tree_model_weights) / np.sum(tree_model_weights)
+    tree_mtl_lines = []
+    for mtl_path in dict.fromkeys(model_mtl_path(model_path) for model_path in args.tree_models):
+        f = open(mtl_path, 'r')
+        tree_mtl_lines += f.readlines()
+        f.close()
+
+    # Write the materials that every tile shares
+    write_city_material_library(os.path.join(city_directory, CITY_MTL_FILENAME), config, tree_mtl_lines)
+    tile_mtllib = "%s %s" % (TILE_MTL_FILENAME, "../" + CITY_MTL_FILENAME)
+
+    # Keep a journal of the finished tiles, so a crashed run can be resumed
+    journal = TileJournal(checkpoint_path(city_directory, "create_tile_mesh.journal"), describe_run(args, ["resume", "prefetch"], config), args.resume)
+
+    # Iterate over every tile, creating an OBJ manually. Going through the tiles
+    # along a curve keeps the DEM and other caches warm.
     start_time = time.time()
-    num_complete = 0
-    for i in range(min_i, max_i + 1):
-        for j in range(min_j, max_j + 1):
-            current_tile = TileID.tile_indices_to_object(i, j, tile_min.zone)
-            sw_x, sw_y = current_tile.sw_corner()
-            full_path = os.path.join(city_directory, "%d_%d_%d" % (i, j, tile_min.zone))
-
-            # Load the buildings geojson file
-            building_pwps = []
-            try:
-                f = open(os.path.join(full_path, BUILDINGS_FILENAME))
-                buildings_geojson_contents = geojson.loads(f.read())
-                f.close()
-                for geojson_feature in buildings_geojson_contents['features']:
-                    building_pwps += geojson_feature_to_pwps(geojson_feature)
-            except FileNotFoundError:
-                pass
-
-            # Load the info about custom buildings
-            osm_ids_to_ignore = []
-            custom_building_filenames_to_centers = {}
-            custom_buildings_full_path = os.path.join(full_path, CUSTOM_BUILDINGS_FILENAME)
-            try:
-                f = open(custom_buildings_full_path)
-                for line in f.readlines():
-                    if line.startswith("filename"):
-                        name, x, y = line.split()[1:]
-                        custom_building_filenames_to_centers[name] = (float(x), float(y.strip()))
-                    elif line.startswith("id"):
-                        osm_ids_to_ignore.append(int(line.split()[1].strip()))
-                    else:
-                        print("Unknown line prefix %s in %s" % (line, custom_buildings_full_path))
-            except FileNotFoundError:
-                pass
-
-            # Load the trees geojson file
-            tree_points = []
-            try:
-                f = open(os.path.join(full_path, "trees.geojson"))
-                tree_geojson_contents = geojson.loads(f.read())
-                f.close()
-                for geojson_feature in tree_geojson_contents['features']:
-                    tree_points += geojson_feature_to_shapely(geojson_feature)
-            except FileNotFoundError:
-                pass
-
-            # Create the MTL file (the easy part)
-            mtl_path = os.path.join(full_path, TILE_MTL_FILENAME)
-            material_name = "%d_%d_%d" % (i, j, tile_min.zone)
-            f = open(mtl_path, 'w')
-            f.write("newmtl %s\n" % (material_name))
-            f.write("Ka 1.0000 1.0000 1.0000\n")
-            f.write("Kd 1.0000 1.0000 1.0000\n")
-            f.write("illum 1\n")
-            f.write("map_Kd %s\n\n" % TILE_TEXTURE_FILENAME)
-
-            # Add colors for buildings
-            # Get them from the config file
-            material_color_map = {building_mat_name : config.at[BUILDING_MATERIAL_NAMES[building_mat_name]] for building_mat_name in BUILDING_MATERIAL_NAMES}
-            for building_mat_name in material_color_map:
-                f.write("newmtl %s\n" % building_mat_name)
-                r,g,b = material_color_map[building_mat_name].split(',')
-                f.write("Kd %s %s %s\n" % (r, g, b))
-                f.write("illum 0\n\n")
-
-            # Add colors from the tree model
-            for line in tree_mtl_lines:
-                f.write(line)
-            if config.at["AUTUMN"]:
-                f.write("newmtl tree_red\n")
-                f.write("Kd 1.0000 0.0000 0.0000\n")
-                f.write("illum 0\n")
-                f.write("newmtl tree_yellow\n")
-                f.write("Kd 1.0000 1.0000 0.0000\n")
-                f.write("illum 0\n")
-                f.write("newmtl tree_orange\n")
-                f.write("Kd 1.0000 0.5000 0.0000\n")
-                f.write("illum 0\n")
-            f.close()
-
-            # Start the OBJ file
-            obj_path = os.path.join(full_path, TILE_OBJ_FILENAME)
-            f = open(obj_path, 'w')
-
-            # The header is always this
-            f.write("mtllib %s\n" % (TILE_MTL_FILENAME))
-            f.write("# Terrain vertices\n")
-
+    tile_keys = sort_tile_keys([(i, j) for i in range(min_i, max_i + 1) for j in range(min_j, max_j + 1)], args.spatial_sort)
+    num_complete = sum(1 for i, j in tile_keys if journal.is_complete(i, j))
+    tile_keys = [(i, j) for i, j in tile_keys if not journal.is_complete(i, j)]
+    # The next tiles' inputs are read in the background while each tile is built
+    load_function = lambda i, j: load_tile_inputs(os.path.join(city_directory, "%d_%d_%d" % (i, j, tile_min.zone)), model_cache, args.custom_building_max_faces)
+    for i, j, tile_inputs in TilePrefetcher(tile_keys, load_function, args.prefetch):
+        current_tile = TileID.tile_indices_to_object(i, j, tile_min.zone)
+        sw_x, sw_y = current_tile.sw_corner()
+        full_path = os.path.join(city_directory, "%d_%d_%d" % (i, j, tile_min.zone))
+
+        building_pwps, osm_ids_to_ignore, custom_building_filenames_to_centers, custom_building_meshes, tree_points = tile_inputs
+
+        # Create the MTL file (the easy part). It only has the tile's texture,
+        # the other materials are in the city's shared MTL file.
+        mtl_path = os.path.join(full_path, TILE_MTL_FILENAME)
+        material_name = "%d_%d_%d" % (i, j, tile_min.zone)
+        f = open(mtl_path, 'w')
+        write_texture_material(f, material_name, TILE_TEXTURE_FILENAME)
+        f.close()
+
+        # Start the OBJ file
+        obj_path = os.path.join(full_path, TILE_OBJ_FILENAME)
+        f = open(obj_path, 'w')
+
+        # The header is always this
+        f.write("mtllib %s\n" % (tile_mtllib))
+
+        if args.terrain_lod:
+            # Simplified terrain. LOD 0 goes in this OBJ and the coarser LODs get their own OBJs.
+            terrain_meshes = terrain_lod_meshes(dem, current_tile, args.terrain_lod_grid_size, terrain_lod_errors, edge_cache)
+            terrain_vertices, terrain_uvs, terrain_faces = terrain_meshes[0]
+            write_terrain_mesh(f, terrain_vertices, terrain_uvs, terrain_faces, material_name)
+            for lod in range(1, len(terrain_meshes)):
+                lod_f = open(os.path.join(full_path, TILE_LOD_OBJ_FILENAME % (lod)), 'w')
+                lod_f.write("mtllib %s\n" % (tile_mtllib))
+                write_terrain_mesh(lod_f, *terrain_meshes[lod], material_name)
+                lod_f.close()
+            num_terrain_vertices = len(terrain_vertices)
+            num_tile_triangles = len(terrain_faces)
+        else:
             # Add the terrain. Use the DEM.
-            for local_x in range(0, TileID.TILE_SIZE + TERRAIN_MESH_RES, TERRAIN_MESH_RES):
-                for local_y in range(0, TileID.TILE_SIZE + TERRAIN_MESH_RES, TERRAIN_MESH_RES):
-                    # Compute the elevation and write the vertex's coordinates
-                    elevation = dem.interpolate(sw_x + local_x, sw_y + local_y)
+            f.write("# Terrain vertices\n")
+            terrain_heights = sample_terrain_grid(dem, current_tile, TERRAIN_MESH_ROW_SIZE + 1, edge_cache)
+            for x_index, local_x in enumerate(range(0, TileID.TILE_SIZE + TERRAIN_MESH_RES, TERRAIN_MESH_RES)):
+                for y_index, local_y in enumerate(range(0, TileID.TILE_SIZE + TERRAIN_MESH_RES, TERRAIN_MESH_RES)):
+                    # Write the vertex's coordinates
+                    elevation = terrain_heights[y_index, x_index]
                     # The z (y) coordinate is flipped here. Do OBJs have -z being up?
                     f.write("v    %.6f    %.6f    %.6f\n" % (local_x, elevation, TileID.TILE_SIZE - local_y))
 
@@ -225,69 +296,82 @@ def main():
                     p2 = p3
                     p3 = p1 + 1
                     f.write("f %d/%d %d/%d %d/%d\n" % (p1, p1, p2, p2, p3, p3))
-
-            # Add all of the buildings
-            # This variable tracks which index the building's vertices starts with
-            starting_vertex_index = (TERRAIN_MESH_ROW_SIZE + 1) * (TERRAIN_MESH_ROW_SIZE + 1) + 1
-            for pwp in building_pwps:
-                # Check if the building should be omitted
-                osm_id = int(get_property_or_default(pwp.properties, "osm_id", 0))
-                if osm_id in osm_ids_to_ignore:
-                    continue
-
+            num_terrain_vertices = (TERRAIN_MESH_ROW_SIZE + 1) * (TERRAIN_MESH_ROW_SIZE + 1)
+            num_tile_triangles = 2 * TERRAIN_MESH_ROW_SIZE * TERRAIN_MESH_ROW_SIZE
+
+        # Add all of the buildings
+        # This variable tracks which index the building's vertices starts with
+        starting_vertex_index = num_terrain_vertices + 1
+        if args.true_footprints:
+            # Extrude the real footprints. Everything is done for the whole tile at once.
+            kept_pwps = [pwp for pwp in building_pwps if int(get_property_or_default(pwp.properties, "osm_id", 0)) not in osm_ids_to_ignore]
+            footprints = simplify_footprints([pwp.polygon for pwp in kept_pwps], args.footprint_simplify_tolerance, args.max_footprint_vertices)
+            base_elevations = []
+            top_elevations = []
+            colors = []
+            roof_colors = []
+            for pwp, footprint in zip(kept_pwps, footprints):
                 # Determine the elevation/height properties
-                building = pwp.polygon
-                lowest_elevation, highest_elevation = query_building_elevations(building.convex_hull, dem)
+                if footprint.is_empty:
+                    lowest_elevation, highest_elevation = 0., 0.
+                else:
+                    lowest_elevation, highest_elevation = query_building_elevations(footprint, dem)
                 above_ground_height = float(get_property_or_default(pwp.properties, "height", 5.))
-                height = above_ground_height + highest_elevation - lowest_elevation
+                base_elevations.append(lowest_elevation)
+                top_elevations.append(highest_elevation + above_ground_height)
 
                 # The color
-                if config.at["SINGLE_COLOR_BUILDINGS"]:
-                    color = config.at["BUILDING_MESH_COLOR"]
-                else:
-                    color = get_property_or_default(pwp.properties, "mesh_color", "concrete")
-                if config.at["SINGLE_COLOR_ROOFS"]:
-                    roof_color = config.at["ROOF_MESH_COLOR"]
-                else:
-                    roof_color = get_property_or_default(pwp.properties, "roof_color", "roof_white")
-
-                # Write the vertices of the building
-                # Use a flipped convex hull because OBJs are -z up (I think that's why)
-                convex_hull = get_convex_hull_reflected_across_tile_y(building, current_tile)
-                # Add a point at the center of the top face for triangulating
-                f.write("# Building vertices\n")
-                f.write("v    %.6f    %.6f    %.6f\n" % (convex_hull.centroid.x - sw_x, lowest_elevation + height, convex_hull.centroid.y - sw_y))
-                # Slice to avoid the duplicated starting point
-                vertices = list(convex_hull.exterior.coords)[:-1]
-                for x, y in vertices:
-                    # Point on the base of the building
-                    f.write("v    %.6f    %.6f    %.6f\n" % (x - sw_x, lowest_elevation, y - sw_y))
-                    # Point on the top of the building
-                    f.write("v    %.6f    %.6f    %.6f\n" % (x - sw_x, lowest_elevation + height, y - sw_y))
-                    # For now, buildings don't have textures, just colors. So no UVs.
-
-                # Write the header of the building
-                f.write("g a building with %d vertices\n" % (len(vertices)))
-                f.write("usemtl %s\n" % (color))
-
-                # Once again, doing the triangulation is tricky
-                # For the sides of the building, each face is a bottom right triangle and a top left triangle
-                # On the top base of the building, each vertex connects to the center
-                for face_index in range(len(vertices) - 1):
-                    # Bottom right triangle
-                    p1 = 1 + starting_vertex_index + (2 * face_index)
-                    p2 = p1 + 2
-                    p3 = p2 + 1
-                    f.write("f %d %d %d\n" % (p1, p2, p3))
-                    # Top left triangle
-                    p2 = p3
-                    p3 = p1 + 1
-                    f.write("f %d %d %d\n" % (p1, p2, p3))
-
-                # Connect to the end to the beginning
+                colors.append(config.building_color_override or get_property_or_default(pwp.properties, "mesh_color", "concrete"))
+                roof_colors.append(config.roof_color_override or get_property_or_default(pwp.properties, "roof_color", "roof_white"))
+
+            extrusion = extrude_footprints(footprints, base_elevations, top_elevations, current_tile, starting_vertex_index)
+            write_extruded_buildings(f, extrusion, colors, roof_colors)
+            starting_vertex_index += len(extrusion[0])
+            num_tile_triangles += len(extrusion[1]) + len(extrusion[3])
+            # The convex hull loop below has nothing left to do
+            building_pwps = []
+        for pwp in building_pwps:
+            # Check if the building should be omitted
+            osm_id = int(get_property_or_default(pwp.properties, "osm_id", 0))
+            if osm_id in osm_ids_to_ignore:
+                continue
+
+            # Determine the elevation/height properties
+            building = pwp.polygon
+            lowest_elevation, highest_elevation = query_building_elevations(building.convex_hull, dem)
+            above_ground_height = float(get_property_or_default(pwp.properties, "height", 5.))
+            height = above_ground_height + highest_elevation - lowest_elevation
+
+            # The color
+            color = config.building_color_override or get_property_or_default(pwp.properties, "mesh_color", "concrete")
+            roof_color = config.roof_color_override or get_property_or_default(pwp.properties, "roof_color", "roof_white")
+
+            # Write the vertices of the building
+            # Use a flipped convex hull because OBJs are -z up (I think that's why)
+            convex_hull = get_convex_hull_reflected_across_tile_y(building, current_tile)
+            # Add a point at the center of the top face for triangulating
+            f.write("# Building vertices\n")
+            f.write("v    %.6f    %.6f    %.6f\n" % (convex_hull.centroid.x - sw_x, lowest_elevation + height, convex_hull.centroid.y - sw_y))
+            # Slice to avoid the duplicated starting point
+            vertices = list(convex_hull.exterior.coords)[:-1]
+            for x, y in vertices:
+                # Point on the base of the building
+                f.write("v    %.6f    %.6f    %.6f\n" % (x - sw_x, lowest_elevation, y - sw_y))
+                # Point on the top of the building
+                f.write("v    %.6f    %.6f    %.6f\n" % (x - sw_x, lowest_elevation + height, y - sw_y))
+                # For now, buildings don't have textures, just colors. So no UVs.
+
+            # Write the header of the building
+            f.write("g a building with %d vertices\n" % (len(vertices)))
+            f.write("usemtl %s\n" % (color))
+
+            # Once again, doing the triangulation is tricky
+            # For the sides of the building, each face is a bottom right triangle and a top left triangle
+            # On the top base of the building, each vertex connects to the center
+            for face_index in range(len(vertices) - 1):
                 # Bottom right triangle
-                p1 = 1 + starting_vertex_index + 2 * (len(vertices) - 1)
-                p2 = starting_vertex_index + 1
+                p1 = 1 + starting_vertex_index + (2 * face_index)
+                p2 = p1 + 2
                 p3 = p2 + 1
                 f.write("f %d %d %d\n" % (p1, p2, p3))
                 # Top left triangle
@@ -295,107 +379,117 @@ def main():
                 p3 = p1 + 1
                 f.write("f %d %d %d\n" % (p1, p2, p3))
 
-                # Write the header of the roof
-                f.write("g roof of building\n")
-                f.write("usemtl %s\n" % (roof_color))
-                # Triangulate the top base of the building. Each vertex connects to the center.
-                for face_index in range(len(vertices) - 1):
-                    p1 = 1 + starting_vertex_index + (2 * face_index) + 1
-                    p2 = p1 + 2
-                    p3 = starting_vertex_index
-                    f.write("f %d %d %d\n" % (p1, p2, p3))
-                # Finish the last triangle at the end
-                p1 = starting_vertex_index + 2
-                p1 = 1 + starting_vertex_index + 2 * (len(vertices) - 1) + 1
-                p2 = starting_vertex_index + 2
+            # Connect to the end to the beginning
+            # Bottom right triangle
+            p1 = 1 + starting_vertex_index + 2 * (len(vertices) - 1)
+            p2 = starting_vertex_index + 1
+            p3 = p2 + 1
+            f.write("f %d %d %d\n" % (p1, p2, p3))
+            # Top left triangle
+            p2 = p3
+            p3 = p1 + 1
+            f.write("f %d %d %d\n" % (p1, p2, p3))
+
+            # Write the header of the roof
+            f.write("g roof of building\n")
+            f.write("usemtl %s\n" % (roof_color))
+            # Triangulate the top base of the building. Each vertex connects to the center.
+            for face_index in range(len(vertices) - 1):
+                p1 = 1 + starting_vertex_index + (2 * face_index) + 1
+                p2 = p1 + 2
                 p3 = starting_vertex_index
                 f.write("f %d %d %d\n" % (p1, p2, p3))
-
-                # Update the vertex index based on how many this building added
-                starting_vertex_index += (2 * len(vertices) + 1)
-
-            # Now add trees
-            # TODO why subtract 1?
-            starting_vertex_index -= 1
-            # rng used for picking autumn colors
-            rng = np.random.default_rng()
-            for shapely_tree_point in tree_points:
-                tree_x = shapely_tree_point.x - sw_x
-                tree_y = shapely_tree_point.y - sw_y
-                elevation = dem.interpolate(sw_x + tree_x, sw_y + tree_y)
-                for line in tree_obj_lines:
-                    if line.startswith('m') or line.startswith('#'):
-                        continue
-                    elif line.startswith('g'):
-                        f.write(line)
-                    elif line.startswith('u'):
-                        if not config.at["AUTUMN"] or ("brown" in line):
-                            f.write(line)
-                        else:
-                            rand = rng.random()
-                            if rand < 0.33:
-                                f.write("usemtl tree_red\n")
-                            elif rand < 0.67:
-                                f.write("usemtl tree_yellow\n")
-                            elif rand < 0.98:
-                                f.write("usemtl tree_orange\n")
-                            else:
-                                f.write(line)
-                    elif line.startswith('v'):
-                        coords = line.split()[1:]
-                        x = float(coords[0]) + tree_x
-                        y = float(coords[1]) + elevation
-                        z = float(coords[2]) + (TileID.TILE_SIZE - tree_y)
-                        f.write("v    %.6f    %.6f    %.6f\n" % (x, y, z))
-                    elif line.startswith('f'):
-                        indices = line.split()[1:]
-                        a = int(indices[0]) + starting_vertex_index
-                        b = int(indices[1]) + starting_vertex_index
-                        c = int(indices[2]) + starting_vertex_index
-                        f.write("f %d %d %d\n" % (a, b, c))
-                starting_vertex_index += num_tree_points
-
-            # For the last step, add in any custom buildings
-            f.write("g custom buildings\n")
-            f.write("usemtl %s\n" % ("brick"))
-            for filename in custom_building_filenames_to_centers:
-                center_x, center_y = custom_building_filenames_to_centers[filename]
-                elevation = dem.interpolate(center_x, center_y)
-                local_center_x = center_x - sw_x
-                local_center_y = center_y - sw_y
-                custom_building_full_path = os.path.join(full_path, filename)
-                try:
-                    building_file = open(custom_building_full_path)
-                    lines = building_file.readlines()
-                    building_file.close()
-                except FileNotFoundError:
-                    print("Failed to find %s" % (custom_building_full_path))
-                    continue
-
-                # Add lines to the tile's OBJ based on the lines in the custom building's OBJ
-                num_building_points = 0
-                for line in lines:
-                    if line.startswith('v'):
-                        coords = line.split()[1:]
-                        x = float(coords[0]) + local_center_x
-                        y = float(coords[1]) + elevation
-                        z = float(coords[2]) + (TileID.TILE_SIZE - local_center_y)
-                        f.write("v    %.6f    %.6f    %.6f\n" % (x, y, z))
-                        num_building_points += 1
-                    elif line.startswith('f'):
-                        indices = line.split()[1:]
-                        a = int(indices[0]) + starting_vertex_index
-                        b = int(indices[1]) + starting_vertex_index
-                        c = int(indices[2]) + starting_vertex_index
-                        f.write("f %d %d %d\n" % (a, c, b)) # TODO: why reverse orientation?
-                starting_vertex_index += num_building_points
-
-            f.close()
-
-            # Log the status
-            time_elapsed = time.time() - start_time
-            num_complete += 1
-            print(get_time_estimate_string(time_elapsed, num_complete, num_tiles))
+            # Finish the last triangle at the end
+            p1 = starting_vertex_index + 2
+            p1 = 1 + starting_vertex_index + 2 * (len(vertices) - 1) + 1
+            p2 = starting_vertex_index + 2
+            p3 = starting_vertex_index
+            f.write("f %d %d %d\n" % (p1, p2, p3))
+
+            # Update the vertex index based on how many this building added
+            starting_vertex_index += (2 * len(vertices) + 1)
+            num_tile_triangles += 3 * len(vertices)
+
+        # Now add trees
+        # TODO why subtract 1?
+        starting_vertex_index -= 1
+        # Each tree gets one of the tree models, and random numbers used for picking
+        # autumn colors, one for every material group of its model. They only
+        # depend on where the tree is.
+        num_tree_materials = max(len(lods[0][2]) for lods in tree_lods)
+        tree_xs = np.array([p.x for p in tree_points])
+        tree_ys = np.array([p.y for p in tree_points])
+        tree_keys = point_keys(tree_xs, tree_ys)
+        tree_model_indices = np.minimum(np.searchsorted(tree_model_cdf, stable_uniforms(tree_keys, TREE_MODEL_STREAM), side='right'), len(tree_models) - 1)
+        autumn_rands = np.array([stable_uniforms(tree_keys, AUTUMN_STREAM, seed=k) for k in range(num_tree_materials)]).reshape(num_tree_materials, len(tree_points))
+        tree_elevations = dem.interpolate_many(tree_xs, tree_ys)
+
+        # Stay within the tile's triangle budget by drawing the densest trees as
+        # impostors, and thinning the trees out if that isn't enough
+        tree_keep = np.ones(len(tree_points), dtype=bool)
+        tree_lod_indices = np.zeros(len(tree_points), dtype=np.int64)
+        if args.max_tile_triangles > 0:
+            num_custom_building_triangles = sum(mesh.num_triangles() for mesh in custom_building_meshes.values() if mesh is not None)
+            tree_budget = args.max_tile_triangles - num_tile_triangles - num_custom_building_triangles
+            tree_face_counts = tree_lod_face_counts[tree_model_indices]
+            tree_keep, use_impostor = plan_tree_lods(tree_xs, tree_ys, stable_uniforms(tree_keys, TREE_LOD_STREAM),\
+                    tree_face_counts[:, 0], tree_face_counts[:, 1], tree_budget)
+            tree_lod_indices = use_impostor.astype(np.int64)
+            if use_impostor.any() or not tree_keep.all():
+                print("Drew %d of %d trees as impostors and left out %d to stay under %d triangles." % (use_impostor[tree_keep].sum(), len(tree_points), (~tree_keep).sum(), args.max_tile_triangles))
+
+        for tree_index, shapely_tree_point in enumerate(tree_points):
+            if not tree_keep[tree_index]:
+                continue
+            tree_mesh, group_starts, group_materials, rand_indices = tree_lods[tree_model_indices[tree_index]][tree_lod_indices[tree_index]]
+            tree_x = shapely_tree_point.x - sw_x
+            tree_y = shapely_tree_point.y - sw_y
+            elevation = tree_elevations[tree_index]
+            f.write("g tree\n")
+            f.write(format_obj_vertices(tree_mesh.vertices + np.array([tree_x, elevation, TileID.TILE_SIZE - tree_y])))
+            for group_index, material_index in enumerate(group_materials):
+                if material_index >= 0:
+                    material = tree_mesh.materials[material_index]
+                    rand = autumn_rands[rand_indices[group_index], tree_index]
+                    if config.autumn and not ("brown" in material):
+                        if rand < 0.33:
+                            material = "tree_red"
+                        elif rand < 0.67:
+                            material = "tree_yellow"
+                        elif rand < 0.98:
+                            material = "tree_orange"
+                    f.write("usemtl %s\n" % (material))
+                group_faces = tree_mesh.faces[group_starts[group_index]:group_starts[group_index + 1]]
+                f.write(format_obj_faces(group_faces + starting_vertex_index + 1))
+            starting_vertex_index += len(tree_mesh.vertices)
+
+        # For the last step, add in any custom buildings
+        f.write("g custom buildings\n")
+        f.write("usemtl %s\n" % ("brick"))
+        for filename in custom_building_filenames_to_centers:
+            center_x, center_y = custom_building_filenames_to_centers[filename]
+            elevation = dem.interpolate(center_x, center_y)
+            local_center_x = center_x - sw_x
+            local_center_y = center_y - sw_y
+            building_mesh = custom_building_meshes[filename]
+            if building_mesh is None:
+                print("Failed to find %s" % (os.path.join(full_path, filename)))
+                continue
+
+            # Add the custom building's vertices and faces to the tile's OBJ
+            offset = np.array([local_center_x, elevation, TileID.TILE_SIZE - local_center_y])
+            f.write(format_obj_vertices(building_mesh.vertices + offset))
+            f.write(format_obj_faces(building_mesh.faces[:, [0, 2, 1]] + starting_vertex_index + 1)) # TODO: why reverse orientation?
+            starting_vertex_index += len(building_mesh.vertices)
+
+        f.close()
+        journal.mark_complete(i, j)
+
+        # Log the status
+        time_elapsed = time.time() - start_time
+        num_complete += 1
+        print(get_time_estimate_string(time_elapsed, num_complete, num_tiles))
+    journal.finish()
 
 if __name__ == "__main__":
     main()
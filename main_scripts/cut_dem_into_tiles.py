@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+
+# Cut a GeoTIFF DEM into one elevation array per tile, so meshes can be
+# made without reading the whole DEM every time.
+
+import argparse
+import json
+import numpy as np
+import os
+import sys
+import time
+
+sys.path.insert(1, 'C:/Users/mse93/Documents/simple-cities-digital-twins/utility_scripts')
+from configuration import *
+from file_utils import *
+from general_utils import *
+from latlon_to_utm import *
+from tiff_utils import *
+from tile_id import *
+
+def write_dem_tile(filepath, array):
+    f = AtomicFile(filepath, 'wb')
+    np.save(f, np.ascontiguousarray(array))
+    f.commit()
+
+def main():
+    parser = argparse.ArgumentParser(description="Cut a GeoTIFF DEM into per-tile elevation arrays.")
+    parser.add_argument("--dem-path", required=True, nargs='+', help="Path to GeoTIFF DEM file, or several GeoTIFFs (or directories of them) that make up the DEM")
+    parser.add_argument("--dem-nodata", required=False, type=float, default=None, help='Value of the DEM samples that have no data. They are filled in from the nearest samples that have data.')
+    parser.add_argument("-t", "--tile-directory", required=True, help="Name of tile directory")
+    parser.add_argument("--city-name", required=True, help="Name of city (sub-directory of output directory)")
+    parser.add_argument("--sw", required=True, help='SW corner formatted as "lat,lon" or "lat, lon"')
+    parser.add_argument("--ne", required=True, help='NE corner formatted as "lat,lon" or "lat, lon"')
+    parser.add_argument("--utm-zone", required=False, type=int, default=0, help='Project everything into this UTM zone, so the area can cross zone boundaries')
+    parser.add_argument("--buffer", required=False, type=int, default=2, help='Number of extra DEM samples kept around each tile')
+    parser.add_argument("--margin-tiles", required=False, type=int, default=1, help='Also cut this many tiles around the area, for buildings that stick out of it')
+    parser.add_argument("--levels", required=False, type=int, default=1, help='Number of levels to write. Each level after the first keeps every other sample of the one before it.')
+    parser.add_argument("--write-threads", required=False, type=int, default=8, help='Number of threads used to write the tile files')
+
+    args = parser.parse_args()
+
+    # Get the min/max tile IDs from the lat/lon
+    lat1, lon1 = parse_latlon_string(args.sw)
+    lat2, lon2 = parse_latlon_string(args.ne)
+    tile_min, tile_max = tile_area(lat1, lon1, lat2, lon2, args.utm_zone)
+    if tile_min is None:
+        return
+    min_i = tile_min.i - args.margin_tiles
+    min_j = tile_min.j - args.margin_tiles
+    max_i = tile_max.i + args.margin_tiles
+    max_j = tile_max.j + args.margin_tiles
+    num_tiles = (max_i - min_i + 1) * (max_j - min_j + 1)
+    print("Cutting the DEM into %d tile%s." % (num_tiles,  "s" if num_tiles > 1 else ""))
+
+    city_directory = os.path.join(args.tile_directory, args.city_name)
+    os.makedirs(city_directory, exist_ok=True)
+
+    # Load the DEM
+    dem = open_dem(args.dem_path, args.dem_nodata)
+    levels = []
+    for level in range(args.levels):
+        step = 2 ** level
+        levels.append({"step" : step, "res_x" : dem.res_x * step, "res_y" : dem.res_y * step,\
+                "cols" : (dem.cols + step - 1) // step, "rows" : (dem.rows + step - 1) // step})
+
+    start_time = time.time()
+    num_complete = 0
+    writer = BackgroundWriter(args.write_threads)
+    for i in range(min_i, max_i + 1):
+        for j in range(min_j, max_j + 1):
+            current_tile = TileID.tile_indices_to_object(i, j, tile_min.zone)
+            full_path = os.path.join(city_directory, "%d_%d_%d" % (i, j, tile_min.zone))
+            for level_index, level in enumerate(levels):
+                i_min, i_max, j_min, j_max = dem_window(dem.min_x, dem.min_y, level["res_x"], level["res_y"],\
+                        level["cols"], level["rows"], current_tile, args.buffer)
+                os.makedirs(full_path, exist_ok=True)
+                block = dem.read_block(i_min, i_max, j_min, j_max, level["step"])
+                writer.submit(write_dem_tile, os.path.join(full_path, DEM_TILE_FILENAME % (level_index)), block)
+
+            num_complete += 1
+            time_elapsed = int(time.time() - start_time)
+            print(get_time_estimate_string(time_elapsed, num_complete, num_tiles))
+    writer.finish()
+
+    # Write the index last, so it only exists once every tile does
+    index = {"min_x" : dem.min_x, "min_y" : dem.min_y, "buffer" : args.buffer, "tiles" : [min_i, min_j, max_i, max_j],\
+            "levels" : [{key : level[key] for key in ["res_x", "res_y", "cols", "rows"]} for level in levels]}
+    f = AtomicFile(os.path.join(city_directory, DEM_INDEX_FILENAME))
+    f.write(json.dumps(index))
+    f.commit()
+    print("Stored the DEM of %d tiles in %s." % (num_tiles, city_directory))
+
+if __name__ == "__main__":
+    main()
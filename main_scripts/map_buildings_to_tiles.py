@@ -5,22 +5,90 @@
 
 import argparse
 import geojson
+import multiprocessing
+import numpy as np
 import os
 import shapely
-import subprocess
 import sys
 import time
 import utm
 
 sys.path.insert(1, 'C:/Users/mse93/Documents/simple-cities-digital-twins/utility_scripts')
 from configuration import *
+from feature_store import *
 from general_utils import *
 from geojson_utils import *
 from latlon_to_utm import *
 from polygon_utils import *
 from property_filter import *
+from spatial_sort import *
+from tile_context_cache import *
 from tile_id import *
 
+# The context every worker process needs. Each worker gets its own copy of
+# it, including its own cache of the per-tile downtown/park/residential polygons.
+worker_context = {}
+
+def init_worker(config_filepath, offset, zone, geojson_crs, city_directory, tile_bounds, context_cache_size, union_context):
+    geojson.geometry.DEFAULT_PRECISION = 10
+    worker_context["property_filter"] = PropertyFilter(Configuration(config_filepath))
+    worker_context["offset"] = offset
+    worker_context["zone"] = zone
+    worker_context["geojson_crs"] = geojson_crs
+    worker_context["city_directory"] = city_directory
+    worker_context["tile_bounds"] = tile_bounds
+    worker_context["tile_contexts"] = TileContextCache(city_directory, zone, context_cache_size, union_context)
+
+def map_features_to_tiles(geojson_features):
+    """
+    Project a chunk of geojson features into UTM and figure out which tile
+    each building's center is in. Returns (tile_is, tile_js, store), where
+    store is a FeatureStore of the chunk's buildings and tile_is/tile_js
+    are their tiles, skipping buildings outside of the tile area.
+    """
+    polygon_features = [geojson_feature for geojson_feature in geojson_features if geojson_feature.geometry["type"] in ["Polygon", "MultiPolygon"]]
+    polygons = []
+    properties_list = []
+    for geojson_feature, polygon_list in zip(polygon_features,\
+            geojson_features_to_shapely_lists(polygon_features, worker_context["zone"], worker_context["offset"])):
+        for polygon in polygon_list:
+            if polygon.is_empty:
+                continue
+            polygons.append(polygon)
+            properties_list.append(geojson_feature.properties)
+
+    # Figure out which tile each center is in
+    centroids = shapely.centroid(np.asarray(polygons, dtype=object))
+    tile_is = np.floor(shapely.get_x(centroids) / TileID.TILE_SIZE).astype(np.int64)
+    tile_js = np.floor(shapely.get_y(centroids) / TileID.TILE_SIZE).astype(np.int64)
+
+    # If the polygon's center is not in the tile area, ignore it
+    min_i, min_j, max_i, max_j = worker_context["tile_bounds"]
+    inside = (min_i <= tile_is) & (tile_is <= max_i) & (min_j <= tile_js) & (tile_js <= max_j)
+    store = FeatureStore(BUILDING_PROPERTY_KEYS)
+    store.extend([polygon for polygon, keep in zip(polygons, inside) if keep],\
+            [properties for properties, keep in zip(properties_list, inside) if keep])
+    return tile_is[inside], tile_js[inside], store
+
+def filter_and_write_tile(tile_key, store):
+    """
+    Filter the properties of all of a tile's buildings and write
+    the tile's buildings geojson file.
+    """
+    # Filter out unused properties and set the required ones, a whole tile at a time.
+    # Tiles without buildings don't need their context loaded.
+    i, j = tile_key
+    polygons = store.polygons()
+    if len(store) > 0:
+        context = worker_context["tile_contexts"].get(i, j)
+        filtered_properties = worker_context["property_filter"].filter_polygons_batch(polygons, store.properties_list(),\
+                context.downtown, context.park, context.residential)
+    else:
+        filtered_properties = []
+    # Write the buildings straight to the file, creating the tile's directory if needed
+    return write_tile_geojson_features(worker_context["city_directory"], i, j, worker_context["zone"], BUILDINGS_FILENAME,\
+            polygons, filtered_properties, worker_context["geojson_crs"])
+
 def main():
     parser = argparse.ArgumentParser(description="Map geojson polygons into tiles.")
     parser.add_argument("--config-file", required=True, help="Path to the configuration file")
@@ -29,20 +97,22 @@ def main():
     parser.add_argument("--city-name", required=True, help="Name of city (sub-directory of output directory that will be created)")
     parser.add_argument("--sw", required=True, help='SW corner formatted as "lat,lon" or "lat, lon"')
     parser.add_argument("--ne", required=True, help='NE corner formatted as "lat,lon" or "lat, lon"')
+    parser.add_argument("--utm-zone", required=False, type=int, default=0, help='Project everything into this UTM zone, so the area can cross zone boundaries')
     parser.add_argument("--offset-x", required=False, type=float, default=0., help='Offset x coord of each point')
     parser.add_argument("--offset-y", required=False, type=float, default=0., help='Offset y coord of each point')
+    parser.add_argument("--spatial-sort", required=False, choices=SPATIAL_SORT_CURVES, default="none", help='Sort the features along a space-filling curve through the tiles before mapping them, so consecutive features land in nearby tiles.')
+    parser.add_argument("--workers", required=False, type=int, default=1, help='Number of worker processes used to map and write the buildings')
+    parser.add_argument("--chunk-size", required=False, type=int, default=10000, help='Number of geojson features each worker maps at a time')
+    parser.add_argument("--context-cache-size", required=False, type=int, default=256, help='Number of tiles whose downtown/park/residential polygons each worker keeps in memory')
+    parser.add_argument("--union-context", required=False, action="store_true", help='Combine each tile\'s downtown/park/residential polygons into a prepared union for faster lookups')
 
     args = parser.parse_args()
 
-    config = Configuration(args.config_file)
-
     # Get the min/max tile IDs from the lat/lon
     lat1, lon1 = parse_latlon_string(args.sw)
     lat2, lon2 = parse_latlon_string(args.ne)
-    tile_min = TileID(lat1, lon1)
-    tile_max = TileID(lat2, lon2)
-    if tile_min.zone != tile_max.zone:
-        print("Crossing from UTM zone %d to %d. Quitting." % (tile_min.zone, tile_max.zone))
+    tile_min, tile_max = tile_area(lat1, lon1, lat2, lon2, args.utm_zone)
+    if tile_min is None:
         return
     min_i = tile_min.i
     min_j = tile_min.j
@@ -56,10 +126,7 @@ def main():
     city_directory = os.path.join(args.tile_directory, args.city_name)
 
     # Try to create the directory, in case it doesn't exist
-    p = subprocess.Popen(['mkdir', args.tile_directory], shell=True)
-    p.communicate()
-    p = subprocess.Popen(['mkdir', city_directory], shell=True)
-    p.communicate()
+    os.makedirs(city_directory, exist_ok=True)
 
     geojson.geometry.DEFAULT_PRECISION = 10
 
@@ -68,85 +135,61 @@ def main():
     geojson_contents = geojson.loads(f.read())
     f.close()
 
-    # Start by mapping every tile to an empty polygon
-    # and reading in downtown, park, and residential polygons
-    tile_to_pwps_map = {}
-    tile_to_downtown_multipolygon_map = {}
-    tile_to_park_multipolygon_map = {}
-    tile_to_residential_multipolygon_map = {}
-    print("Initializing an empty multipolygon for all %d tiles." % (num_tiles))
+    # Start by mapping every tile to an empty store of buildings. The downtown, park,
+    # and residential polygons are read later, the first time a tile needs them.
+    tile_to_store_map = {}
+    print("Initializing an empty building store for all %d tiles." % (num_tiles))
     for i in range(min_i, max_i + 1):
         for j in range(min_j, max_j + 1):
-            full_path = os.path.join(city_directory, "%d_%d_%d" % (i, j, tile_min.zone))
-            tile_to_downtown_multipolygon_map[(i, j)] = read_geojson_file_to_shapely_list(full_path, DOWNTOWN_FILENAME)
-            tile_to_park_multipolygon_map[(i, j)] = read_geojson_file_to_shapely_list(full_path, PARK_FILENAME)
-            tile_to_residential_multipolygon_map[(i, j)] = read_geojson_file_to_shapely_list(full_path, RESIDENTIAL_FILENAME)
-            tile_to_pwps_map[(i, j)] = []
-
-    property_filter = PropertyFilter(config)
+            tile_to_store_map[(i, j)] = FeatureStore(BUILDING_PROPERTY_KEYS)
+
+    # Every worker gets its own copy of the context. With one worker,
+    # everything runs in this process instead.
+    context = (args.config_file, (args.offset_x, args.offset_y), tile_min.zone, geojson_crs, city_directory,\
+            (min_i, min_j, max_i, max_j), args.context_cache_size, args.union_context)
+    if args.workers > 1:
+        pool = multiprocessing.Pool(args.workers, initializer=init_worker, initargs=context)
+        map_function = pool.imap
+        starmap_function = pool.starmap
+    else:
+        pool = None
+        init_worker(*context)
+        map_function = map
+        starmap_function = lambda function, arguments: [function(*a) for a in arguments]
 
     # Collect info for logging
     start_time = time.time()
     num_polygons = num_features_in_geojson_file(geojson_contents)
     num_completed = 0
 
-    # Now iterate over every polygon in the geojson, putting the building into the tile it belongs in
-    for geojson_feature in geojson_contents['features']:
-        pwps_lonlat = geojson_feature_to_pwps(geojson_feature)
-        if type(pwps_lonlat) != list:
-            pwps_lonlat = [pwps_lonlat]
-        for pwp_lonlat in pwps_lonlat:
-            pwp_utm = PolygonWithProperties(poly_lonlat_to_utm(pwp_lonlat.polygon, offset=(args.offset_x, args.offset_y)), pwp_lonlat.properties)
-
-            if pwp_utm.polygon.is_empty:
-                # Polygon could be empty if it crossed a UTM boundary
-                continue
-
-            # Figure out which tile its center is in
-            center_x, center_y = pwp_utm.polygon.centroid.x, pwp_utm.polygon.centroid.y
-            containing_tile = TileID(center_x, center_y, tile_min.zone)
-
-            if not (containing_tile.i, containing_tile.j) in tile_to_pwps_map:
-                # If the polygon's center is not in the tile area, ignore it
-                continue
-
-            # Filter out unused properties and set the required ones
-            downtown = tile_to_downtown_multipolygon_map[(containing_tile.i, containing_tile.j)]
-            park = tile_to_park_multipolygon_map[(containing_tile.i, containing_tile.j)]
-            residential = tile_to_residential_multipolygon_map[(containing_tile.i, containing_tile.j)]
-            pwp_utm.properties = property_filter.filter(pwp_utm, downtown, park, residential)
-
-            # Add it to the tile's list of polygons
-            tile_to_pwps_map[(containing_tile.i, containing_tile.j)].append(pwp_utm)
- 
-            # Log the status
-            num_completed += 1
-            time_elapsed = int(time.time() - start_time)
-            print(get_time_estimate_string(time_elapsed, num_completed, num_polygons))
-
-    # The tile to polygon map is complete. Write each tile's geojson file.
-    print("Storing files in tiles.")
-    for i in range(min_i, max_i + 1):
-        for j in range(min_j, max_j + 1):
-            geojson_features = []
-            for pwp in tile_to_pwps_map[(i, j)]:
-                geojson_feature = polygon_with_properties_to_geojson(pwp)
-                geojson_features.append(geojson_feature)
-
-            # Create the tile's directory, in case it doesn't exist yet
-            full_path = os.path.join(city_directory, "%d_%d_%d" % (i, j, tile_min.zone))
-            p = subprocess.Popen(['mkdir', full_path], shell=True)
-            p.communicate()
-
-            # Dump the geojson object into a string
-            dump = geojson.dumps(geojson.FeatureCollection(features=geojson_features, crs=geojson_crs))
-
-            # Finally, write to the file
-            full_path = os.path.join(full_path, BUILDINGS_FILENAME)
-            f = open(full_path, 'w')
-            f.write(dump)
-            f.close()
-    print("Stored %d %s files in %s." % (num_tiles, BUILDINGS_FILENAME, full_path))
+    # Now split the features into chunks and put every building into the tile it belongs in.
+    # The chunks come back in order, so each tile's buildings are in the same order as the input
+    # (sorting the features along a curve keys them on the same centroid, so that stays true
+    # except for multipolygons with parts in several tiles).
+    features = sort_features_spatially(geojson_contents['features'], tile_min.zone, (args.offset_x, args.offset_y), args.spatial_sort)
+    chunks = [features[k:k + args.chunk_size] for k in range(0, len(features), args.chunk_size)]
+    for chunk, (tile_is, tile_js, store) in zip(chunks, map_function(map_features_to_tiles, chunks)):
+        # Add them to their tile's store. Their properties get filtered
+        # later, together with the rest of the tile's buildings.
+        if len(store) > 0:
+            tile_keys, inverse, counts = np.unique(np.column_stack((tile_is, tile_js)), axis=0, return_inverse=True, return_counts=True)
+            order = np.argsort(inverse.ravel(), kind='stable')
+            for (i, j), indices in zip(tile_keys.tolist(), np.split(order, np.cumsum(counts)[:-1])):
+                tile_to_store_map[(i, j)].extend_store(store, indices)
+
+        # Log the status
+        num_completed += len(chunk)
+        time_elapsed = int(time.time() - start_time)
+        print(get_time_estimate_string(time_elapsed, num_completed, num_polygons))
+
+    # The tile to polygon map is complete. Filter and write each tile's geojson file.
+    print("Filtering building properties and storing files in tiles.")
+    tile_keys = [(i, j) for i in range(min_i, max_i + 1) for j in range(min_j, max_j + 1)]
+    written_paths = starmap_function(filter_and_write_tile, [(tile_key, tile_to_store_map[tile_key]) for tile_key in tile_keys])
+    if pool is not None:
+        pool.close()
+        pool.join()
+    print("Stored %d %s files in %s." % (num_tiles, BUILDINGS_FILENAME, written_paths[-1]))
 
 if __name__ == "__main__":
     main()
@@ -7,27 +7,43 @@ import argparse
 import geojson
 import os
 import shapely
-import subprocess
 import sys
 import time
 import utm
 
 sys.path.insert(1, 'C:/Users/mse93/Documents/simple-cities-digital-twins/utility_scripts')
+from checkpoint_utils import *
 from configuration import *
 from general_utils import *
 from geojson_utils import *
 from latlon_to_utm import *
 from polygon_utils import *
+from spatial_sort import *
 from tile_id import *
 
-def map_shapely_polygon_into_tile(tile, shapely_polygon_latlon, manual_offset=(0.,0.)):
-    shapely_polygon_utm = poly_latlon_to_utm(shapely_polygon_latlon, offset=manual_offset)
+def map_shapely_polygon_into_tile(tile, shapely_polygon_utm):
     clipped_poly = tile.polygon().intersection(shapely_polygon_utm)
     if clipped_poly.is_simple:
         return clipped_poly
     else:
         return shapely.Polygon()
 
+def polygons_only(tile_union):
+    """
+    If the tile union is somehow a "geometry collection", make it
+    the union of just its polygons.
+    """
+    if type(tile_union) == shapely.geometry.collection.GeometryCollection:
+        polygon_union = shapely.Polygon()
+        for geom in tile_union.geoms:
+            if type(geom) == shapely.geometry.polygon.Polygon:
+                polygon_union = polygon_union.union(geom)
+            else:
+                pass
+        # Now it should be either a Polygon or MultiPolygon
+        tile_union = polygon_union
+    return tile_union
+
 def get_overlapping_tiles(shapely_polygon_utm, zone):
     x_min, y_min, x_max, y_max = shapely_polygon_utm.bounds
     min_tile = TileID(x_min, y_min, zone)
@@ -41,6 +57,7 @@ def main():
     parser.add_argument("--city-name", required=True, help="Name of city (sub-directory of output directory that will be created)")
     parser.add_argument("--sw", required=True, help='SW corner formatted as "lat,lon" or "lat, lon"')
     parser.add_argument("--ne", required=True, help='NE corner formatted as "lat,lon" or "lat, lon"')
+    parser.add_argument("--utm-zone", required=False, type=int, default=0, help='Project everything into this UTM zone, so the area can cross zone boundaries')
     parser.add_argument("--offset-x", required=False, type=float, default=0., help='Offset x coord of each point')
     parser.add_argument("--offset-y", required=False, type=float, default=0., help='Offset y coord of each point')
     optimization_group = parser.add_mutually_exclusive_group(required=True)
@@ -61,15 +78,18 @@ def main():
     polygon_category_group.add_argument("--farmland", action='store_true', help='The geojson polygons are farm fields (landuse=farmland in osm)')
     polygon_category_group.add_argument("--runway", action='store_true', help='The geojson polygons are airport runways')
 
+    parser.add_argument("--spatial-sort", required=False, choices=SPATIAL_SORT_CURVES, default="none", help='Sort the features along a space-filling curve through the tiles before mapping them, so consecutive features land in nearby tiles.')
+    parser.add_argument("--chunk-size", required=False, type=int, default=10000, help='Number of geojson features a --memory run converts to UTM at a time')
+    parser.add_argument("--write-threads", required=False, type=int, default=8, help='Number of threads used to write the tile files')
+    parser.add_argument("--resume", action='store_true', help='Pick up a --time run that crashed where its last checkpoint left off')
+    parser.add_argument("--checkpoint-minutes", required=False, type=float, default=5., help='Minutes between checkpoints of a --time run')
     args = parser.parse_args()
 
     # Get the min/max tile IDs from the lat/lon
     lat1, lon1 = parse_latlon_string(args.sw)
     lat2, lon2 = parse_latlon_string(args.ne)
-    tile_min = TileID(lat1, lon1)
-    tile_max = TileID(lat2, lon2)
-    if tile_min.zone != tile_max.zone:
-        print("Crossing from UTM zone %d to %d. Quitting." % (tile_min.zone, tile_max.zone))
+    tile_min, tile_max = tile_area(lat1, lon1, lat2, lon2, args.utm_zone)
+    if tile_min is None:
         return
     min_i = tile_min.i
     min_j = tile_min.j
@@ -112,10 +132,7 @@ def main():
     city_directory = os.path.join(args.tile_directory, args.city_name)
 
     # Try to create the directory, in case it doesn't exist
-    p = subprocess.Popen(['mkdir', args.tile_directory], shell=True)
-    p.communicate()
-    p = subprocess.Popen(['mkdir', city_directory], shell=True)
-    p.communicate()
+    os.makedirs(city_directory, exist_ok=True)
 
     geojson.geometry.DEFAULT_PRECISION = 10
 
@@ -130,37 +147,32 @@ def main():
         # Intersect every geometry from the geojson with every tile
         num_completed = 0
         start_time = time.time()
+        writer = BackgroundWriter(args.write_threads)
+        features = [geojson_feature for geojson_feature in geojson_contents['features'] if geojson_feature.geometry["type"] in ["Polygon", "MultiPolygon"]]
         for i in range(min_i, max_i + 1):
             for j in range(min_j, max_j + 1):
                 current_tile = TileID.tile_indices_to_object(i, j, tile_min.zone)
+                tile_polygon = current_tile.polygon()
                 tile_union = shapely.Polygon()
-                for geojson_multipolygon in geojson_contents['features']:
-                    shapely_polygons = geojson_multipoly_to_shapely(geojson_multipolygon.geometry.coordinates)
-                    for shapely_polygon_latlon in shapely_polygons:
-                        clipped_polygon = map_shapely_polygon_into_tile(current_tile, shapely_polygon_latlon, manual_offset=(args.offset_x, args.offset_y))
-                        tile_union = tile_union.union(clipped_polygon)
+                # Only a chunk of the features is in UTM at a time
+                for k in range(0, len(features), args.chunk_size):
+                    shapely_polygons, _ = geojson_features_to_shapely_array(features[k:k + args.chunk_size], tile_min.zone, (args.offset_x, args.offset_y))
+                    for shapely_polygon_utm in shapely_polygons[shapely.intersects(tile_polygon, shapely_polygons)]:
+                        try:
+                            clipped_polygon = map_shapely_polygon_into_tile(current_tile, shapely_polygon_utm)
+                            tile_union = tile_union.union(clipped_polygon)
+                        except shapely.errors.GEOSException:
+                            print("Error intersecting polygon with tile. Skipping")
+                            pass
+                tile_union = polygons_only(tile_union)
                 # Once every polygon has been intersected with the tile, overwrite the tile's geojson file
 
-                # Convert the multipolygon from shapely to geojson
-                if type(tile_union) == shapely.geometry.multipolygon.MultiPolygon:
-                    geojson_tile_union = shapely_multipolygon_to_geojson(tile_union)
-                elif type(tile_union) == shapely.geometry.polygon.Polygon:
-                    geojson_tile_union = shapely_polygon_to_geojson(tile_union)
-                features = [geojson.Feature(geometry=geojson_tile_union)]
-
-                # Create the tile's directory, in case it doesn't exist yet
-                full_path = os.path.join(city_directory, "%d_%d_%d" % (i, j, tile_min.zone))
-                p = subprocess.Popen(['mkdir', full_path], shell=True)
-                p.communicate()
-
-                # Dump the geojson object into a string
-                dump = geojson.dumps(geojson.FeatureCollection(features=features, crs=geojson_crs))
+                # It should be either a Polygon or MultiPolygon
+                if not type(tile_union) in [shapely.geometry.multipolygon.MultiPolygon, shapely.geometry.polygon.Polygon]:
+                    print("Unknown shapely type %s" % (type(tile_union)))
 
-                # Finally, write to the file
-                full_path = os.path.join(full_path, args.output_filename)
-                f = open(full_path, 'w')
-                f.write(dump)
-                f.close()
+                # Write the polygons straight to the file, creating the tile's directory if needed
+                writer.submit(write_tile_geojson_features, city_directory, i, j, tile_min.zone, output_filename, [tile_union], None, geojson_crs)
 
                 # Log the status
                 num_completed += 1
@@ -179,7 +191,8 @@ def main():
                         time_remaining = int(time_remaining / 60)
                         time_string = "%d hours, %d hours remaining" % (time_elapsed, time_remaining)
                 print("Completed %d/%d tiles (%.1f percent) in %s" % (num_completed, num_tiles, percent_complete, time_string))
-        print("Stored %d %s files in %s." % (num_tiles, args.output_filename, full_path))
+        writer.finish()
+        print("Stored %d %s files in %s." % (num_tiles, output_filename, args.tile_directory))
 
     # If we have plenty of RAM and want things to run faster, we only intersect each polygon with the
     # tiles that actually overlap with it. This requires storing a map from each tile to its polygon.
@@ -191,18 +204,27 @@ def main():
             for j in range(min_j, max_j + 1):
                 tile_to_polygon_map[(i, j)] = shapely.Polygon()
 
+        # The tiles' polygons are checkpointed every few minutes, and a journal keeps
+        # track of which tiles have been written, so a crashed run can be resumed.
+        run_description = describe_run(args, ["resume", "checkpoint_minutes", "write_threads"])
+        checkpoint = TileStateCheckpoint(checkpoint_path(city_directory, output_filename + ".state"), run_description, args.checkpoint_minutes * 60, args.resume)
+        num_features_complete = checkpoint.load(tile_to_polygon_map) if args.resume else 0
+
         # Collect info for logging
         start_time = time.time()
         num_polygons = num_features_in_geojson_file(geojson_contents)
-        num_completed = 0
+        num_completed = num_features_complete
 
         # Now iterate over every polygon in the geojson, intersecting only with relevant tiles
-        for geojson_feature in geojson_contents['features']:
-            shapely_polygons = geojson_feature_to_shapely(geojson_feature)
-            for shapely_polygon_lonlat in shapely_polygons:
-                shapely_polygon_utm = poly_lonlat_to_utm(shapely_polygon_lonlat, offset=(args.offset_x, args.offset_y))
+        # Sorting the features along a curve keeps consecutive features in nearby tiles
+        features = sort_features_spatially(geojson_contents['features'], tile_min.zone, (args.offset_x, args.offset_y), args.spatial_sort)
+        shapely_polygon_lists = geojson_features_to_shapely_lists(features, tile_min.zone, (args.offset_x, args.offset_y))
+        for feature_index, shapely_polygons in enumerate(shapely_polygon_lists):
+            if feature_index < num_features_complete:
+                # This feature was already in the checkpoint
+                continue
+            for shapely_polygon_utm in shapely_polygons:
                 if shapely_polygon_utm.is_empty:
-                    # If the polygon crossed UTM zones, it could be empty
                     continue
 
                 # With the polygon in UTM, determine which tiles overlap with its bbox.
@@ -220,6 +242,7 @@ def main():
                         try:
                             clipped_poly = current_tile.polygon().intersection(shapely_polygon_utm)
                             tile_to_polygon_map[(i, j)] = tile_to_polygon_map[(i, j)].union(clipped_poly)
+                            checkpoint.mark_dirty((i, j))
                         except shapely.errors.GEOSException:
                             print("Error intersecting polygon with tile. Skipping")
                             pass
@@ -228,45 +251,32 @@ def main():
                 num_completed += 1
                 time_elapsed = int(time.time() - start_time)
                 print(get_time_estimate_string(time_elapsed, num_completed, num_polygons))
+            checkpoint.save_if_due(tile_to_polygon_map, feature_index + 1)
+        checkpoint.save(tile_to_polygon_map, num_polygons)
 
         # The tile to polygon map is complete. Write each tile's geojson file.
         print("Storing files in tiles.")
+        journal = TileJournal(checkpoint_path(city_directory, output_filename + ".journal"), run_description, args.resume)
+        def write_tile(i, j, tile_union):
+            write_tile_geojson_features(city_directory, i, j, tile_min.zone, output_filename, [tile_union], None, geojson_crs)
+            journal.mark_complete(i, j)
+        writer = BackgroundWriter(args.write_threads)
         for i in range(min_i, max_i + 1):
             for j in range(min_j, max_j + 1):
+                if journal.is_complete(i, j):
+                    continue
                 tile_union = tile_to_polygon_map[(i, j)]
-                # If the tile union is somehow a "geometry collection", make it not that
-                if type(tile_union) == shapely.geometry.collection.GeometryCollection:
-                    polygon_union = shapely.Polygon()
-                    for geom in tile_union.geoms:
-                        if type(geom) == shapely.geometry.polygon.Polygon:
-                            polygon_union = polygon_union.union(geom)
-                        else:
-                            pass
-                    # Now it should be either a Polygon or MultiPolygon
-                    tile_union = polygon_union
+                tile_union = polygons_only(tile_union)
 
-                # Convert the multipolygon from shapely to geojson
-                if type(tile_union) == shapely.geometry.multipolygon.MultiPolygon:
-                    geojson_tile_union = shapely_multipolygon_to_geojson(tile_union)
-                elif type(tile_union) == shapely.geometry.polygon.Polygon:
-                    geojson_tile_union = shapely_polygon_to_geojson(tile_union)
-                else:
+                # It should be either a Polygon or MultiPolygon
+                if not type(tile_union) in [shapely.geometry.multipolygon.MultiPolygon, shapely.geometry.polygon.Polygon]:
                     print("Unknown shapely type %s" % (type(tile_union)))
-                features = [geojson.Feature(geometry=geojson_tile_union)]
-
-                # Create the tile's directory, in case it doesn't exist yet
-                full_path = os.path.join(city_directory, "%d_%d_%d" % (i, j, tile_min.zone))
-                p = subprocess.Popen(['mkdir', full_path], shell=True)
-                p.communicate()
-
-                # Dump the geojson object into a string
-                dump = geojson.dumps(geojson.FeatureCollection(features=features, crs=geojson_crs))
 
-                # Finally, write to the file
-                full_path = os.path.join(full_path, output_filename)
-                f = open(full_path, 'w')
-                f.write(dump)
-                f.close()
+                # Write the polygons straight to the file, creating the tile's directory if needed
+                writer.submit(write_tile, i, j, tile_union)
+        writer.finish()
+        journal.finish()
+        checkpoint.finish()
         print("Stored %d %s files in %s." % (num_tiles, output_filename, args.tile_directory))
 
 if __name__ == "__main__":
@@ -7,7 +7,6 @@ import argparse
 import geojson
 import os
 import shapely
-import subprocess
 import sys
 import time
 import utm
@@ -18,6 +17,7 @@ from general_utils import *
 from geojson_utils import *
 from latlon_to_utm import *
 from polygon_utils import *
+from spatial_sort import *
 from tile_id import *
 
 def main():
@@ -27,18 +27,19 @@ def main():
     parser.add_argument("--city-name", required=True, help="Name of city (sub-directory of output directory that will be created)")
     parser.add_argument("--sw", required=True, help='SW corner formatted as "lat,lon" or "lat, lon"')
     parser.add_argument("--ne", required=True, help='NE corner formatted as "lat,lon" or "lat, lon"')
+    parser.add_argument("--utm-zone", required=False, type=int, default=0, help='Project everything into this UTM zone, so the area can cross zone boundaries')
     parser.add_argument("--offset-x", required=False, type=float, default=0., help='Offset x coord of each point')
     parser.add_argument("--offset-y", required=False, type=float, default=0., help='Offset y coord of each point')
 
+    parser.add_argument("--spatial-sort", required=False, choices=SPATIAL_SORT_CURVES, default="none", help='Sort the features along a space-filling curve through the tiles before mapping them, so consecutive features land in nearby tiles.')
+    parser.add_argument("--write-threads", required=False, type=int, default=8, help='Number of threads used to write the tile files')
     args = parser.parse_args()
 
     # Get the min/max tile IDs from the lat/lon
     lat1, lon1 = parse_latlon_string(args.sw)
     lat2, lon2 = parse_latlon_string(args.ne)
-    tile_min = TileID(lat1, lon1)
-    tile_max = TileID(lat2, lon2)
-    if tile_min.zone != tile_max.zone:
-        print("Crossing from UTM zone %d to %d. Quitting." % (tile_min.zone, tile_max.zone))
+    tile_min, tile_max = tile_area(lat1, lon1, lat2, lon2, args.utm_zone)
+    if tile_min is None:
         return
     min_i = tile_min.i
     min_j = tile_min.j
@@ -52,10 +53,7 @@ def main():
     city_directory = os.path.join(args.tile_directory, args.city_name)
 
     # Try to create the directory, in case it doesn't exist
-    p = subprocess.Popen(['mkdir', args.tile_directory], shell=True)
-    p.communicate()
-    p = subprocess.Popen(['mkdir', city_directory], shell=True)
-    p.communicate()
+    os.makedirs(city_directory, exist_ok=True)
 
     geojson.geometry.DEFAULT_PRECISION = 10
 
@@ -76,11 +74,10 @@ def main():
     num_completed = 0
 
     # Now iterate over every polygon in the geojson, intersecting only with relevant tiles
-    for geojson_feature in geojson_contents['features']:
-        shapely_points = geojson_feature_to_shapely(geojson_feature)
-        for shapely_point_lonlat in shapely_points:
-            shapely_point_utm = point_lonlat_to_utm(shapely_point_lonlat, offset=(args.offset_x, args.offset_y))
-
+    # Sorting the features along a curve keeps consecutive features in nearby tiles
+    features = sort_features_spatially(geojson_contents['features'], tile_min.zone, (args.offset_x, args.offset_y), args.spatial_sort)
+    for shapely_points in geojson_features_to_shapely_lists(features, tile_min.zone, (args.offset_x, args.offset_y)):
+        for shapely_point_utm in shapely_points:
             containing_tile = TileID(shapely_point_utm.x, shapely_point_utm.y, tile_min.zone)
             i = containing_tile.i
             j = containing_tile.j
@@ -96,25 +93,14 @@ def main():
 
     # The tile to points map is complete. Write each tile's geojson file.
     print("Storing files in tiles.")
+    writer = BackgroundWriter(args.write_threads)
     for i in range(min_i, max_i + 1):
         for j in range(min_j, max_j + 1):
-            shapely_points = tile_to_points_map[(i, j)]
-            geojson_multipoint = shapely_points_to_geojson(shapely_points)
-            features = [geojson.Feature(geometry=geojson_multipoint)]
-
-            # Create the tile's directory, in case it doesn't exist yet
-            full_path = os.path.join(city_directory, "%d_%d_%d" % (i, j, tile_min.zone))
-            p = subprocess.Popen(['mkdir', full_path], shell=True)
-            p.communicate()
-
-            # Dump the geojson object into a string
-            dump = geojson.dumps(geojson.FeatureCollection(features=features, crs=geojson_crs))
-
-            # Finally, write to the file
-            full_path = os.path.join(full_path, "trees.geojson")
-            f = open(full_path, 'w')
-            f.write(dump)
-            f.close()
+            shapely_multipoint = shapely.MultiPoint(tile_to_points_map[(i, j)])
+
+            # Write the points straight to the file, creating the tile's directory if needed
+            writer.submit(write_tile_geojson_features, city_directory, i, j, tile_min.zone, "trees.geojson", [shapely_multipoint], None, geojson_crs)
+    writer.finish()
     print("Stored %d %s files in %s." % (num_tiles, "trees.geojson", args.tile_directory))
 
 if __name__ == "__main__":
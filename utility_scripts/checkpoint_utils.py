@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+
+# Checkpoints for long runs, so a run that crashes can be resumed
+# with --resume instead of starting over.
+
+import json
+import os
+import shapely
+import shutil
+import threading
+import time
+
+from file_utils import *
+
+# Where checkpoints are kept, inside the city directory
+CHECKPOINT_DIRECTORY_NAME = ".checkpoints"
+
+def describe_run(args, ignored_keys, config=None):
+    """
+    Describe a run by its command line arguments, leaving out the ones
+    (like --resume) that don't change what it writes. If the run uses a
+    Configuration, its content hash is included too, since editing the
+    config file changes the outputs without changing the arguments.
+    """
+    description = {key : value for key, value in sorted(vars(args).items()) if not key in ignored_keys}
+    if config is not None:
+        description["config_hash"] = config.content_hash
+    return json.dumps(description)
+
+def checkpoint_path(city_directory, name):
+    directory = os.path.join(city_directory, CHECKPOINT_DIRECTORY_NAME)
+    os.makedirs(directory, exist_ok=True)
+    return os.path.join(directory, name)
+
+class TileJournal:
+    """
+    An append-only journal of the tiles a run has finished. The first line
+    describes the run (its arguments), so a journal is only resumed by the
+    same run. Each finished tile adds a line that is flushed right away,
+    which is cheap enough to do for every tile. Tiles can be marked
+    complete from several threads.
+    """
+    def __init__(self, filepath, run_description, resume):
+        self.filepath = filepath
+        self.complete_tiles = set()
+        self.lock = threading.Lock()
+        if resume and os.path.exists(filepath):
+            f = open(filepath, 'r')
+            lines = f.readlines()
+            f.close()
+            if len(lines) > 0 and lines[0].strip() == run_description:
+                for line in lines[1:]:
+                    parts = line.split()
+                    # The last line could be cut off by a crash
+                    if len(parts) == 2:
+                        self.complete_tiles.add((int(parts[0]), int(parts[1])))
+                print("Resuming with %d tiles already complete." % (len(self.complete_tiles)))
+            else:
+                print("The journal in %s is from a different run. Starting over." % (filepath))
+        if len(self.complete_tiles) > 0:
+            self.f = open(filepath, 'a')
+        else:
+            self.f = open(filepath, 'w')
+            self.f.write(run_description + "\n")
+            self.f.flush()
+
+    def is_complete(self, i, j):
+        return (i, j) in self.complete_tiles
+
+    def mark_complete(self, i, j):
+        with self.lock:
+            self.complete_tiles.add((i, j))
+            self.f.write("%d %d\n" % (i, j))
+            self.f.flush()
+
+    def finish(self):
+        """
+        Call once the whole run is done. The journal is removed,
+        so the next run starts from scratch.
+        """
+        self.f.close()
+        os.remove(self.filepath)
+
+class TileStateCheckpoint:
+    """
+    Periodically spills a map from tile to shapely geometry to disk,
+    along with how many input features had been processed. Only the
+    tiles that changed since the last checkpoint are written (as WKB,
+    one file per tile), so checkpoints stay cheap.
+
+    The progress file is written last. If a crash happens in the middle of
+    a checkpoint, some tiles can be newer than the progress says, and those
+    features get unioned into them again on resume, which doesn't change them.
+    """
+    def __init__(self, directory, run_description, interval_seconds, resume):
+        self.directory = directory
+        self.run_description = run_description
+        self.interval_seconds = interval_seconds
+        self.dirty_tiles = set()
+        self.last_save_time = time.time()
+        if resume:
+            os.makedirs(directory, exist_ok=True)
+        else:
+            self.clear()
+
+    def clear(self):
+        # Don't let an old checkpoint get mixed into this one
+        shutil.rmtree(self.directory, ignore_errors=True)
+        os.makedirs(self.directory, exist_ok=True)
+
+    def progress_path(self):
+        return os.path.join(self.directory, "progress.json")
+
+    def tile_path(self, tile_key):
+        return os.path.join(self.directory, "%d_%d.wkb" % tile_key)
+
+    def load(self, tile_to_geometry_map):
+        """
+        Load the last checkpoint into tile_to_geometry_map. Returns the
+        number of input features it had processed, or 0 if there is no
+        checkpoint from this run. Tiles that aren't part of a checkpoint
+        from this run are deleted.
+        """
+        if not os.path.exists(self.progress_path()):
+            # Tiles without a progress file are from a checkpoint that
+            # was interrupted before it finished, maybe from another run
+            self.clear()
+            return 0
+        f = open(self.progress_path(), 'r')
+        progress = json.load(f)
+        f.close()
+        if progress["run"] != self.run_description:
+            print("The checkpoint in %s is from a different run. Starting over." % (self.directory))
+            self.clear()
+            return 0
+        for tile_key in tile_to_geometry_map:
+            if os.path.exists(self.tile_path(tile_key)):
+                f = open(self.tile_path(tile_key), 'rb')
+                tile_to_geometry_map[tile_key] = shapely.from_wkb(f.read())
+                f.close()
+        print("Resuming after %d features." % (progress["num_features"]))
+        return progress["num_features"]
+
+    def mark_dirty(self, tile_key):
+        self.dirty_tiles.add(tile_key)
+
+    def save(self, tile_to_geometry_map, num_features):
+        for tile_key in self.dirty_tiles:
+            f = AtomicFile(self.tile_path(tile_key), 'wb')
+            f.write(shapely.to_wkb(tile_to_geometry_map[tile_key]))
+            f.commit()
+        self.dirty_tiles = set()
+        f = AtomicFile(self.progress_path())
+        f.write(json.dumps({"run" : self.run_description, "num_features" : num_features}))
+        f.commit()
+        self.last_save_time = time.time()
+
+    def save_if_due(self, tile_to_geometry_map, num_features):
+        if time.time() - self.last_save_time >= self.interval_seconds:
+            self.save(tile_to_geometry_map, num_features)
+
+    def finish(self):
+        """
+        Call once the whole run is done to remove the checkpoint.
+        """
+        shutil.rmtree(self.directory, ignore_errors=True)
@@ -3,6 +3,10 @@
 # Load all of the configuration variables
 # into memory so they can be accessed.
 
+import hashlib
+import json
+import types
+
 # Filenames that are stored in tiles
 ROAD_FILENAME = "road_polygons.geojson"
 SIDEWALK_FILENAME = "sidewalk_polygons.geojson"
@@ -22,10 +26,19 @@ RAILWAY_FILENAME = "railway_lines.geojson"
 SVG_FILENAME = "tile_texture.svg"
 JPG_FILENAME = "tile_texture.jpg"
 TILE_MTL_FILENAME = "tile.mtl"
+# Lives in the city directory, next to the tile directories
+CITY_MTL_FILENAME = "city_materials.mtl"
 TILE_OBJ_FILENAME = "tile.obj"
+TILE_LOD_OBJ_FILENAME = "tile_lod%d.obj"
 TILE_TEXTURE_FILENAME = "tile_texture.jpg"
 BUILDINGS_FILENAME = "buildings.geojson"
 CUSTOM_BUILDINGS_FILENAME = "custom_buildings.txt"
+DEM_TILE_FILENAME = "dem_level%d.npy"
+# Lives in the city directory, next to the tile directories
+DEM_INDEX_FILENAME = "dem_tiles.json"
+
+# ImageMagick is used for converting and combining textures
+PATH_TO_IMAGE_MAGICK = "C:/Program Files/ImageMagick-7.1.1-Q16-HDRI/magick.exe"
 
 # This maps the name of the material we write in the MTL files to
 # the material's name in the config file
@@ -113,24 +126,115 @@ KEY_TO_TYPE = {\
         # Data sizes
         "JPG_SIZE" : int,\
         "TERRAIN_MESH_RES" : int}
-        
+
+# The material probabilities, as (probability key, material name) pairs.
+# The materials are chosen by comparing a uniform random number to the
+# cumulative probabilities, in this order.
+SKYSCRAPER_MATERIAL_PROBS = (("SKYSCRAPER_GLASS_PROB", "glass"),\
+        ("SKYSCRAPER_CONCRETE_PROB", "concrete"),\
+        ("SKYSCRAPER_METAL_PROB", "metal"))
+APARTMENT_MATERIAL_PROBS = (("APARTMENTS_BRICK_PROB", "brick"),\
+        ("APARTMENTS_CONCRETE_PROB", "concrete"),\
+        ("APARTMENTS_METAL_PROB", "metal"))
+HOUSE_MATERIAL_PROBS = (("HOUSE_VINYL_PROB", "vinyl"),\
+        ("HOUSE_BRICK_PROB", "brick"))
+VINYL_COLOR_PROBS = (("VINYL_TAN_PROB", "tan"),\
+        ("VINYL_WHITE_PROB", "white"),\
+        ("VINYL_GRAY_PROB", "gray"),\
+        ("VINYL_BROWN_PROB", "brown"),\
+        ("VINYL_YELLOW_PROB", "yellow"),\
+        ("VINYL_BLUE_PROB", "blue"),\
+        ("VINYL_GREEN_PROB", "green"))
+ROOF_MATERIAL_PROBS = (("ROOF_BLACK_PROB", "roof_black"),\
+        ("ROOF_GRAY_PROB", "roof_gray"),\
+        ("ROOF_WHITE_PROB", "roof_white"))
+
+def parse_config_value(key, value):
+    expected_type = KEY_TO_TYPE[key]
+    if expected_type == str:
+        return value
+    elif expected_type == float:
+        return float(value)
+    elif expected_type == int:
+        return int(value)
+    elif expected_type == bool:
+        return True if value == "True" else False
+    print("What is the expected type?")
+    return value
+
+def material_cutoffs(values, probs, description):
+    """
+    Turn a table of (probability key, material name) pairs into
+    (material name, cumulative probability) pairs.
+    """
+    cutoffs = []
+    cutoff = 0.
+    for key, name in probs:
+        cutoff += values[key]
+        cutoffs.append((name, cutoff))
+    if abs(cutoff - 1.) > 0.01:
+        print("Error: %s probabilities don't add to 1. Check the config file." % (description))
+    return tuple(cutoffs)
+
 class Configuration:
-    def __init__(self, filepath):
-        self.at = {}
-        f = open(filepath, 'r')
-        for line in f:
-            key, value = line.split()
-            if key in KEY_TO_TYPE:
-                expected_type = KEY_TO_TYPE[key]
-                if expected_type == str:
-                    self.at[key] = value
-                elif expected_type == float:
-                    self.at[key] = float(value)
-                elif expected_type == int:
-                    self.at[key] = int(value)
-                elif expected_type == bool:
-                    self.at[key] = True if value == "True" else False
+    """
+    The variables of a config file. Every variable can be read as a
+    lowercase attribute (config.autumn) or through config.at["AUTUMN"].
+    Values that are derived from the variables, like the cumulative
+    material probabilities and the MTL color tuples, are computed once
+    here instead of by every user.
+
+    A configuration can't be changed after it is loaded. Pickling it only
+    sends the parsed values, so it is cheap to pass to worker processes.
+    content_hash identifies the values, so it can be used to tell whether
+    outputs were made with the same configuration.
+    """
+    def __init__(self, filepath=None, values=None):
+        if values is None:
+            values = {}
+            f = open(filepath, 'r')
+            for line in f:
+                if line.strip() == "":
+                    continue
+                key, value = line.split()
+                if key in KEY_TO_TYPE:
+                    values[key] = parse_config_value(key, value)
                 else:
-                    print("What is the expected type?")
-            else:
-                print("Unknown key %s" % (key))
+                    print("Unknown key %s" % (key))
+            f.close()
+        for key in KEY_TO_TYPE:
+            if not key in values:
+                print("Missing key %s" % (key))
+
+        set_attribute = super().__setattr__
+        set_attribute("at", types.MappingProxyType(dict(values)))
+        for key in values:
+            set_attribute(key.lower(), values[key])
+
+        # Derived values. Each one is only computed when the variables it
+        # needs are in the file, so a missing key fails where it's used
+        # like any other missing variable.
+        for name, probs, description in (("skyscraper_material_probs", SKYSCRAPER_MATERIAL_PROBS, "skyscraper material"),\
+                ("apartment_material_probs", APARTMENT_MATERIAL_PROBS, "apartment material"),\
+                ("house_material_probs", HOUSE_MATERIAL_PROBS, "house material"),\
+                ("vinyl_color_probs", VINYL_COLOR_PROBS, "vinyl color"),\
+                ("roof_material_probs", ROOF_MATERIAL_PROBS, "roof material")):
+            if all(key in values for key, material in probs):
+                set_attribute(name, material_cutoffs(values, probs, description))
+        set_attribute("material_colors", types.MappingProxyType({building_mat_name : tuple(float(c) for c in values[BUILDING_MATERIAL_NAMES[building_mat_name]].split(','))\
+                for building_mat_name in BUILDING_MATERIAL_NAMES if BUILDING_MATERIAL_NAMES[building_mat_name] in values}))
+        # None when the buildings (or roofs) keep their own colors
+        for name, flag_key, color_key in (("building_color_override", "SINGLE_COLOR_BUILDINGS", "BUILDING_MESH_COLOR"),\
+                ("roof_color_override", "SINGLE_COLOR_ROOFS", "ROOF_MESH_COLOR")):
+            if flag_key in values and (not values[flag_key] or color_key in values):
+                set_attribute(name, values[color_key] if values[flag_key] else None)
+        set_attribute("content_hash", hashlib.sha256(json.dumps(sorted(values.items())).encode()).hexdigest())
+
+    def __setattr__(self, name, value):
+        raise AttributeError("The configuration can't be changed")
+
+    def __delattr__(self, name):
+        raise AttributeError("The configuration can't be changed")
+
+    def __reduce__(self):
+        return (Configuration, (None, dict(self.at)))
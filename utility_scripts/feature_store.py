@@ -0,0 +1,241 @@
+#!/usr/bin/env python3
+
+# A compact columnar store for polygons and their properties. It is
+# used instead of lists of PolygonWithProperties when there are lots of
+# features, like when mapping a city's buildings into tiles.
+
+import array
+import json
+import numpy as np
+import shapely
+
+def concatenated_ranges(starts, ends):
+    """
+    The indices of the ranges [starts[k], ends[k]), one after another.
+    """
+    starts = np.asarray(starts, dtype=np.int64)
+    lengths = np.asarray(ends, dtype=np.int64) - starts
+    range_starts = np.concatenate(([0], np.cumsum(lengths)[:-1])).astype(np.int64)
+    return np.arange(lengths.sum(), dtype=np.int64) + np.repeat(starts - range_starts, lengths)
+
+def codes_to_array(codes):
+    # A numpy view of an array('i') of codes, without copying it
+    if len(codes) == 0:
+        return np.zeros(0, dtype=np.int32)
+    return np.frombuffer(codes, dtype=np.int32)
+
+class CategoryColumn:
+    """
+    One property of every feature in a FeatureStore. Each distinct value
+    is stored once, and the column holds a small integer code per feature.
+    Code -1 means the feature doesn't have the property.
+    """
+    def __init__(self):
+        self.values = []
+        self.value_to_code = {}
+        self.codes = array.array('i')
+
+    def intern(self, value):
+        """
+        The code of a value, adding it if it's new. 1, 1.0, and True are
+        kept apart, since they are written differently.
+        """
+        try:
+            key = (type(value), value)
+            hash(key)
+        except TypeError:
+            key = (type(value), json.dumps(value, sort_keys=True))
+        code = self.value_to_code.get(key)
+        if code is None:
+            code = len(self.values)
+            self.values.append(value)
+            self.value_to_code[key] = code
+        return code
+
+    def append_missing(self, count):
+        self.codes.frombytes(np.full(count, -1, dtype=np.int32).tobytes())
+
+class FeatureView:
+    """
+    A lightweight view of one feature of a FeatureStore, with the same
+    polygon and properties attributes as PolygonWithProperties. Both are
+    built from the store when they are read.
+    """
+    __slots__ = ("store", "index")
+
+    def __init__(self, store, index):
+        self.store = store
+        self.index = index
+
+    @property
+    def polygon(self):
+        return self.store.polygon(self.index)
+
+    @property
+    def properties(self):
+        return self.store.properties(self.index)
+
+class FeatureStore:
+    """
+    Polygons with properties, stored as columns. The coordinates of every
+    ring are in one buffer, with offsets saying where each ring and each
+    polygon starts, like shapely.to_ragged_array. Every property is a
+    CategoryColumn, so repeated values (like building=house) are only
+    stored once, and each feature remembers which properties it has, in
+    order, so its properties come back exactly as they went in.
+
+    If property_keys is given, only those properties are kept. Features are
+    added in batches with extend or extend_store, and read back all at
+    once with polygons and properties_list, or one at a time through
+    FeatureViews. A store pickles into a handful of arrays, so it is cheap
+    to send between processes.
+    """
+    def __init__(self, property_keys=None):
+        self.property_keys = property_keys
+        self.coord_chunks = []
+        self.ring_length_chunks = []
+        self.ring_count_chunks = []
+        self.consolidated = None
+        self.num_features = 0
+        # Which properties each feature has, as an interned tuple of keys
+        self.schemas = CategoryColumn()
+        self.columns = {}
+
+    def __len__(self):
+        return self.num_features
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += self.num_features
+        if not 0 <= index < self.num_features:
+            raise IndexError("Feature index %d is out of range." % (index))
+        return FeatureView(self, index)
+
+    def __iter__(self):
+        for index in range(self.num_features):
+            yield FeatureView(self, index)
+
+    def __getstate__(self):
+        self.consolidate()
+        return self.__dict__
+
+    def consolidate(self):
+        """
+        Join the batches of geometry that were added into single arrays.
+        Returns (coords, ring_offsets, polygon_offsets).
+        """
+        if self.consolidated is None or len(self.coord_chunks) > 1:
+            coords = np.concatenate(self.coord_chunks) if len(self.coord_chunks) > 0 else np.zeros((0, 2))
+            ring_lengths = np.concatenate(self.ring_length_chunks) if len(self.ring_length_chunks) > 0 else np.zeros(0, dtype=np.int64)
+            ring_counts = np.concatenate(self.ring_count_chunks) if len(self.ring_count_chunks) > 0 else np.zeros(0, dtype=np.int64)
+            self.coord_chunks = [coords] if len(coords) > 0 else []
+            self.ring_length_chunks = [ring_lengths] if len(ring_lengths) > 0 else []
+            self.ring_count_chunks = [ring_counts] if len(ring_counts) > 0 else []
+            ring_offsets = np.concatenate(([0], np.cumsum(ring_lengths))).astype(np.int64)
+            polygon_offsets = np.concatenate(([0], np.cumsum(ring_counts))).astype(np.int64)
+            self.consolidated = (coords, ring_offsets, polygon_offsets)
+        return self.consolidated
+
+    def get_column(self, key):
+        if not key in self.columns:
+            column = CategoryColumn()
+            column.append_missing(self.num_features)
+            self.columns[key] = column
+        return self.columns[key]
+
+    def extend(self, polygons, properties_list):
+        """
+        Add shapely polygons and their property dicts.
+        """
+        if len(polygons) == 0:
+            return
+        _, coords, (ring_offsets, polygon_offsets) = shapely.to_ragged_array(np.asarray(polygons, dtype=object))
+        self.coord_chunks.append(coords)
+        self.ring_length_chunks.append(np.diff(ring_offsets).astype(np.int64))
+        self.ring_count_chunks.append(np.diff(polygon_offsets).astype(np.int64))
+        self.consolidated = None
+
+        # Properties, one column at a time
+        num_new = len(polygons)
+        new_codes = {}
+        schema_codes = array.array('i')
+        for k, properties in enumerate(properties_list):
+            keys = tuple(key for key in (properties or {}) if self.property_keys is None or key in self.property_keys)
+            schema_codes.append(self.schemas.intern(keys))
+            for key in keys:
+                if not key in new_codes:
+                    new_codes[key] = np.full(num_new, -1, dtype=np.int32)
+                new_codes[key][k] = self.get_column(key).intern(properties[key])
+        self.schemas.codes.extend(schema_codes)
+        for key, column in self.columns.items():
+            if key in new_codes:
+                column.codes.frombytes(new_codes[key].tobytes())
+            else:
+                column.append_missing(num_new)
+        self.num_features += num_new
+
+    def extend_store(self, other, indices=None):
+        """
+        Add the features of another store (or the ones at indices), in
+        order, without building shapely objects or property dicts.
+        """
+        if indices is None:
+            indices = np.arange(len(other))
+        indices = np.asarray(indices, dtype=np.int64)
+        if len(indices) == 0:
+            return
+        coords, ring_offsets, polygon_offsets = other.consolidate()
+        ring_indices = concatenated_ranges(polygon_offsets[indices], polygon_offsets[indices + 1])
+        coord_indices = concatenated_ranges(ring_offsets[ring_indices], ring_offsets[ring_indices + 1])
+        self.coord_chunks.append(coords[coord_indices])
+        self.ring_length_chunks.append(np.diff(ring_offsets)[ring_indices])
+        self.ring_count_chunks.append(np.diff(polygon_offsets)[indices])
+        self.consolidated = None
+
+        # Translate the other store's codes into this one's
+        def translate(column, other_column):
+            code_map = np.array([column.intern(value) for value in other_column.values] + [-1], dtype=np.int32)
+            # Code -1 indexes the -1 at the end of the map
+            column.codes.frombytes(code_map[codes_to_array(other_column.codes)[indices]].tobytes())
+        translate(self.schemas, other.schemas)
+        for key in other.columns:
+            if not key in self.columns:
+                self.get_column(key)
+        for key, column in self.columns.items():
+            if key in other.columns:
+                translate(column, other.columns[key])
+            else:
+                column.append_missing(len(indices))
+        self.num_features += len(indices)
+
+    def polygons(self):
+        """
+        Every feature's polygon, as an array of shapely polygons.
+        """
+        if self.num_features == 0:
+            return np.array([], dtype=object)
+        coords, ring_offsets, polygon_offsets = self.consolidate()
+        return shapely.from_ragged_array(shapely.GeometryType.POLYGON, coords, (ring_offsets, polygon_offsets))
+
+    def polygon(self, index):
+        coords, ring_offsets, polygon_offsets = self.consolidate()
+        rings = [coords[ring_offsets[ring]:ring_offsets[ring + 1]] for ring in range(polygon_offsets[index], polygon_offsets[index + 1])]
+        if len(rings) == 0:
+            return shapely.Polygon()
+        return shapely.Polygon(rings[0], rings[1:])
+
+    def properties(self, index):
+        keys = self.schemas.values[self.schemas.codes[index]]
+        return {key : self.columns[key].values[self.columns[key].codes[index]] for key in keys}
+
+    def properties_list(self):
+        """
+        Every feature's property dict.
+        """
+        schema_codes = self.schemas.codes.tolist()
+        columns = {key : (column.values, column.codes.tolist()) for key, column in self.columns.items()}
+        properties_list = []
+        for index, schema_code in enumerate(schema_codes):
+            keys = self.schemas.values[schema_code]
+            properties_list.append({key : columns[key][0][columns[key][1][index]] for key in keys})
+        return properties_list
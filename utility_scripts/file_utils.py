@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+
+# Portable file operations.
+
+import collections
+import concurrent.futures
+import hashlib
+import itertools
+import os
+import shutil
+import threading
+
+def link_or_copy_file(source_path, destination_path):
+    """
+    Make destination_path have the contents of source_path. A hard link is
+    used when possible so nothing gets copied. Otherwise the file is copied,
+    which uses the OS's in-kernel copy where it has one.
+    """
+    if os.path.exists(destination_path):
+        os.remove(destination_path)
+    try:
+        os.link(source_path, destination_path)
+    except OSError:
+        shutil.copyfile(source_path, destination_path)
+
+def file_content_key(filepath):
+    """
+    A short key made from a hash of a file's contents, for naming caches
+    of things computed from the file. Copies of a file get the same key.
+    """
+    content_hash = hashlib.sha256()
+    f = open(filepath, 'rb')
+    for block in iter(lambda: f.read(1 << 20), b""):
+        content_hash.update(block)
+    f.close()
+    return content_hash.hexdigest()[:16]
+
+class AtomicFile:
+    """
+    A file opened for writing that only shows up at filepath once commit
+    is called. Until then everything goes to a temporary file next to it,
+    so a crashed run never leaves a half-written file at filepath.
+    """
+    def __init__(self, filepath, mode='w'):
+        self.filepath = filepath
+        self.temp_filepath = "%s.%d.%d.tmp" % (filepath, os.getpid(), threading.get_ident())
+        self.f = open(self.temp_filepath, mode)
+
+    def write(self, contents):
+        self.f.write(contents)
+
+    def commit(self):
+        self.f.close()
+        os.replace(self.temp_filepath, self.filepath)
+
+    def commit_if_absent(self):
+        """
+        Like commit, but if a file is already at filepath, it is kept and
+        this one is thrown away. When several writers race to write the
+        same file, the first one wins. Returns whether this file was kept.
+        """
+        self.f.close()
+        try:
+            os.link(self.temp_filepath, self.filepath)
+            kept = True
+        except FileExistsError:
+            kept = False
+        os.remove(self.temp_filepath)
+        return kept
+
+    def abort(self):
+        self.f.close()
+        if os.path.exists(self.temp_filepath):
+            os.remove(self.temp_filepath)
+
+class BackgroundWriter:
+    """
+    Runs file writing functions on a pool of threads, so the next tile can
+    be computed while the previous ones are being written. finish waits for
+    every write and raises the first error any of them had.
+    """
+    def __init__(self, num_threads):
+        self.executor = concurrent.futures.ThreadPoolExecutor(max(num_threads, 1))
+        self.futures = []
+
+    def submit(self, function, *args):
+        self.futures.append(self.executor.submit(function, *args))
+
+    def finish(self):
+        results = [future.result() for future in self.futures]
+        self.executor.shutdown()
+        self.futures = []
+        return results
+
+class TilePrefetcher:
+    """
+    Reads the inputs of tiles on a pool of threads before they are needed,
+    so the next tiles are being read while the current one is processed.
+    Iterating over it gives (i, j, inputs) for each (i, j) of tile_keys,
+    in order, where inputs is what load_function(i, j) returned. At most
+    depth tiles are read ahead, which bounds the memory it uses. With a
+    depth of 0, each tile is read when it is reached. An error raised by
+    load_function comes out when its tile is reached.
+    """
+    def __init__(self, tile_keys, load_function, depth):
+        self.tile_keys = tile_keys
+        self.load_function = load_function
+        self.depth = depth
+
+    def __iter__(self):
+        if self.depth <= 0:
+            for i, j in self.tile_keys:
+                yield i, j, self.load_function(i, j)
+            return
+        executor = concurrent.futures.ThreadPoolExecutor(self.depth)
+        remaining_keys = iter(self.tile_keys)
+        pending = collections.deque()
+        try:
+            for i, j in itertools.islice(remaining_keys, self.depth):
+                pending.append((i, j, executor.submit(self.load_function, i, j)))
+            while len(pending) > 0:
+                i, j, future = pending.popleft()
+                for next_i, next_j in itertools.islice(remaining_keys, 1):
+                    pending.append((next_i, next_j, executor.submit(self.load_function, next_i, next_j)))
+                yield i, j, future.result()
+        finally:
+            for _, _, future in pending:
+                future.cancel()
+            executor.shutdown()
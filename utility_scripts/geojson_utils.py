@@ -5,12 +5,15 @@
 # these functions only use x and y.
 
 import geojson
+import json
+import numpy as np
 import os
 import shapely
 import sys
 import utm
 
 sys.path.insert(1, 'C:/Users/mse93/Documents/simple-cities-digital-twins/utility_scripts')
+from file_utils import *
 from polygon_utils import *
 
 def geojson_polygon_to_shapely(geojson_polygon):
@@ -80,6 +83,118 @@ def geojson_feature_to_shapely(geojson_feature):
         print("Unknown geojson geometry type %s." % (geojson_feature.geometry["type"]))
         return []
 
+# The kind of shapely geometry each geojson geometry type turns into
+GEOJSON_TYPE_TO_PART_KIND = {"Polygon" : "polygon",\
+        "MultiPolygon" : "polygon",\
+        "Point" : "point",\
+        "MultiPoint" : "point",\
+        "LineString" : "line",\
+        "MultiLineString" : "line"}
+
+def geojson_coordinates_to_array(point_lists):
+    """
+    Stack lists of geojson points into one (n, 2) array, dropping z.
+    Returns the array and the number of points in each list.
+    """
+    flat_points = []
+    counts = np.empty(len(point_lists), dtype=np.int64)
+    for k, point_list in enumerate(point_lists):
+        flat_points.extend(point_list)
+        counts[k] = len(point_list)
+    if len(flat_points) == 0:
+        return np.zeros((0, 2)), counts
+    try:
+        coords = np.array(flat_points, dtype=float)
+    except ValueError:
+        # Some points have a z coordinate and some don't
+        coords = np.array([point[:2] for point in flat_points], dtype=float)
+    return coords[:, :2], counts
+
+def geojson_features_to_shapely_array(geojson_features, zone=None, offset=(0,0)):
+    """
+    Vectorized version of geojson_feature_to_shapely for a whole list of
+    features. All of the coordinates are collected into arrays and handed
+    to shapely's vectorized constructors at once. Returns (geometries,
+    feature_indices), where geometries is a numpy array of the polygons,
+    points, and lines in the same order geojson_feature_to_shapely would
+    give them, and feature_indices says which feature each came from.
+
+    If zone is given, the coordinates are lon/lat and are all projected
+    into that UTM zone (plus offset) before the geometries are built.
+    """
+    part_kinds = []
+    feature_indices = []
+    polygon_rings = []
+    polygon_ring_counts = []
+    points = []
+    lines = []
+    for feature_index, geojson_feature in enumerate(geojson_features):
+        geometry_type = geojson_feature.geometry["type"]
+        if not geometry_type in GEOJSON_TYPE_TO_PART_KIND:
+            print("Unknown geojson geometry type %s." % (geometry_type))
+            continue
+        coordinates = geojson_feature.geometry["coordinates"]
+        parts = coordinates if geometry_type.startswith("Multi") else [coordinates]
+        kind = GEOJSON_TYPE_TO_PART_KIND[geometry_type]
+        for part in parts:
+            part_kinds.append(kind)
+            feature_indices.append(feature_index)
+            if kind == "polygon":
+                polygon_rings.extend(part)
+                polygon_ring_counts.append(len(part))
+            elif kind == "point":
+                points.append(part)
+            else:
+                lines.append(part)
+    part_kinds = np.array(part_kinds)
+    geometries = np.empty(len(part_kinds), dtype=object)
+
+    # Polygons. The first ring of each polygon is its exterior. Rings without
+    # points are dropped, and a polygon without an exterior is empty.
+    ring_coords, ring_sizes = geojson_coordinates_to_array(polygon_rings)
+    if zone is not None:
+        ring_coords = lonlat_array_to_utm(ring_coords, zone, offset)
+    polygon_ring_counts = np.array(polygon_ring_counts, dtype=np.int64)
+    polygons = np.empty(len(polygon_ring_counts), dtype=object)
+    polygons[:] = [shapely.Polygon()] * len(polygons)
+    if len(polygon_rings) > 0:
+        ring_polygons = np.repeat(np.arange(len(polygon_ring_counts)), polygon_ring_counts)
+        first_rings = np.cumsum(polygon_ring_counts) - polygon_ring_counts
+        has_exterior = polygon_ring_counts > 0
+        has_exterior[has_exterior] = ring_sizes[first_rings[has_exterior]] > 0
+        keep_rings = (ring_sizes > 0) & has_exterior[ring_polygons]
+        keep_coords = np.repeat(keep_rings, ring_sizes)
+        rings = shapely.linearrings(ring_coords[keep_coords], indices=np.repeat(np.arange(keep_rings.sum()), ring_sizes[keep_rings]))
+        polygon_positions = np.cumsum(has_exterior) - 1
+        polygons[has_exterior] = shapely.polygons(rings, indices=polygon_positions[ring_polygons[keep_rings]])
+    geometries[part_kinds == "polygon"] = polygons
+
+    # Points
+    point_coords, _ = geojson_coordinates_to_array([[point] for point in points])
+    if zone is not None:
+        point_coords = lonlat_array_to_utm(point_coords, zone, offset)
+    geometries[part_kinds == "point"] = shapely.points(point_coords)
+
+    # Lines
+    line_coords, line_sizes = geojson_coordinates_to_array(lines)
+    if zone is not None:
+        line_coords = lonlat_array_to_utm(line_coords, zone, offset)
+    if len(lines) > 0:
+        geometries[part_kinds == "line"] = shapely.linestrings(line_coords, indices=np.repeat(np.arange(len(line_sizes)), line_sizes))
+
+    return geometries, np.array(feature_indices, dtype=np.int64)
+
+def geojson_features_to_shapely_lists(geojson_features, zone=None, offset=(0,0)):
+    """
+    Convert a whole list of features at once. Returns one list of shapely
+    geometries per feature, the same as calling geojson_feature_to_shapely
+    on each feature. zone and offset are the same as for
+    geojson_features_to_shapely_array.
+    """
+    geometries, feature_indices = geojson_features_to_shapely_array(geojson_features, zone, offset)
+    bounds = np.searchsorted(feature_indices, np.arange(len(geojson_features) + 1))
+    return [list(geometries[bounds[k]:bounds[k + 1]]) for k in range(len(geojson_features))]
+
 def num_features_in_geojson_file(geojson_contents):
     return len(geojson_contents['features'])
 
@@ -90,8 +205,7 @@ def read_geojson_file_to_shapely_list(directory_path, filename):
         geojson_contents = geojson.loads(f.read())
         f.close()
 
-        for geojson_feature in geojson_contents['features']:
-           shapely_polygons += geojson_feature_to_shapely(geojson_feature)
+        shapely_polygons = list(geojson_features_to_shapely_array(geojson_contents['features'])[0])
     except FileNotFoundError:
         pass
 
@@ -115,6 +229,23 @@ def geojson_feature_to_pwps(geojson_feature):
     else:
         return PolygonWithProperties(shapely.Polygon(), {})
 
+def geojson_features_to_pwps(geojson_features, zone=None, offset=(0,0)):
+    """
+    Vectorized version of geojson_feature_to_pwps for a whole list of
+    features. Returns one list of pwps per feature. zone and offset are
+    the same as for geojson_features_to_shapely_array.
+    """
+    is_polygon = [geojson_feature.geometry["type"] in ["Polygon", "MultiPolygon"] for geojson_feature in geojson_features]
+    polygon_features = [geojson_feature for geojson_feature, polygon in zip(geojson_features, is_polygon) if polygon]
+    polygon_lists = iter(geojson_features_to_shapely_lists(polygon_features, zone, offset))
+    pwps_list = []
+    for geojson_feature, polygon in zip(geojson_features, is_polygon):
+        if polygon:
+            pwps_list.append([PolygonWithProperties(p, geojson_feature.properties) for p in next(polygon_lists)])
+        else:
+            pwps_list.append([PolygonWithProperties(shapely.Polygon(), {})])
+    return pwps_list
+
 def shapely_point_to_geojson(shapely_point):
     return geojson.Point([shapely_point.x, shapely_point.y])
 
@@ -135,3 +266,78 @@ def shapely_multipolygon_to_geojson(shapely_multipoly):
 
 def polygon_with_properties_to_geojson(pwp):
     return geojson.Feature(geometry=shapely_polygon_to_geojson(pwp.polygon), properties=pwp.properties)
+
+def format_geojson_positions(coords, precision):
+    """
+    Format an (n, 2) array of coordinates as a geojson list of positions,
+    rounded to precision decimals like the geojson package does.
+    """
+    if len(coords) == 0:
+        return "[]"
+    # Python's round is exact, unlike np.round, so this matches the geojson package
+    rounded = [round(c, precision) for c in coords[:, :2].ravel().tolist()]
+    return "[" + (", ".join(["[%r, %r]"] * len(coords)) % tuple(rounded)) + "]"
+
+def shapely_to_geojson_string(shapely_geometry, precision=10):
+    """
+    Format a shapely geometry as a geojson geometry string, reading the
+    coordinates straight from shapely without making geojson objects.
+    """
+    geometry_type = shapely_geometry.geom_type
+    if geometry_type == "GeometryCollection":
+        geometries = ", ".join([shapely_to_geojson_string(geometry, precision) for geometry in shapely_geometry.geoms])
+        return '{"type": "GeometryCollection", "geometries": [%s]}' % (geometries)
+    if geometry_type == "Point":
+        coordinates = format_geojson_positions(shapely.get_coordinates(shapely_geometry), precision)[1:-1]
+    elif geometry_type == "MultiPoint":
+        coordinates = format_geojson_positions(shapely.get_coordinates(shapely_geometry), precision)
+    elif geometry_type == "LineString":
+        coordinates = format_geojson_positions(shapely.get_coordinates(shapely_geometry), precision)
+    elif geometry_type == "MultiLineString":
+        coordinates = "[" + ", ".join([format_geojson_positions(shapely.get_coordinates(line), precision) for line in shapely_geometry.geoms]) + "]"
+    elif geometry_type == "Polygon":
+        coordinates = format_geojson_polygon(shapely_geometry, precision)
+    elif geometry_type == "MultiPolygon":
+        coordinates = "[" + ", ".join([format_geojson_polygon(polygon, precision) for polygon in shapely_geometry.geoms]) + "]"
+    else:
+        raise ValueError("Can't write shapely type %s to geojson." % (geometry_type))
+    return '{"type": "%s", "coordinates": %s}' % (geometry_type, coordinates)
+
+def format_geojson_polygon(shapely_polygon, precision):
+    rings = [shapely_polygon.exterior] + list(shapely_polygon.interiors)
+    return "[" + ", ".join([format_geojson_positions(shapely.get_coordinates(ring), precision) for ring in rings]) + "]"
+
+def write_geojson_features(filepath, shapely_geometries, properties_list, crs, precision=10):
+    """
+    Write shapely geometries (and their properties, or None for empty
+    properties) into a geojson FeatureCollection file. This streams each
+    feature straight to the file instead of building geojson objects, but
+    writes the same crs and feature layout as geojson.dumps would.
+    """
+    if properties_list is None:
+        properties_list = [None] * len(shapely_geometries)
+    # Write to a temporary file first so a crash never leaves half a file
+    f = AtomicFile(filepath)
+    try:
+        f.write('{"type": "FeatureCollection", "crs": %s, "features": [' % (json.dumps(crs)))
+        for k, (shapely_geometry, properties) in enumerate(zip(shapely_geometries, properties_list)):
+            if k > 0:
+                f.write(", ")
+            f.write('{"type": "Feature", "geometry": %s, "properties": %s}' %\
+                    (shapely_to_geojson_string(shapely_geometry, precision), json.dumps(properties if properties is not None else {})))
+        f.write("]}")
+    except BaseException:
+        f.abort()
+        raise
+    f.commit()
+
+def write_tile_geojson_features(city_directory, i, j, zone, filename, shapely_geometries, properties_list, crs):
+    """
+    Write a tile's geojson file with write_geojson_features, creating the
+    tile's directory if it doesn't exist yet. Returns the file's path.
+    """
+    full_path = os.path.join(city_directory, "%d_%d_%d" % (i, j, zone))
+    os.makedirs(full_path, exist_ok=True)
+    full_path = os.path.join(full_path, filename)
+    write_geojson_features(full_path, shapely_geometries, properties_list, crs)
+    return full_path
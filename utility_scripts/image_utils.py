@@ -0,0 +1,25 @@
+#!/usr/bin/env python3
+
+# Utility functions for combining tile textures with ImageMagick.
+
+import subprocess
+
+from configuration import *
+
+def create_image_mosaic(image_path_rows, tile_pixels, output_path, fill_color="gray"):
+    """
+    Resize every image to tile_pixels x tile_pixels and lay them out in a
+    grid. image_path_rows is a list of rows from top (north) to bottom
+    (south). An image path of None leaves that cell filled with fill_color.
+    """
+    command = [PATH_TO_IMAGE_MAGICK, "convert"]
+    for row in image_path_rows:
+        command.append("(")
+        for image_path in row:
+            if image_path is None:
+                command += ["-size", "%dx%d" % (tile_pixels, tile_pixels), "xc:%s" % (fill_color)]
+            else:
+                command += ["(", image_path, "-resize", "%dx%d!" % (tile_pixels, tile_pixels), ")"]
+        command += ["+append", ")"]
+    command += ["-append", output_path]
+    subprocess.run(command)
@@ -0,0 +1,45 @@
+#!/usr/bin/env python3
+
+# Utility functions for writing MTL files. Every material except the
+# tile textures is the same for the whole city, so those are written
+# once into a shared material library that every tile points at.
+
+from configuration import *
+
+def write_texture_material(f, material_name, texture_filename):
+    """
+    Write a material that only uses a texture (tiles, atlases, etc.)
+    """
+    f.write("newmtl %s\n" % (material_name))
+    f.write("Ka 1.0000 1.0000 1.0000\n")
+    f.write("Kd 1.0000 1.0000 1.0000\n")
+    f.write("illum 1\n")
+    f.write("map_Kd %s\n\n" % (texture_filename))
+
+def write_city_material_library(filepath, config, tree_mtl_lines):
+    """
+    Write the building and tree materials into the city's shared MTL file.
+    """
+    f = open(filepath, 'w')
+
+    # Add colors for buildings
+    # Get them from the config file
+    for building_mat_name in config.material_colors:
+        f.write("newmtl %s\n" % building_mat_name)
+        f.write("Kd %.4f %.4f %.4f\n" % config.material_colors[building_mat_name])
+        f.write("illum 0\n\n")
+
+    # Add colors from the tree model
+    for line in tree_mtl_lines:
+        f.write(line)
+    if config.autumn:
+        f.write("\nnewmtl tree_red\n")
+        f.write("Kd 1.0000 0.0000 0.0000\n")
+        f.write("illum 0\n")
+        f.write("newmtl tree_yellow\n")
+        f.write("Kd 1.0000 1.0000 0.0000\n")
+        f.write("illum 0\n")
+        f.write("newmtl tree_orange\n")
+        f.write("Kd 1.0000 0.5000 0.0000\n")
+        f.write("illum 0\n")
+    f.close()
@@ -0,0 +1,404 @@
+#!/usr/bin/env python3
+
+# Utility functions for building meshes out of shapely geometry
+# and writing them into OBJ files.
+
+import numpy as np
+import shapely
+
+from obj_utils import *
+from tile_id import *
+
+def format_obj_vertices(vertices):
+    """
+    Format an (n, 3) array of vertices as OBJ "v" lines.
+    """
+    if len(vertices) == 0:
+        return ""
+    return ("v    %.6f    %.6f    %.6f\n" * len(vertices)) % tuple(np.asarray(vertices, dtype=float).ravel())
+
+def format_obj_faces(faces):
+    """
+    Format an (n, 3) array of 1-based vertex indices as OBJ "f" lines.
+    """
+    if len(faces) == 0:
+        return ""
+    return ("f %d %d %d\n" * len(faces)) % tuple(np.asarray(faces, dtype=np.int64).ravel())
+
+def simplify_footprints(footprints, tolerance=0., max_vertices=0):
+    """
+    Simplify an array of shapely building footprints. If max_vertices is
+    positive, footprints that still have too many vertices are simplified
+    with a growing tolerance and finally replaced by their convex hull.
+    Invalid footprints are also replaced by their convex hull, since they
+    can't be triangulated.
+    """
+    footprints = np.asarray(footprints, dtype=object)
+    if tolerance > 0:
+        footprints = shapely.simplify(footprints, tolerance, preserve_topology=True)
+
+    invalid = ~shapely.is_valid(footprints) | (shapely.get_type_id(footprints) != shapely.GeometryType.POLYGON)
+    footprints[invalid] = shapely.convex_hull(footprints[invalid])
+
+    if max_vertices > 0:
+        current_tolerance = max(tolerance, 0.5)
+        for _ in range(5):
+            too_big = shapely.get_num_coordinates(footprints) > max_vertices
+            if not too_big.any():
+                break
+            footprints[too_big] = shapely.simplify(footprints[too_big], current_tolerance, preserve_topology=True)
+            current_tolerance *= 2
+        too_big = shapely.get_num_coordinates(footprints) > max_vertices
+        footprints[too_big] = shapely.convex_hull(footprints[too_big])
+
+    # The convex hull of a degenerate footprint may not be a polygon
+    not_polygon = shapely.get_type_id(footprints) != shapely.GeometryType.POLYGON
+    footprints[not_polygon] = shapely.Polygon()
+    return footprints
+
+def extrude_footprints(footprints, base_elevations, top_elevations, tile, first_vertex_index):
+    """
+    Extrude every building footprint (holes included) of a tile at once.
+    The roofs are triangulated with GEOS's constrained triangulation, which
+    is ear clipping followed by Delaunay edge flips.
+
+    The vertices are written in the tile's local OBJ coordinates (the same
+    ones the terrain uses) and the faces are 1-based, starting at
+    first_vertex_index. Returns (vertices, wall_faces, wall_building_indices,
+    roof_faces, roof_building_indices, vertex_counts), where vertex_counts
+    is the number of vertices each building added.
+    """
+    footprints = np.asarray(footprints, dtype=object)
+    num_buildings = len(footprints)
+    empty_faces = np.zeros((0, 3), dtype=np.int64)
+    empty_indices = np.zeros(0, dtype=np.int64)
+    if num_buildings == 0:
+        return (np.zeros((0, 3)), empty_faces, empty_indices, empty_faces, empty_indices, np.zeros(0, dtype=np.int64))
+    sw_x, sw_y = tile.sw_corner()
+
+    # Get every ring and its coordinates. The exterior is always the first ring of a polygon.
+    rings, ring_building = shapely.get_rings(footprints, return_index=True)
+    coords, coord_ring = shapely.get_coordinates(rings, return_index=True)
+    num_rings = len(rings)
+    ring_sizes = np.bincount(coord_ring, minlength=num_rings)
+    ring_starts = np.concatenate(([0], np.cumsum(ring_sizes)[:-1]))
+    is_exterior = np.ones(num_rings, dtype=bool)
+    is_exterior[1:] = ring_building[1:] != ring_building[:-1]
+
+    # Orient exteriors clockwise and holes counterclockwise (in UTM). After flipping
+    # the y-axis into OBJ coordinates, that matches the orientation of the convex hulls.
+    next_coord = np.arange(1, len(coords) + 1)
+    next_coord[ring_starts + ring_sizes - 1] = ring_starts
+    cross = coords[:, 0] * coords[next_coord, 1] - coords[next_coord, 0] * coords[:, 1]
+    signed_areas = np.bincount(coord_ring, weights=cross, minlength=num_rings)
+    flip = (signed_areas > 0) == is_exterior
+    position_in_ring = np.arange(len(coords)) - ring_starts[coord_ring]
+    flipped_position = ring_sizes[coord_ring] - 1 - position_in_ring
+    order = ring_starts[coord_ring] + np.where(flip[coord_ring], flipped_position, position_in_ring)
+    coords = coords[order]
+
+    # Drop the duplicated closing point of every ring
+    keep = np.ones(len(coords), dtype=bool)
+    keep[ring_starts + ring_sizes - 1] = False
+    coords = coords[keep]
+    coord_ring = coord_ring[keep]
+    ring_sizes = ring_sizes - 1
+    ring_starts = np.concatenate(([0], np.cumsum(ring_sizes)[:-1]))
+    coord_building = ring_building[coord_ring]
+
+    # Every ring point has a base vertex followed by a top vertex
+    num_points = len(coords)
+    vertices = np.empty((2 * num_points, 3))
+    local_x = coords[:, 0] - sw_x
+    local_z = TileID.TILE_SIZE - (coords[:, 1] - sw_y)
+    vertices[0::2, 0] = local_x
+    vertices[0::2, 1] = np.asarray(base_elevations, dtype=float)[coord_building]
+    vertices[0::2, 2] = local_z
+    vertices[1::2, 0] = local_x
+    vertices[1::2, 1] = np.asarray(top_elevations, dtype=float)[coord_building]
+    vertices[1::2, 2] = local_z
+    base_index = first_vertex_index + 2 * np.arange(num_points)
+    top_index = base_index + 1
+
+    # The walls. Each edge is a bottom right triangle and a top left triangle.
+    next_point = np.arange(1, num_points + 1)
+    next_point[ring_starts + ring_sizes - 1] = ring_starts
+    wall_faces = np.empty((2 * num_points, 3), dtype=np.int64)
+    wall_faces[0::2] = np.column_stack((base_index, base_index[next_point], top_index[next_point]))
+    wall_faces[1::2] = np.column_stack((base_index, top_index[next_point], top_index))
+    wall_building_indices = np.repeat(coord_building, 2)
+
+    # The roofs. Triangulate, then look up each triangle corner among the
+    # building's own top vertices.
+    triangulations = shapely.constrained_delaunay_triangles(footprints)
+    triangles, triangle_building = shapely.get_parts(triangulations, return_index=True)
+    if len(triangles) > 0:
+        triangle_coords = shapely.get_coordinates(triangles).reshape(-1, 4, 2)[:, :3].reshape(-1, 2)
+        keys = np.vstack((np.column_stack((coord_building, coords)),\
+                np.column_stack((np.repeat(triangle_building, 3), triangle_coords))))
+        _, inverse = np.unique(keys, axis=0, return_inverse=True)
+        inverse = inverse.ravel()
+        lookup = np.full(inverse.max() + 1, -1, dtype=np.int64)
+        lookup[inverse[:num_points]] = np.arange(num_points)
+        corners = lookup[inverse[num_points:]].reshape(-1, 3)
+
+        # Triangulation shouldn't add points, but drop any triangle that did
+        matched = (corners >= 0).all(axis=1)
+        corners = corners[matched]
+        triangle_building = triangle_building[matched]
+        triangle_coords = triangle_coords.reshape(-1, 3, 2)[matched]
+
+        # Make the roof triangles clockwise in UTM, like the footprint exteriors
+        a, b, c = triangle_coords[:, 0], triangle_coords[:, 1], triangle_coords[:, 2]
+        twice_area = (b[:, 0] - a[:, 0]) * (c[:, 1] - a[:, 1]) - (c[:, 0] - a[:, 0]) * (b[:, 1] - a[:, 1])
+        counterclockwise = twice_area > 0
+        corners[counterclockwise] = corners[counterclockwise][:, [0, 2, 1]]
+        roof_faces = top_index[corners]
+        roof_building_indices = triangle_building
+    else:
+        roof_faces = empty_faces
+        roof_building_indices = empty_indices
+
+    vertex_counts = 2 * np.bincount(coord_building, minlength=num_buildings)
+    return (vertices, wall_faces, wall_building_indices, roof_faces, roof_building_indices, vertex_counts)
+
+def write_extruded_buildings(f, extrusion, colors, roof_colors):
+    """
+    Write the output of extrude_footprints to an open OBJ file. Every
+    building gets a group for its walls and a group for its roof, the
+    same as the convex hull buildings.
+    """
+    vertices, wall_faces, wall_building_indices, roof_faces, roof_building_indices, vertex_counts = extrusion
+    num_buildings = len(vertex_counts)
+    wall_bounds = np.searchsorted(wall_building_indices, np.arange(num_buildings + 1))
+    roof_bounds = np.searchsorted(roof_building_indices, np.arange(num_buildings + 1))
+
+    f.write("# Building vertices\n")
+    f.write(format_obj_vertices(vertices))
+    for building_index in range(num_buildings):
+        if vertex_counts[building_index] == 0:
+            continue
+        f.write("g a building with %d vertices\n" % (vertex_counts[building_index] // 2))
+        f.write("usemtl %s\n" % (colors[building_index]))
+        f.write(format_obj_faces(wall_faces[wall_bounds[building_index]:wall_bounds[building_index + 1]]))
+        f.write("g roof of building\n")
+        f.write("usemtl %s\n" % (roof_colors[building_index]))
+        f.write(format_obj_faces(roof_faces[roof_bounds[building_index]:roof_bounds[building_index + 1]]))
+
+def cluster_decimate(mesh, cell_size):
+    """
+    Simplify an ObjMesh by vertex clustering. Every vertex is snapped to
+    the average of the vertices in its cell_size grid cell, and faces
+    that collapse (or become duplicates) are removed. UVs are kept per
+    face corner, so textured faces keep their texture coordinates.
+    """
+    if len(mesh.faces) == 0:
+        return mesh
+    cells = np.floor(mesh.vertices / cell_size).astype(np.int64)
+    _, cluster = np.unique(cells, axis=0, return_inverse=True)
+    cluster = cluster.ravel()
+    num_clusters = cluster.max() + 1
+    counts = np.bincount(cluster, minlength=num_clusters)
+    vertices = np.column_stack([np.bincount(cluster, weights=mesh.vertices[:, k], minlength=num_clusters) / counts for k in range(3)])
+
+    faces = cluster[mesh.faces]
+    keep = (faces[:, 0] != faces[:, 1]) & (faces[:, 1] != faces[:, 2]) & (faces[:, 0] != faces[:, 2])
+    # Remove duplicated faces, ignoring orientation
+    _, first = np.unique(np.sort(faces, axis=1), axis=0, return_index=True)
+    unique = np.zeros(len(faces), dtype=bool)
+    unique[first] = True
+    keep &= unique
+
+    # Drop the vertices and UVs no face uses anymore
+    faces = faces[keep]
+    face_uvs = mesh.face_uvs[keep]
+    used_vertices, faces = np.unique(faces, return_inverse=True)
+    used_uvs, uv_inverse = np.unique(face_uvs, return_inverse=True)
+    uv_inverse = uv_inverse.reshape(face_uvs.shape)
+    if len(used_uvs) > 0 and used_uvs[0] == -1:
+        face_uvs = uv_inverse - 1
+        used_uvs = used_uvs[1:]
+    else:
+        face_uvs = uv_inverse
+    return ObjMesh(vertices[used_vertices], mesh.uvs[used_uvs], faces.reshape(-1, 3), face_uvs,\
+            mesh.face_materials[keep], list(mesh.materials), mesh.building_faces[keep])
+
+# How much more moving a vertex off the mesh's open boundary costs than
+# moving it off a face's plane, so outlines keep their shape
+BOUNDARY_QUADRIC_WEIGHT = 100.
+
+def plane_quadrics(normals, points, weights):
+    """
+    The (n, 4, 4) quadrics measuring the weighted squared distance to the
+    planes through points with the given normals.
+    """
+    lengths = np.linalg.norm(normals, axis=1)
+    normals = normals / np.maximum(lengths, 1e-12)[:, np.newaxis]
+    planes = np.column_stack((normals, -(normals * points).sum(axis=1)))
+    return planes[:, :, np.newaxis] * planes[:, np.newaxis, :] * weights[:, np.newaxis, np.newaxis]
+
+def accumulate_quadrics(vertex_indices, quadrics, num_vertices):
+    # Sum the quadrics into the vertices they belong to
+    flat = quadrics.reshape(-1, 16)
+    return np.column_stack([np.bincount(vertex_indices, weights=flat[:, k], minlength=num_vertices) for k in range(16)]).reshape(-1, 4, 4)
+
+def mesh_vertex_quadrics(vertices, faces):
+    """
+    The error quadric of every vertex: the area weighted planes of the
+    faces around it, plus planes standing up from the open boundary edges.
+    """
+    corners = vertices[faces]
+    normals = np.cross(corners[:, 1] - corners[:, 0], corners[:, 2] - corners[:, 0])
+    areas = np.linalg.norm(normals, axis=1) / 2
+    quadrics = accumulate_quadrics(faces.ravel(), np.repeat(plane_quadrics(normals, corners[:, 0], areas), 3, axis=0), len(vertices))
+
+    # Boundary edges are the ones only one face uses
+    edges = np.stack((faces, np.roll(faces, -1, axis=1)), axis=2).reshape(-1, 2)
+    sorted_edges = np.sort(edges, axis=1)
+    _, first, counts = np.unique(sorted_edges[:, 0] * len(vertices) + sorted_edges[:, 1], return_index=True, return_counts=True)
+    boundary = first[counts == 1]
+    if len(boundary) > 0:
+        starts = vertices[edges[boundary, 0]]
+        directions = vertices[edges[boundary, 1]] - starts
+        boundary_normals = np.cross(directions, normals[boundary // 3])
+        weights = BOUNDARY_QUADRIC_WEIGHT * (directions ** 2).sum(axis=1)
+        boundary_quadrics = plane_quadrics(boundary_normals, starts, weights)
+        quadrics += accumulate_quadrics(edges[boundary].ravel(), np.repeat(boundary_quadrics, 2, axis=0), len(vertices))
+    return quadrics
+
+def quadric_errors(quadrics, points):
+    homogeneous = np.column_stack((points, np.ones(len(points))))
+    return np.einsum('ni,nij,nj->n', homogeneous, quadrics, homogeneous)
+
+def edge_collapse_targets(vertices, quadrics, edges):
+    """
+    Where each edge's vertices should be merged to, and the error of
+    doing it. The point with the least error is used when it's well
+    defined, otherwise the best of the ends and the middle.
+    """
+    edge_quadrics = quadrics[edges[:, 0]] + quadrics[edges[:, 1]]
+    starts = vertices[edges[:, 0]]
+    ends = vertices[edges[:, 1]]
+    candidates = [starts, ends, (starts + ends) / 2]
+    # The quadric's 3x3 part is well conditioned when its determinant isn't
+    # tiny next to the cube of its average eigenvalue
+    scales = np.trace(edge_quadrics[:, :3, :3], axis1=1, axis2=2) / 3
+    solvable = np.abs(np.linalg.det(edge_quadrics[:, :3, :3])) > 1e-9 * scales ** 3
+    if solvable.any():
+        optimal = (starts + ends) / 2
+        optimal[solvable] = np.linalg.solve(edge_quadrics[solvable, :3, :3], -edge_quadrics[solvable, :3, 3:])[:, :, 0]
+        candidates.append(optimal)
+    errors = np.column_stack([quadric_errors(edge_quadrics, candidate) for candidate in candidates])
+    best = errors.argmin(axis=1)
+    targets = np.stack(candidates, axis=1)[np.arange(len(edges)), best]
+    return targets, errors[np.arange(len(edges)), best]
+
+def first_unique_rows(rows):
+    """
+    A mask of the rows of an integer array that don't repeat an earlier row.
+    """
+    order = np.lexsort(rows.T[::-1])
+    sorted_rows = rows[order]
+    first = np.ones(len(rows), dtype=bool)
+    first[order[1:]] = (sorted_rows[1:] != sorted_rows[:-1]).any(axis=1)
+    return first
+
+def mesh_edges(faces, num_vertices):
+    """
+    Every edge of a triangle mesh once, as (n, 2) vertex indices with the
+    smaller index first.
+    """
+    edges = np.sort(np.stack((faces, np.roll(faces, -1, axis=1)), axis=2).reshape(-1, 2), axis=1)
+    keys = np.unique(edges[:, 0] * num_vertices + edges[:, 1])
+    return np.column_stack((keys // num_vertices, keys % num_vertices))
+
+def remove_degenerate_faces(faces):
+    """
+    A mask of the faces to keep: the ones with three different vertices
+    that aren't a copy of an earlier face (ignoring orientation).
+    """
+    keep = (faces[:, 0] != faces[:, 1]) & (faces[:, 1] != faces[:, 2]) & (faces[:, 0] != faces[:, 2])
+    return keep & first_unique_rows(np.sort(faces, axis=1))
+
+def quadric_decimate(mesh, max_faces):
+    """
+    Simplify an ObjMesh to at most max_faces faces (when it can) by
+    collapsing edges, cheapest first, where the cost is the quadric error
+    of Garland and Heckbert. Each pass collapses a batch of edges that
+    don't share vertices, picked and applied with array operations, and
+    collapses that would flip a face over are skipped. Face UVs and
+    materials are kept for the faces that are left.
+    """
+    vertices = mesh.vertices.astype(float)
+    faces = mesh.faces.copy()
+    face_indices = np.arange(len(faces))
+    keep = remove_degenerate_faces(faces)
+    faces = faces[keep]
+    face_indices = face_indices[keep]
+    if len(faces) > max_faces:
+        quadrics = mesh_vertex_quadrics(vertices, faces)
+    rng = np.random.default_rng(0)
+    while len(faces) > max_faces:
+        # Every edge and what collapsing it costs
+        edges = mesh_edges(faces, len(vertices))
+        targets, errors = edge_collapse_targets(vertices, quadrics, edges)
+
+        # Pick the edges that are the cheapest at both of their vertices, so
+        # no two of them share a vertex. Collapsing an edge removes about 2 faces.
+        # Ties are broken in a fixed shuffled order, since breaking them in
+        # edge order picks only one edge out of a run of equally cheap ones.
+        ranks = np.empty(len(edges), dtype=np.int64)
+        ranks[np.lexsort((rng.permutation(len(edges)), errors))] = np.arange(len(edges))
+        vertex_best = np.full(len(vertices), len(edges), dtype=np.int64)
+        np.minimum.at(vertex_best, edges[:, 0], ranks)
+        np.minimum.at(vertex_best, edges[:, 1], ranks)
+        chosen = np.flatnonzero((vertex_best[edges[:, 0]] == ranks) & (vertex_best[edges[:, 1]] == ranks))
+        chosen = chosen[np.argsort(ranks[chosen])][:max((len(faces) - max_faces + 1) // 2, 1)]
+
+        # Skip the collapses that flip a face, until none of them do
+        old_corners = vertices[faces]
+        old_normals = np.cross(old_corners[:, 1] - old_corners[:, 0], old_corners[:, 2] - old_corners[:, 0])
+        while len(chosen) > 0:
+            collapse_of_vertex = np.full(len(vertices), -1, dtype=np.int64)
+            collapse_of_vertex[edges[chosen, 0]] = np.arange(len(chosen))
+            collapse_of_vertex[edges[chosen, 1]] = np.arange(len(chosen))
+            new_vertices = vertices.copy()
+            new_vertices[edges[chosen, 0]] = targets[chosen]
+            new_vertices[edges[chosen, 1]] = targets[chosen]
+            face_collapses = collapse_of_vertex[faces]
+            # Faces with both vertices of an edge go away, the other touched ones move
+            collapsed = ((face_collapses == np.roll(face_collapses, -1, axis=1)) & (face_collapses >= 0)).any(axis=1)
+            touched = (face_collapses >= 0).any(axis=1) & ~collapsed
+            new_corners = new_vertices[faces[touched]]
+            new_normals = np.cross(new_corners[:, 1] - new_corners[:, 0], new_corners[:, 2] - new_corners[:, 0])
+            # Faces that were already flat can't flip, the others mustn't flip or go flat
+            flipped = ((new_normals * old_normals[touched]).sum(axis=1) <= 0) & (np.abs(old_normals[touched]).sum(axis=1) > 0)
+            if not flipped.any():
+                break
+            rejected = np.unique(face_collapses[touched][flipped])
+            chosen = np.delete(chosen, rejected[rejected >= 0])
+        if len(chosen) == 0:
+            break
+
+        # Merge the second vertex of each edge into the first
+        vertices = new_vertices
+        quadrics[edges[chosen, 0]] += quadrics[edges[chosen, 1]]
+        remap = np.arange(len(vertices))
+        remap[edges[chosen, 1]] = edges[chosen, 0]
+        faces = remap[faces]
+        keep = remove_degenerate_faces(faces)
+        faces = faces[keep]
+        face_indices = face_indices[keep]
+
+    # Drop the vertices and UVs no face uses anymore
+    used_vertices, faces = np.unique(faces, return_inverse=True)
+    face_uvs = mesh.face_uvs[face_indices]
+    used_uvs, uv_inverse = np.unique(face_uvs, return_inverse=True)
+    uv_inverse = uv_inverse.reshape(face_uvs.shape)
+    if len(used_uvs) > 0 and used_uvs[0] == -1:
+        face_uvs = uv_inverse - 1
+        used_uvs = used_uvs[1:]
+    else:
+        face_uvs = uv_inverse
+    return ObjMesh(vertices[used_vertices], mesh.uvs[used_uvs], faces.reshape(-1, 3), face_uvs,\
+            mesh.face_materials[face_indices], list(mesh.materials), mesh.building_faces[face_indices])
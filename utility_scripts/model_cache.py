@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+
+# A cache of the OBJ models (trees, custom buildings) that go into tile
+# meshes, parsed into arrays once and memory mapped from then on.
+
+import collections
+import os
+import shutil
+import threading
+
+from file_utils import *
+from mesh_utils import *
+from obj_utils import *
+
+# The models that come with the scripts. Found from this file, so the
+# scripts can be run from any directory.
+MODELS_DIRECTORY = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "models")
+DEFAULT_TREE_MODEL_PATH = os.path.join(MODELS_DIRECTORY, "tree.obj")
+
+# Lives in the city directory, next to the tile directories
+MODEL_CACHE_DIRECTORY_NAME = ".model_cache"
+
+def model_mtl_path(model_path):
+    # A model's materials are in the MTL file next to it with the same name
+    return os.path.splitext(model_path)[0] + ".mtl"
+
+class ModelCache:
+    """
+    OBJ models parsed into ObjMeshes. Each model is only parsed once: its
+    arrays are saved under the city's directory as .npy files and memory
+    mapped from there, by this run and later ones, so processes building
+    tiles at the same time share one copy. Models are found by a hash of
+    their contents, so a model copied into several tiles is shared and an
+    edited one is parsed again. Recently used meshes are also kept open,
+    and the cache can be used from several threads.
+    """
+    def __init__(self, city_directory, max_models=16):
+        self.directory = os.path.join(city_directory, MODEL_CACHE_DIRECTORY_NAME)
+        os.makedirs(self.directory, exist_ok=True)
+        self.max_models = max_models
+        self.meshes = collections.OrderedDict()
+        # Content keys of files by their path, size, and modification time,
+        # so files that didn't change aren't hashed again
+        self.content_keys = {}
+        self.lock = threading.Lock()
+
+    def get_content_key(self, filepath):
+        stat = os.stat(filepath)
+        file_key = (os.path.abspath(filepath), stat.st_size, stat.st_mtime_ns)
+        with self.lock:
+            content_key = self.content_keys.get(file_key)
+        if content_key is None:
+            content_key = file_content_key(filepath)
+            with self.lock:
+                self.content_keys[file_key] = content_key
+        return content_key
+
+    def get(self, filepath, max_faces=0):
+        """
+        The ObjMesh of an OBJ file, decimated to max_faces faces if that
+        isn't 0. Raises FileNotFoundError if the file is missing.
+        """
+        key = "%s_%d" % (self.get_content_key(filepath), max_faces)
+        with self.lock:
+            if key in self.meshes:
+                self.meshes.move_to_end(key)
+                return self.meshes[key]
+
+        mesh_directory = os.path.join(self.directory, key)
+        if not os.path.exists(mesh_directory):
+            mesh = read_obj(filepath)
+            if max_faces > 0 and mesh.num_triangles() > max_faces:
+                mesh = quadric_decimate(mesh, max_faces)
+            # Save into a temporary directory and move it into place, so the
+            # cache never has half-saved meshes. If another process saved
+            # the model first, its copy is used.
+            temp_directory = "%s.%d.%d.tmp" % (mesh_directory, os.getpid(), threading.get_ident())
+            save_obj_mesh(temp_directory, mesh)
+            try:
+                os.rename(temp_directory, mesh_directory)
+            except OSError:
+                shutil.rmtree(temp_directory)
+        mesh = load_obj_mesh(mesh_directory, 'r')
+
+        with self.lock:
+            self.meshes[key] = mesh
+            while len(self.meshes) > self.max_models:
+                self.meshes.popitem(last=False)
+        return mesh
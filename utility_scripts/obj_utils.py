@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+
+# Read and write OBJ files as numpy arrays.
+
+import numpy as np
+import os
+
+class ObjMesh:
+    """
+    A triangle mesh read from an OBJ file. Faces index (0-based) into
+    vertices, face_uvs index into uvs (-1 when a corner has no UV), and
+    face_materials index into materials. building_faces marks the faces
+    that came after a "# Building" comment in a tile OBJ, since those
+    are written with the opposite orientation.
+    """
+    def __init__(self, vertices, uvs, faces, face_uvs, face_materials, materials, building_faces=None):
+        self.vertices = vertices
+        self.uvs = uvs
+        self.faces = faces
+        self.face_uvs = face_uvs
+        self.face_materials = face_materials
+        self.materials = materials
+        if building_faces is None:
+            building_faces = np.zeros(len(faces), dtype=bool)
+        self.building_faces = building_faces
+
+    def num_triangles(self):
+        return len(self.faces)
+
+def empty_obj_mesh():
+    return ObjMesh(np.zeros((0, 3)), np.zeros((0, 2)), np.zeros((0, 3), dtype=np.int64),\
+            np.zeros((0, 3), dtype=np.int64), np.zeros(0, dtype=np.int64), [])
+
+def read_obj(filepath):
+    """
+    Parse an OBJ file into an ObjMesh. Polygons with more than three
+    vertices are split into a triangle fan.
+    """
+    vertices = []
+    uvs = []
+    faces = []
+    face_uvs = []
+    face_materials = []
+    building_faces = []
+    materials = []
+    material_indices = {}
+    current_material = -1
+    is_building = False
+    f = open(filepath, 'r')
+    for line in f:
+        if line.startswith("v "):
+            vertices.append(line.split()[1:4])
+        elif line.startswith("vt"):
+            uvs.append(line.split()[1:3])
+        elif line.startswith("f "):
+            corners = line.split()[1:]
+            vertex_indices = []
+            uv_indices = []
+            for corner in corners:
+                parts = corner.split('/')
+                vertex_index = int(parts[0])
+                vertex_indices.append(vertex_index - 1 if vertex_index > 0 else len(vertices) + vertex_index)
+                if len(parts) > 1 and parts[1] != "":
+                    uv_index = int(parts[1])
+                    uv_indices.append(uv_index - 1 if uv_index > 0 else len(uvs) + uv_index)
+                else:
+                    uv_indices.append(-1)
+            for k in range(1, len(corners) - 1):
+                faces.append((vertex_indices[0], vertex_indices[k], vertex_indices[k + 1]))
+                face_uvs.append((uv_indices[0], uv_indices[k], uv_indices[k + 1]))
+                face_materials.append(current_material)
+                building_faces.append(is_building)
+        elif line.startswith("usemtl"):
+            material_name = line.split()[-1].strip()
+            if not material_name in material_indices:
+                material_indices[material_name] = len(materials)
+                materials.append(material_name)
+            current_material = material_indices[material_name]
+        elif line.startswith("# Building"):
+            is_building = True
+        elif line.startswith("# Terrain"):
+            is_building = False
+    f.close()
+
+    return ObjMesh(np.array(vertices, dtype=float).reshape(-1, 3),\
+            np.array(uvs, dtype=float).reshape(-1, 2),\
+            np.array(faces, dtype=np.int64).reshape(-1, 3),\
+            np.array(face_uvs, dtype=np.int64).reshape(-1, 3),\
+            np.array(face_materials, dtype=np.int64),\
+            materials,\
+            np.array(building_faces, dtype=bool))
+
+# The arrays of an ObjMesh that save_obj_mesh writes, one .npy file each
+OBJ_MESH_ARRAY_NAMES = ["vertices", "uvs", "faces", "face_uvs", "face_materials", "materials", "building_faces"]
+
+def save_obj_mesh(directory, mesh):
+    """
+    Save an ObjMesh's arrays as .npy files in a directory, so it can be
+    loaded (or memory mapped) without parsing the OBJ again.
+    """
+    os.makedirs(directory, exist_ok=True)
+    for name in OBJ_MESH_ARRAY_NAMES:
+        value = getattr(mesh, name)
+        if name == "materials":
+            value = np.array(value, dtype=str).reshape(-1)
+        np.save(os.path.join(directory, name + ".npy"), value)
+
+def load_obj_mesh(directory, mmap_mode=None):
+    """
+    Load an ObjMesh saved by save_obj_mesh. With a mmap_mode like 'r', the
+    arrays are memory mapped, so processes loading the same mesh share
+    its memory and only the parts that are used get read.
+    """
+    arrays = {name : np.load(os.path.join(directory, name + ".npy"), mmap_mode=mmap_mode) for name in OBJ_MESH_ARRAY_NAMES}
+    arrays["materials"] = [str(material) for material in arrays["materials"]]
+    return ObjMesh(**arrays)
+
+def material_groups(mesh):
+    """
+    Split an ObjMesh's faces into runs that use the same material, in
+    order. Returns (group_starts, group_materials), where group k is faces
+    group_starts[k] to group_starts[k + 1] and uses material
+    group_materials[k] (an index into mesh.materials, or -1).
+    """
+    face_materials = np.asarray(mesh.face_materials)
+    if len(face_materials) == 0:
+        return np.zeros(1, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    group_starts = np.concatenate(([0], np.flatnonzero(np.diff(face_materials)) + 1, [len(face_materials)])).astype(np.int64)
+    return group_starts, face_materials[group_starts[:-1]]
+
+def merge_obj_meshes(meshes, offsets):
+    """
+    Merge meshes into one, adding offsets[k] = (x, y, z) to the
+    vertices of meshes[k]. Materials with the same name are merged.
+    """
+    vertices = []
+    uvs = []
+    faces = []
+    face_uvs = []
+    face_materials = []
+    building_faces = []
+    materials = []
+    material_indices = {}
+    num_vertices = 0
+    num_uvs = 0
+    for mesh, offset in zip(meshes, offsets):
+        vertices.append(mesh.vertices + np.asarray(offset, dtype=float))
+        uvs.append(mesh.uvs)
+        faces.append(mesh.faces + num_vertices)
+        face_uvs.append(np.where(mesh.face_uvs >= 0, mesh.face_uvs + num_uvs, -1))
+        material_remap = np.empty(len(mesh.materials) + 1, dtype=np.int64)
+        material_remap[-1] = -1
+        for k, material_name in enumerate(mesh.materials):
+            if not material_name in material_indices:
+                material_indices[material_name] = len(materials)
+                materials.append(material_name)
+            material_remap[k] = material_indices[material_name]
+        face_materials.append(material_remap[mesh.face_materials])
+        building_faces.append(mesh.building_faces)
+        num_vertices += len(mesh.vertices)
+        num_uvs += len(mesh.uvs)
+    if len(vertices) == 0:
+        return empty_obj_mesh()
+    return ObjMesh(np.vstack(vertices), np.vstack(uvs), np.vstack(faces), np.vstack(face_uvs),\
+            np.concatenate(face_materials), materials, np.concatenate(building_faces))
+
+def write_obj(f, mesh, mtllib_names):
+    """
+    Write an ObjMesh to an open file. Faces are grouped by material.
+    """
+    f.write("mtllib %s\n" % (" ".join(mtllib_names)))
+    if len(mesh.vertices) > 0:
+        f.write(("v    %.6f    %.6f    %.6f\n" * len(mesh.vertices)) % tuple(mesh.vertices.ravel()))
+    if len(mesh.uvs) > 0:
+        f.write(("vt %.6f %.6f\n" * len(mesh.uvs)) % tuple(mesh.uvs.ravel()))
+    order = np.argsort(mesh.face_materials, kind="stable")
+    boundaries = np.flatnonzero(np.diff(mesh.face_materials[order])) + 1
+    for group in np.split(order, boundaries):
+        if len(group) == 0:
+            continue
+        material_index = mesh.face_materials[group[0]]
+        if material_index >= 0:
+            f.write("usemtl %s\n" % (mesh.materials[material_index]))
+        group_faces = mesh.faces[group] + 1
+        group_uvs = mesh.face_uvs[group] + 1
+        has_uvs = (group_uvs > 0).all(axis=1)
+        if has_uvs.any():
+            interleaved = np.empty((has_uvs.sum(), 6), dtype=np.int64)
+            interleaved[:, 0::2] = group_faces[has_uvs]
+            interleaved[:, 1::2] = group_uvs[has_uvs]
+            f.write(("f %d/%d %d/%d %d/%d\n" * len(interleaved)) % tuple(interleaved.ravel()))
+        if (~has_uvs).any():
+            f.write(("f %d %d %d\n" * (~has_uvs).sum()) % tuple(group_faces[~has_uvs].ravel()))
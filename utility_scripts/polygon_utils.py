@@ -1,5 +1,6 @@
 #!/usr/bin/env python3
 
+import numpy as np
 import shapely
 import utm
 
@@ -8,6 +9,20 @@ class PolygonWithProperties:
         self.polygon = polygon
         self.properties = properties
 
+def lonlat_array_to_utm(coords_lonlat, zone, offset=(0,0)):
+    """
+    Project an (n, 2) array of lon/lat coordinates into the given UTM zone
+    all at once. Points outside of the zone are projected into it anyway
+    (extended UTM), so nothing is lost at zone boundaries. The distortion
+    grows slowly with the distance from the zone, and is still small a
+    zone width away.
+    """
+    coords_lonlat = np.asarray(coords_lonlat, dtype=float)
+    if len(coords_lonlat) == 0:
+        return np.zeros((0, 2))
+    x, y, _, _ = utm.from_latlon(coords_lonlat[:, 1], coords_lonlat[:, 0], force_zone_number=zone)
+    return np.column_stack((x + offset[0], y + offset[1]))
+
 def point_lonlat_to_utm(point_lonlat, offset=(0,0)):
     x, y, zone, letter = utm.from_latlon(point_lonlat.y, point_lonlat.x)
     return shapely.Point(x + offset[0], y + offset[1])
@@ -92,6 +107,19 @@ def polygon_list_contains(polygon_list, point):
             pass
     return False
 
+def polygon_list_contains_xy(polygon_list, xs, ys):
+    """
+    Vectorized version of polygon_list_contains. Returns a boolean array
+    saying whether each point (xs[k], ys[k]) is in any of the polygons.
+    """
+    contained = np.zeros(len(xs), dtype=bool)
+    for polygon in polygon_list:
+        try:
+            contained |= shapely.contains_xy(polygon, xs, ys)
+        except shapely.errors.GEOSException:
+            pass
+    return contained
+
 def main():
     print("Main function not implemented")
 
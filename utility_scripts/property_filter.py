@@ -4,10 +4,12 @@
 
 from enum import Enum
 import numpy as np
+import shapely
 import sys
 
 sys.path.insert(1, 'C:/Users/mse93/Documents/simple-cities-digital-twins/utility_scripts')
-from polygon_utils import polygon_list_contains
+from polygon_utils import polygon_list_contains, polygon_list_contains_xy
+from random_utils import *
 
 class BuildingClassification(Enum):
     House = 1
@@ -18,105 +20,74 @@ class BuildingClassification(Enum):
     DowntownMiscellaneous = 6
     SmallNonHouse = 7
 
+# The raw properties that clean_properties looks at. The rest can be
+# dropped as soon as the buildings are read.
+BUILDING_PROPERTY_KEYS = ("height", "building", "building:material", "building:color", "building:colour",\
+        "roof:shape", "roof:color", "roof:colour", "roof:material", "osm_id", "building:levels", "levels")
+
 class PropertyFilter:
     """
     This class handles the properties that were read from the original
     geojson file of buildings. Currently height and mesh:color are
     required for creating a mesh, so those are randomly chosen based on
     the configuration file variables if not present.
+
+    The random choices for a building only depend on its OSM id (or its
+    centroid if it has none) and the seed, not on the order buildings
+    are filtered in.
     """
-    def __init__(self, configuration):
+    def __init__(self, configuration, seed=1):
         self.config = configuration
-        self.rng = np.random.default_rng(1)
-
-        # Set the probabilities for materials of skyscrapers
-        glass_cutoff = self.config.at["SKYSCRAPER_GLASS_PROB"]
-        concrete_cutoff = glass_cutoff + self.config.at["SKYSCRAPER_CONCRETE_PROB"]
-        metal_cutoff = concrete_cutoff + self.config.at["SKYSCRAPER_METAL_PROB"]
-        if abs(metal_cutoff - 1.) > 0.01:
-            print("Error: skyscraper material probabilities don't add to 1. Check the config file.")
-        self.skyscraper_material_probs = (("glass", glass_cutoff), ("concrete", concrete_cutoff), ("metal", metal_cutoff))
-
-        # Set the probabilities for materials of apartments
-        brick_cutoff = self.config.at["APARTMENTS_BRICK_PROB"]
-        concrete_cutoff = brick_cutoff + self.config.at["APARTMENTS_CONCRETE_PROB"]
-        metal_cutoff = concrete_cutoff + self.config.at["APARTMENTS_METAL_PROB"]
-        if abs(metal_cutoff - 1.) > 0.01:
-            print("Error: apartment material probabilities don't add to 1. Check the config file.")
-        self.apartment_material_probs = (("brick", brick_cutoff), ("concrete", concrete_cutoff), ("metal", metal_cutoff))
-
-        # Set the probabilities for materials of houses
-        vinyl_cutoff = self.config.at["HOUSE_VINYL_PROB"]
-        brick_cutoff = vinyl_cutoff + self.config.at["HOUSE_BRICK_PROB"]
-        if abs(brick_cutoff - 1.) > 0.01:
-            print("Error: house material probabilities don't add to 1. Check the config file.")
-        self.house_material_probs = (("vinyl", vinyl_cutoff), ("brick", brick_cutoff))
-
-        # Set the probabilities for vinyl colors
-        tan_cutoff = self.config.at["VINYL_TAN_PROB"]
-        white_cutoff = tan_cutoff + self.config.at["VINYL_WHITE_PROB"]
-        gray_cutoff = white_cutoff + self.config.at["VINYL_GRAY_PROB"]
-        brown_cutoff = gray_cutoff + self.config.at["VINYL_BROWN_PROB"]
-        yellow_cutoff = brown_cutoff + self.config.at["VINYL_YELLOW_PROB"]
-        blue_cutoff = yellow_cutoff + self.config.at["VINYL_BLUE_PROB"]
-        green_cutoff = blue_cutoff + self.config.at["VINYL_GREEN_PROB"]
-        if abs(green_cutoff - 1.) > 0.01:
-            print("Error: vinyl color probabilities don't add to 1. Check the config file.")
-        self.vinyl_color_probs = (("tan", tan_cutoff), ("white", white_cutoff), ("gray", gray_cutoff),\
-                ("brown", brown_cutoff), ("yellow", yellow_cutoff), ("blue", blue_cutoff), ("green", green_cutoff))
-
-        # Set the probabilities for materials of houses
-        black_cutoff = self.config.at["ROOF_BLACK_PROB"]
-        gray_cutoff = black_cutoff + self.config.at["ROOF_GRAY_PROB"]
-        white_cutoff = gray_cutoff + self.config.at["ROOF_WHITE_PROB"]
-        if abs(white_cutoff - 1.) > 0.01:
-            print("Error: roof material probabilities don't add to 1. Check the config file.")
-        self.roof_material_probs = (("roof_black", black_cutoff), ("roof_gray", gray_cutoff), ("roof_white", white_cutoff))
-
-    def choose_random(self, name_cutoff_pairs):
-        r = self.rng.random()
+        self.seed = seed
+
+        # The cumulative material probabilities come from the configuration
+        self.skyscraper_material_probs = self.config.skyscraper_material_probs
+        self.apartment_material_probs = self.config.apartment_material_probs
+        self.house_material_probs = self.config.house_material_probs
+        self.vinyl_color_probs = self.config.vinyl_color_probs
+        self.roof_material_probs = self.config.roof_material_probs
+
+    def uniform(self, key, stream):
+        return float(stable_uniforms([key], stream, self.seed)[0])
+
+    def choose_random(self, name_cutoff_pairs, r):
         for name,cutoff in name_cutoff_pairs:
             if r < cutoff:
                 return name
         raise ValueError("Failed to randomly choose a material/color. Verify that the config probabilities add to 1.")
 
-    def random_skyscraper_material(self):
-        return self.choose_random(self.skyscraper_material_probs)
-    def random_apartments_material(self):
-        return self.choose_random(self.apartment_material_probs)
-    def random_house_material(self):
-        random_material = self.choose_random(self.house_material_probs)
+    def random_skyscraper_material(self, key):
+        return self.choose_random(self.skyscraper_material_probs, self.uniform(key, MATERIAL_STREAM))
+    def random_apartments_material(self, key):
+        return self.choose_random(self.apartment_material_probs, self.uniform(key, MATERIAL_STREAM))
+    def random_house_material(self, key):
+        random_material = self.choose_random(self.house_material_probs, self.uniform(key, HOUSE_MATERIAL_STREAM))
         if random_material == "vinyl":
-            return "vinyl_" + self.random_vinyl_color()
+            return "vinyl_" + self.random_vinyl_color(key)
         else:
             return random_material
-    def random_vinyl_color(self):
-        return self.choose_random(self.vinyl_color_probs)
-    def random_roof_material(self):
-        return self.choose_random(self.roof_material_probs)
-
-    def random_downtown_height(self):
-        r = self.rng.random()
-        return self.config.at["MIN_DOWNTOWN_HEIGHT"] + r * (self.config.at["MAX_DOWNTOWN_HEIGHT"] - self.config.at["MIN_DOWNTOWN_HEIGHT"])
+    def random_vinyl_color(self, key):
+        return self.choose_random(self.vinyl_color_probs, self.uniform(key, VINYL_COLOR_STREAM))
+    def random_roof_material(self, key):
+        return self.choose_random(self.roof_material_probs, self.uniform(key, ROOF_STREAM))
 
-    def random_apartments_height(self):
-        r = self.rng.random()
-        return self.config.at["MIN_APARTMENTS_HEIGHT"] + r * (self.config.at["MAX_APARTMENTS_HEIGHT"] - self.config.at["MIN_APARTMENTS_HEIGHT"])
+    def random_downtown_height(self, key):
+        r = self.uniform(key, HEIGHT_STREAM)
+        return self.config.min_downtown_height + r * (self.config.max_downtown_height - self.config.min_downtown_height)
 
-    def random_house_height(self):
-        r = self.rng.random()
-        return self.config.at["MIN_HOUSE_HEIGHT"] + r * (self.config.at["MAX_HOUSE_HEIGHT"] - self.config.at["MIN_HOUSE_HEIGHT"])
+    def random_apartments_height(self, key):
+        r = self.uniform(key, HEIGHT_STREAM)
+        return self.config.min_apartments_height + r * (self.config.max_apartments_height - self.config.min_apartments_height)
 
-    def filter(self, pwp, downtown_multipolygon, park_multipolygon, residential_multipolygon):
-        building_footprint = pwp.polygon
-        raw_properties = pwp.properties
-
-        # Check for containment in downtown, residential zones, or parks
-        in_downtown = polygon_list_contains(downtown_multipolygon, building_footprint.centroid)
-        in_park = polygon_list_contains(park_multipolygon, building_footprint.centroid)
-        in_residential = polygon_list_contains(residential_multipolygon, building_footprint.centroid)
+    def random_house_height(self, key):
+        r = self.uniform(key, HEIGHT_STREAM)
+        return self.config.min_house_height + r * (self.config.max_house_height - self.config.min_house_height)
 
-        # Keep only the keys that we care about
+    def clean_properties(self, raw_properties):
+        """
+        Keep only the OSM keys that we care about, and make sure
+        there is a building tag.
+        """
         filtered = {}
         for key,value in raw_properties.items():
             if key == "height" and value != None:
@@ -145,10 +116,26 @@ class PropertyFilter:
             elif key == "building:levels" or key == "levels":
                 filtered["levels"] = value
 
-        # Classify the building type. We will use this for estimating the height.
         # Set building=yes if no building tag is present
         if not "building" in filtered:
             filtered["building"] = "yes"
+        return filtered
+
+    def filter(self, pwp, downtown_multipolygon, park_multipolygon, residential_multipolygon):
+        building_footprint = pwp.polygon
+
+        # Check for containment in downtown, residential zones, or parks
+        in_downtown = polygon_list_contains(downtown_multipolygon, building_footprint.centroid)
+        in_park = polygon_list_contains(park_multipolygon, building_footprint.centroid)
+        in_residential = polygon_list_contains(residential_multipolygon, building_footprint.centroid)
+
+        # Keep only the keys that we care about
+        filtered = self.clean_properties(pwp.properties)
+
+        # The key that all of this building's random choices come from
+        key = osm_id_keys([filtered.get("osm_id")], [building_footprint.centroid.x], [building_footprint.centroid.y])[0]
+
+        # Classify the building type. We will use this for estimating the height.
                     # If there is a "building=" property, that could be a clue about the height
         building_type = filtered["building"]
         if building_type == "house" or building_type == "garage":
@@ -160,14 +147,14 @@ class PropertyFilter:
         elif building_type == "apartments" and in_downtown:
             # Apartments in downtown are tall
             building_classification = BuildingClassification.Skyscraper
-        elif "height" in filtered and float(filtered["height"]) > self.config.at["MIN_SKYSCRAPER_HEIGHT"]:
+        elif "height" in filtered and float(filtered["height"]) > self.config.min_skyscraper_height:
             # If we know the height, we can conclude it is a skyscraper
             building_classification = BuildingClassification.Skyscraper
         elif in_downtown and not (in_park or in_residential):
             # Downtown buildings not in parks or residential are tall
             # (residential shouldn't overlap with downtown, but just in case)
             building_classification = BuildingClassification.DowntownMiscellaneous
-            guessed_height = self.random_downtown_height()
+            guessed_height = self.random_downtown_height(key)
         elif building_type == "school":
             building_classification = BuildingClassification.School
         elif building_type == "industrial" or\
@@ -201,42 +188,210 @@ class PropertyFilter:
             # If we didn't set the height from the levels, guess it from the classification
             if not height_from_levels:
                 if building_classification == BuildingClassification.House:
-                    guessed_height = self.random_house_height()
+                    guessed_height = self.random_house_height(key)
                 elif building_classification == BuildingClassification.Skyscraper:
-                    guessed_height = self.random_downtown_height()
+                    guessed_height = self.random_downtown_height(key)
                     print("Error: building classified as skyscraper doesn't have height set?")
                 elif building_classification == BuildingClassification.Apartments:
-                    guessed_height = self.random_apartments_height()
+                    guessed_height = self.random_apartments_height(key)
                 elif building_classification == BuildingClassification.School:
-                    guessed_height = self.random_apartments_height()
+                    guessed_height = self.random_apartments_height(key)
                 elif building_classification == BuildingClassification.MidsizedCommercial:
-                    guessed_height = self.random_apartments_height()
+                    guessed_height = self.random_apartments_height(key)
                 elif building_classification == BuildingClassification.DowntownMiscellaneous:
-                    guessed_height = self.random_downtown_height()
+                    guessed_height = self.random_downtown_height(key)
                 else:
-                    guessed_height = self.random_house_height()
+                    guessed_height = self.random_house_height(key)
                 filtered["height"] = guessed_height
 
         # Choose a mesh_color.
         osm_acceptable_materials = ("glass", "brick", "concrete", "marble", "plaster", "metal")
         if "building:material" in filtered and filtered["building:material"] in osm_acceptable_materials:
             mesh_color = filtered["building:material"]
-        elif float(filtered["height"]) > self.config.at["MIN_SKYSCRAPER_HEIGHT"] or building_classification == BuildingClassification.Skyscraper:
-            mesh_color = self.random_skyscraper_material()
+        elif float(filtered["height"]) > self.config.min_skyscraper_height or building_classification == BuildingClassification.Skyscraper:
+            mesh_color = self.random_skyscraper_material(key)
         elif building_classification == BuildingClassification.House:
-            mesh_color = self.random_house_material()
+            mesh_color = self.random_house_material(key)
         elif building_classification == BuildingClassification.Apartments:
-            mesh_color = self.random_apartments_material()
+            mesh_color = self.random_apartments_material(key)
         elif building_classification == BuildingClassification.School:
             mesh_color = "brick"
         elif building_classification == BuildingClassification.MidsizedCommercial:
-            mesh_color = self.random_apartments_material()
+            mesh_color = self.random_apartments_material(key)
         elif building_classification == BuildingClassification.DowntownMiscellaneous:
-            mesh_color = self.random_apartments_material()
+            mesh_color = self.random_apartments_material(key)
         else:
-            mesh_color = self.random_apartments_material() 
+            mesh_color = self.random_apartments_material(key) 
         filtered["mesh_color"] = mesh_color
 
         # Choose a roof_color
-        filtered["roof_color"] = self.random_roof_material()
+        filtered["roof_color"] = self.random_roof_material(key)
         return filtered
+
+    def choose_random_batch(self, name_cutoff_pairs, r):
+        """
+        Vectorized version of choose_random for an array of uniform draws r.
+        """
+        names = np.array([name for name, cutoff in name_cutoff_pairs], dtype=object)
+        cutoffs = np.array([cutoff for name, cutoff in name_cutoff_pairs])
+        chosen = np.searchsorted(cutoffs, r, side='right')
+        if (chosen >= len(names)).any():
+            raise ValueError("Failed to randomly choose a material/color. Verify that the config probabilities add to 1.")
+        return names[chosen]
+
+    def random_height_batch(self, min_key, max_key, r):
+        return self.config.at[min_key] + r * (self.config.at[max_key] - self.config.at[min_key])
+
+    def classify_batch(self, columns, in_downtown, in_park, in_residential):
+        """
+        Vectorized version of the classification in filter. Returns an array
+        of BuildingClassification values.
+        """
+        tags = columns.building_tags
+        has_tall_height = columns.heights > self.config.min_skyscraper_height
+        conditions = [(tags == "house") | (tags == "garage"),\
+                (tags == "apartments") & ~in_downtown,\
+                (tags == "apartments") & in_downtown,\
+                has_tall_height,\
+                in_downtown & ~(in_park | in_residential),\
+                tags == "school",\
+                (tags == "industrial") | (tags == "warehouse") | (tags == "hospital") | (tags == "hotel"),\
+                in_residential,\
+                in_park]
+        choices = [BuildingClassification.House.value,\
+                BuildingClassification.Apartments.value,\
+                BuildingClassification.Skyscraper.value,\
+                BuildingClassification.Skyscraper.value,\
+                BuildingClassification.DowntownMiscellaneous.value,\
+                BuildingClassification.School.value,\
+                BuildingClassification.MidsizedCommercial.value,\
+                BuildingClassification.House.value,\
+                BuildingClassification.SmallNonHouse.value]
+        return np.select(conditions, choices, default=BuildingClassification.House.value)
+
+    def filter_columns(self, columns, downtown_multipolygon, park_multipolygon, residential_multipolygon):
+        """
+        Vectorized version of filter for a batch of buildings stored as
+        BuildingColumns. Returns (classifications, heights, mesh_colors,
+        roof_colors). heights is NaN wherever the building already had
+        a height (from OSM or from its levels). Every building gets the
+        same random choices that filter would give it.
+        """
+        n = len(columns.building_tags)
+        r_height = stable_uniforms(columns.keys, HEIGHT_STREAM, self.seed)
+        r_material = stable_uniforms(columns.keys, MATERIAL_STREAM, self.seed)
+        r_house_material = stable_uniforms(columns.keys, HOUSE_MATERIAL_STREAM, self.seed)
+        r_vinyl = stable_uniforms(columns.keys, VINYL_COLOR_STREAM, self.seed)
+        r_roof = stable_uniforms(columns.keys, ROOF_STREAM, self.seed)
+
+        # Check for containment in downtown, residential zones, or parks
+        in_downtown = polygon_list_contains_xy(downtown_multipolygon, columns.centroids_x, columns.centroids_y)
+        in_park = polygon_list_contains_xy(park_multipolygon, columns.centroids_x, columns.centroids_y)
+        in_residential = polygon_list_contains_xy(residential_multipolygon, columns.centroids_x, columns.centroids_y)
+        classifications = self.classify_batch(columns, in_downtown, in_park, in_residential)
+
+        # Guess the height of buildings whose height isn't known from OSM or their levels
+        House = BuildingClassification.House.value
+        Skyscraper = BuildingClassification.Skyscraper.value
+        Apartments = BuildingClassification.Apartments.value
+        School = BuildingClassification.School.value
+        MidsizedCommercial = BuildingClassification.MidsizedCommercial.value
+        DowntownMiscellaneous = BuildingClassification.DowntownMiscellaneous.value
+        # Like filter, a single level sets the height to 4 but the height still gets guessed
+        height_from_levels = ~np.isnan(columns.levels) & (columns.levels != 1)
+        needs_guess = np.isnan(columns.heights) & ~height_from_levels
+        downtown_heights = self.random_height_batch("MIN_DOWNTOWN_HEIGHT", "MAX_DOWNTOWN_HEIGHT", r_height)
+        apartments_heights = self.random_height_batch("MIN_APARTMENTS_HEIGHT", "MAX_APARTMENTS_HEIGHT", r_height)
+        house_heights = self.random_height_batch("MIN_HOUSE_HEIGHT", "MAX_HOUSE_HEIGHT", r_height)
+        guessed_heights = np.select([(classifications == Skyscraper) | (classifications == DowntownMiscellaneous),\
+                (classifications == Apartments) | (classifications == School) | (classifications == MidsizedCommercial)],\
+                [downtown_heights, apartments_heights], default=house_heights)
+        heights = np.where(needs_guess, guessed_heights, np.nan)
+        final_heights = np.where(needs_guess, guessed_heights, np.where(np.isnan(columns.heights), 3 * columns.levels, columns.heights))
+
+        # Choose a mesh_color
+        osm_acceptable_materials = ("glass", "brick", "concrete", "marble", "plaster", "metal")
+        house_materials = self.choose_random_batch(self.house_material_probs, r_house_material)
+        vinyl_colors = self.choose_random_batch(self.vinyl_color_probs, r_vinyl)
+        house_materials = np.where(house_materials == "vinyl", np.char.add("vinyl_", vinyl_colors.astype(str)), house_materials.astype(str)).astype(object)
+        mesh_colors = np.select([np.isin(columns.materials, osm_acceptable_materials),\
+                (final_heights > self.config.min_skyscraper_height) | (classifications == Skyscraper),\
+                classifications == House,\
+                classifications == School],\
+                [columns.materials,\
+                self.choose_random_batch(self.skyscraper_material_probs, r_material),\
+                house_materials,\
+                np.full(n, "brick", dtype=object)],\
+                default=self.choose_random_batch(self.apartment_material_probs, r_material))
+
+        # Choose a roof_color
+        roof_colors = self.choose_random_batch(self.roof_material_probs, r_roof)
+        return (classifications, heights, mesh_colors, roof_colors)
+
+    def filter_batch(self, pwps, downtown_multipolygon, park_multipolygon, residential_multipolygon):
+        """
+        Filter the properties of a whole batch of buildings (like a tile's)
+        at once. Returns the list of filtered properties, like calling
+        filter on each building.
+        """
+        return self.filter_polygons_batch([pwp.polygon for pwp in pwps], [pwp.properties for pwp in pwps],\
+                downtown_multipolygon, park_multipolygon, residential_multipolygon)
+
+    def filter_polygons_batch(self, polygons, properties_list, downtown_multipolygon, park_multipolygon, residential_multipolygon):
+        """
+        filter_batch for footprints and properties that are kept apart,
+        like in a FeatureStore.
+        """
+        filtered_list = [self.clean_properties(properties) for properties in properties_list]
+        columns = BuildingColumns.from_filtered_properties(polygons, filtered_list)
+        _, heights, mesh_colors, roof_colors = self.filter_columns(columns, downtown_multipolygon, park_multipolygon, residential_multipolygon)
+        for k, filtered in enumerate(filtered_list):
+            if not "height" in filtered:
+                if np.isnan(heights[k]):
+                    filtered["height"] = 3 * int(columns.levels[k])
+                else:
+                    filtered["height"] = float(heights[k])
+            filtered["mesh_color"] = str(mesh_colors[k])
+            filtered["roof_color"] = str(roof_colors[k])
+        return filtered_list
+
+class BuildingColumns:
+    """
+    The properties of a batch of buildings that PropertyFilter needs,
+    stored as arrays. Missing heights and levels are NaN, and a missing
+    material is None. keys are what the random choices are made from
+    (see random_utils.osm_id_keys).
+    """
+    def __init__(self, keys, centroids_x, centroids_y, building_tags, heights, levels, materials):
+        self.keys = keys
+        self.centroids_x = centroids_x
+        self.centroids_y = centroids_y
+        self.building_tags = building_tags
+        self.heights = heights
+        self.levels = levels
+        self.materials = materials
+
+    def from_filtered_properties(polygons, filtered_list):
+        """
+        Static method that builds the columns from footprints and
+        properties that went through PropertyFilter.clean_properties.
+        """
+        centroids = shapely.centroid(np.asarray(polygons, dtype=object))
+        n = len(filtered_list)
+        heights = np.full(n, np.nan)
+        levels = np.full(n, np.nan)
+        for k, filtered in enumerate(filtered_list):
+            if "height" in filtered:
+                heights[k] = float(filtered["height"])
+            if "levels" in filtered and filtered["levels"]:
+                try:
+                    levels[k] = int(filtered["levels"])
+                except ValueError:
+                    pass
+        centroids_x = shapely.get_x(centroids)
+        centroids_y = shapely.get_y(centroids)
+        keys = osm_id_keys([filtered.get("osm_id") for filtered in filtered_list], centroids_x, centroids_y)
+        return BuildingColumns(keys, centroids_x, centroids_y,\
+                np.array([filtered["building"] for filtered in filtered_list], dtype=object),\
+                heights, levels,\
+                np.array([filtered.get("building:material") for filtered in filtered_list], dtype=object))
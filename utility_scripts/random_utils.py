@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+
+# Deterministic, order-independent random numbers. Instead of drawing
+# from one shared generator (where a building's color depends on how many
+# buildings came before it), every random number is a hash of a stable
+# key (like an OSM id) and a stream number saying what it is used for.
+# Any subset of tiles can then be processed in any order, or in parallel,
+# and every building still gets the same values.
+
+import numpy as np
+
+# One stream per kind of random choice, so they are independent
+HEIGHT_STREAM = 1
+MATERIAL_STREAM = 2
+HOUSE_MATERIAL_STREAM = 3
+VINYL_COLOR_STREAM = 4
+ROOF_STREAM = 5
+AUTUMN_STREAM = 6
+TREE_MODEL_STREAM = 7
+TREE_LOD_STREAM = 8
+
+def splitmix64(x):
+    """
+    The splitmix64 finalizer, vectorized over a uint64 array.
+    """
+    # Overflow is expected, the arithmetic wraps around
+    with np.errstate(over='ignore'):
+        x = np.asarray(x, dtype=np.uint64) + np.uint64(0x9E3779B97F4A7C15)
+        x = (x ^ (x >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+        x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+        return x ^ (x >> np.uint64(31))
+
+def stable_uniforms(keys, stream, seed=1):
+    """
+    Return one uniform number in [0, 1) for every key. The same key,
+    stream and seed always give the same number.
+    """
+    keys = np.asarray(keys, dtype=np.uint64)
+    salt = splitmix64(splitmix64(seed) ^ np.uint64(stream))
+    hashed = splitmix64(keys ^ salt)
+    return (hashed >> np.uint64(11)).astype(float) * (1. / 2 ** 53)
+
+def point_keys(xs, ys):
+    """
+    Stable keys for points, from their coordinates rounded to the centimeter.
+    """
+    xs = np.round(np.asarray(xs, dtype=float) * 100).astype(np.int64).view(np.uint64)
+    ys = np.round(np.asarray(ys, dtype=float) * 100).astype(np.int64).view(np.uint64)
+    return splitmix64(splitmix64(xs) ^ ys)
+
+def osm_id_keys(osm_ids, xs, ys):
+    """
+    Stable keys for buildings. The OSM id is used when there is one, and
+    otherwise the key comes from the building's centroid.
+    """
+    keys = point_keys(xs, ys)
+    for k, osm_id in enumerate(osm_ids):
+        if osm_id is not None:
+            try:
+                keys[k] = np.int64(int(osm_id)).view(np.uint64)
+            except (ValueError, OverflowError):
+                pass
+    return keys
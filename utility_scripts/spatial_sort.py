@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+
+# Order features and tiles along a space-filling curve, so work that goes
+# through them in order moves across the city in a compact front instead
+# of jumping between far away tiles.
+
+import numpy as np
+import shapely
+
+from geojson_utils import *
+from polygon_utils import *
+from tile_id import *
+
+# The choices of --spatial-sort
+SPATIAL_SORT_CURVES = ["none", "hilbert", "morton"]
+
+def morton_keys(cell_is, cell_js):
+    """
+    The Morton (Z-order) index of cells, made by interleaving
+    the bits of their non-negative coordinates.
+    """
+    cell_is = np.asarray(cell_is, dtype=np.int64)
+    cell_js = np.asarray(cell_js, dtype=np.int64)
+    keys = np.zeros(len(cell_is), dtype=np.int64)
+    for bit in range(31):
+        keys |= ((cell_is >> bit) & 1) << (2 * bit)
+        keys |= ((cell_js >> bit) & 1) << (2 * bit + 1)
+    return keys
+
+def hilbert_keys(cell_is, cell_js):
+    """
+    The index of cells along a Hilbert curve over the smallest power of 2
+    grid that holds their non-negative coordinates. Unlike Morton order,
+    cells next to each other on the curve are always neighbors.
+    """
+    x = np.array(cell_is, dtype=np.int64)
+    y = np.array(cell_js, dtype=np.int64)
+    keys = np.zeros(len(x), dtype=np.int64)
+    if len(x) == 0:
+        return keys
+    n = 1
+    while n <= max(x.max(), y.max()):
+        n *= 2
+    s = n // 2
+    while s > 0:
+        rx = (x & s) > 0
+        ry = (y & s) > 0
+        keys += s * s * ((3 * rx) ^ ry)
+        # Rotate the quadrant so the curve inside of it starts and ends in the right places
+        flip = ~ry & rx
+        x = np.where(flip, n - 1 - x, x)
+        y = np.where(flip, n - 1 - y, y)
+        x, y = np.where(~ry, y, x), np.where(~ry, x, y)
+        s //= 2
+    return keys
+
+def spatial_sort_order(xs, ys, cell_size, curve):
+    """
+    The order (as indices) that sorts points along a curve through cells
+    of cell_size. Points in the same cell keep their order, and points
+    without coordinates (NaN) go last.
+    """
+    xs = np.asarray(xs, dtype=float)
+    ys = np.asarray(ys, dtype=float)
+    if curve == "none" or len(xs) == 0:
+        return np.arange(len(xs))
+    valid = np.isfinite(xs) & np.isfinite(ys)
+    cell_is = np.floor(np.where(valid, xs, 0.) / cell_size).astype(np.int64)
+    cell_js = np.floor(np.where(valid, ys, 0.) / cell_size).astype(np.int64)
+    if valid.any():
+        cell_is -= cell_is[valid].min()
+        cell_js -= cell_js[valid].min()
+    cell_is[~valid] = 0
+    cell_js[~valid] = 0
+    if curve == "hilbert":
+        keys = hilbert_keys(cell_is, cell_js)
+    elif curve == "morton":
+        keys = morton_keys(cell_is, cell_js)
+    else:
+        raise ValueError("Unknown spatial sort curve %s." % (curve))
+    keys[~valid] = np.iinfo(np.int64).max
+    return np.argsort(keys, kind='stable')
+
+def geojson_feature_centers(geojson_features, zone, offset):
+    """
+    The point that decides each feature's tile, in UTM (plus offset), as
+    an (n, 2) array. This is the centroid of the feature's first part,
+    which is the point the mappers put a polygon or point in a tile by.
+    Features without a usable geometry get NaN.
+    """
+    centers = np.full((len(geojson_features), 2), np.nan)
+    feature_indices = [k for k, geojson_feature in enumerate(geojson_features)\
+            if geojson_feature.geometry is not None and geojson_feature.geometry["type"] in GEOJSON_TYPE_TO_PART_KIND]
+    if len(feature_indices) == 0:
+        return centers
+    geometries, part_features = geojson_features_to_shapely_array([geojson_features[k] for k in feature_indices], zone, offset)
+    keep = ~shapely.is_empty(geometries)
+    geometries = geometries[keep]
+    part_features = part_features[keep]
+    first_parts = np.unique(part_features, return_index=True)[1]
+    centroids = shapely.centroid(geometries[first_parts])
+    rows = np.array(feature_indices, dtype=np.int64)[part_features[first_parts]]
+    centers[rows, 0] = shapely.get_x(centroids)
+    centers[rows, 1] = shapely.get_y(centroids)
+    return centers
+
+def sort_features_spatially(geojson_features, zone, offset, curve):
+    """
+    Sort geojson features along a curve through the tiles their centers
+    are in. Features in the same tile keep their order, so a tile whose
+    features all have their center in it gets them in the same order.
+    A feature with parts in several tiles is sorted by its first part,
+    so it can move relative to the other features of its other tiles.
+    """
+    if curve == "none":
+        return geojson_features
+    centers = geojson_feature_centers(geojson_features, zone, offset)
+    order = spatial_sort_order(centers[:, 0], centers[:, 1], TileID.TILE_SIZE, curve)
+    return [geojson_features[k] for k in order]
+
+def sort_tile_keys(tile_keys, curve):
+    """
+    Sort (i, j) tile keys along a curve.
+    """
+    if len(tile_keys) == 0:
+        return tile_keys
+    tile_array = np.array(tile_keys, dtype=float)
+    order = spatial_sort_order(tile_array[:, 0], tile_array[:, 1], 1, curve)
+    return [tile_keys[k] for k in order]
@@ -0,0 +1,282 @@
+#!/usr/bin/env python3
+
+# Level-of-detail terrain meshes. This is a vectorized version of the
+# right-triangulated irregular network (RTIN) scheme used by MARTINI:
+# the tile is recursively split into right triangles, and a triangle is
+# only split when the DEM deviates from it by more than a max error.
+
+import numpy as np
+import os
+
+from file_utils import *
+from tile_id import *
+
+# Where shared terrain edges are kept, inside the city directory
+TERRAIN_EDGE_DIRECTORY_NAME = ".terrain_edges"
+
+def edge_stride(values, max_error):
+    """
+    The coarsest power of 2 stride along a tile edge (a 1D array of
+    2^k + 1 heights) where linearly interpolating between every stride-th
+    height is within max_error of all the heights. It only depends on the
+    edge, so the two tiles sharing an edge pick the same stride.
+    """
+    values = np.asarray(values, dtype=float)
+    positions = np.arange(len(values))
+    stride = len(values) - 1
+    while stride > 1:
+        approximation = np.interp(positions, positions[::stride], values[::stride])
+        if np.abs(approximation - values).max() <= max_error:
+            break
+        stride //= 2
+    return stride
+
+def snap_edges(heights, strides):
+    """
+    Replace the heights along each edge of a (grid_size, grid_size) grid
+    (indexed [y, x]) with the line between every stride-th height. strides
+    are for the edges at y = 0, y = max, x = 0, and x = max.
+    """
+    positions = np.arange(heights.shape[0])
+    snapped = np.array(heights, dtype=float)
+    for index, stride in zip([(0, slice(None)), (-1, slice(None)), (slice(None), 0), (slice(None), -1)], strides):
+        edge = snapped[index]
+        snapped[index] = np.interp(positions, positions[::stride], edge[::stride])
+    return snapped
+
+class RtinTerrain:
+    """
+    Precomputes the triangle hierarchy for a square grid of
+    grid_size x grid_size samples, where grid_size is 2^k + 1.
+    """
+    def __init__(self, grid_size):
+        tile_size = grid_size - 1
+        if tile_size < 2 or tile_size & (tile_size - 1) != 0:
+            raise ValueError("RTIN grid size must be 2^k + 1, got %d." % (grid_size))
+        self.grid_size = grid_size
+        self.tile_size = tile_size
+
+        # Compute the corners of every triangle in the hierarchy. Triangle i has
+        # id i + 2, and the bits of the id describe the path from the root.
+        num_triangles = tile_size * tile_size * 2 - 2
+        ids = np.arange(num_triangles, dtype=np.int64) + 2
+        odd = (ids & 1) == 1
+        ax = np.where(odd, 0, tile_size)
+        ay = np.where(odd, 0, tile_size)
+        bx = np.where(odd, tile_size, 0)
+        by = np.where(odd, tile_size, 0)
+        cx = np.where(odd, tile_size, 0)
+        cy = np.where(odd, 0, tile_size)
+        # The level of a triangle is the number of bits in its id
+        self.levels = np.floor(np.log2(ids)).astype(np.int64)
+        remaining = ids >> 1
+        while True:
+            active = remaining > 1
+            if not active.any():
+                break
+            mx = (ax + bx) >> 1
+            my = (ay + by) >> 1
+            left = active & ((remaining & 1) == 1)
+            right = active & ((remaining & 1) == 0)
+            new_ax = np.where(left, cx, np.where(right, bx, ax))
+            new_ay = np.where(left, cy, np.where(right, by, ay))
+            new_bx = np.where(left, ax, np.where(right, cx, bx))
+            new_by = np.where(left, ay, np.where(right, cy, by))
+            cx = np.where(active, mx, cx)
+            cy = np.where(active, my, cy)
+            ax, ay, bx, by = new_ax, new_ay, new_bx, new_by
+            remaining = np.where(active, remaining >> 1, remaining)
+        self.ax, self.ay, self.bx, self.by = ax, ay, bx, by
+
+    def border_masks(self, strides):
+        """
+        Masks of the grid's border vertices that are on every stride-th
+        sample of their edge (kept), and the rest of the border vertices.
+        strides are for the edges at y = 0, y = max, x = 0, and x = max.
+        """
+        size = self.grid_size
+        kept = np.zeros((size, size), dtype=bool)
+        border = np.zeros((size, size), dtype=bool)
+        for index, stride in zip([(0, slice(None)), (-1, slice(None)), (slice(None), 0), (slice(None), -1)], strides):
+            border[index] = True
+            on_stride = np.zeros(size, dtype=bool)
+            on_stride[::stride] = True
+            kept[index] |= on_stride
+        return kept.ravel(), (border & ~kept).ravel()
+
+    def compute_errors(self, heights, strides=None):
+        """
+        heights is a (grid_size, grid_size) array indexed [y, x]. Returns the
+        error at every grid vertex, propagated up the hierarchy so that
+        splitting a triangle always splits its parents too.
+
+        If strides are given (for the edges at y = 0, y = max, x = 0, and
+        x = max), every stride-th vertex of each edge is always kept, and
+        the other edge vertices are only added when the triangles inside
+        the tile need them. Their own error doesn't count, since they are
+        meant to sit on the line between the kept ones (see snap_edges),
+        so neighboring tiles with the same strides don't crack.
+        """
+        terrain = np.asarray(heights, dtype=float).ravel()
+        size = self.grid_size
+        errors = np.zeros(size * size)
+        own_error_counts = np.ones(size * size, dtype=bool)
+        if strides is not None:
+            kept, snapped = self.border_masks(strides)
+            errors[kept] = np.inf
+            own_error_counts[snapped] = False
+        max_level = self.levels.max()
+        for level in range(max_level, 0, -1):
+            at_level = self.levels == level
+            ax, ay, bx, by = self.ax[at_level], self.ay[at_level], self.bx[at_level], self.by[at_level]
+            mx = (ax + bx) >> 1
+            my = (ay + by) >> 1
+            middle_index = my * size + mx
+            interpolated_height = (terrain[ay * size + ax] + terrain[by * size + bx]) / 2
+            own_errors = np.where(own_error_counts[middle_index], np.abs(interpolated_height - terrain[middle_index]), 0.)
+            np.maximum.at(errors, middle_index, own_errors)
+            if level < max_level:
+                cx = mx + my - ay
+                cy = my + ax - mx
+                left_child_index = ((ay + cy) >> 1) * size + ((ax + cx) >> 1)
+                right_child_index = ((by + cy) >> 1) * size + ((bx + cx) >> 1)
+                np.maximum.at(errors, middle_index, np.maximum(errors[left_child_index], errors[right_child_index]))
+        return errors
+
+    def extract_mesh(self, errors, max_error):
+        """
+        Returns (vertex_indices, faces), where vertex_indices are the grid
+        indices (y * grid_size + x) of the vertices used by the mesh and
+        faces index into vertex_indices. Faces are counterclockwise in
+        grid coordinates.
+        """
+        size = self.grid_size
+        t = self.tile_size
+        # The two root triangles (a, b, c), where c is the right angle
+        frontier = np.array([[0, 0, t, t, t, 0], [t, t, 0, 0, 0, t]], dtype=np.int64)
+        finished = []
+        while len(frontier) > 0:
+            ax, ay, bx, by, cx, cy = frontier.T
+            mx = (ax + bx) >> 1
+            my = (ay + by) >> 1
+            split = (np.abs(ax - cx) + np.abs(ay - cy) > 1) & (errors[my * size + mx] > max_error)
+            finished.append(frontier[~split])
+            s = split
+            frontier = np.vstack((np.column_stack((cx[s], cy[s], ax[s], ay[s], mx[s], my[s])),\
+                    np.column_stack((bx[s], by[s], cx[s], cy[s], mx[s], my[s]))))
+        triangles = np.vstack(finished)
+
+        corners = np.column_stack((triangles[:, 1] * size + triangles[:, 0],\
+                triangles[:, 3] * size + triangles[:, 2],\
+                triangles[:, 5] * size + triangles[:, 4]))
+        ax, ay, bx, by, cx, cy = triangles.T
+        clockwise = (bx - ax) * (cy - ay) - (cx - ax) * (by - ay) < 0
+        corners[clockwise] = corners[clockwise][:, [0, 2, 1]]
+
+        vertex_indices, faces = np.unique(corners, return_inverse=True)
+        return vertex_indices, faces.reshape(-1, 3)
+
+class TerrainEdgeCache:
+    """
+    The elevations along the edges between tiles, shared by every tile
+    that touches them. The first tile to sample an edge writes it, and
+    the tiles built after it (in this run or a later one, in any order,
+    from any process) use the same elevations, so neighboring tiles always
+    meet exactly. Each DEM gets its own directory, so a changed DEM never
+    reuses the edges of the old one.
+
+    Vertical edge (i, j) is the west edge of tile (i, j), and horizontal
+    edge (i, j) is its south edge. Edges are stored per number of samples.
+    """
+    def __init__(self, city_directory, source_key):
+        self.directory = os.path.join(city_directory, TERRAIN_EDGE_DIRECTORY_NAME, source_key)
+        os.makedirs(self.directory, exist_ok=True)
+
+    def edge_path(self, direction, i, j, num_samples):
+        return os.path.join(self.directory, "%s_%d_%d_%d.npy" % (direction, i, j, num_samples))
+
+    def get_edge(self, direction, i, j, values):
+        """
+        The stored values of an edge, storing values first if the edge
+        doesn't have any yet.
+        """
+        filepath = self.edge_path(direction, i, j, len(values))
+        if not os.path.exists(filepath):
+            f = AtomicFile(filepath, 'wb')
+            np.save(f, np.asarray(values, dtype=float))
+            if f.commit_if_absent():
+                return values
+        return np.load(filepath)
+
+    def apply(self, tile, heights):
+        """
+        Replace the border of a tile's height grid (indexed [y, x]) with
+        the shared edges.
+        """
+        i, j = tile.i, tile.j
+        heights[:, 0] = self.get_edge("v", i, j, heights[:, 0])
+        heights[:, -1] = self.get_edge("v", i + 1, j, heights[:, -1])
+        heights[0, :] = self.get_edge("h", i, j, heights[0, :])
+        heights[-1, :] = self.get_edge("h", i, j + 1, heights[-1, :])
+        return heights
+
+def sample_terrain_grid(dem, tile, grid_size, edge_cache=None):
+    """
+    Sample the DEM on a grid_size x grid_size grid covering the tile.
+    The result is indexed [y, x]. If an edge_cache is given, the
+    border comes from it.
+    """
+    sw_x, sw_y = tile.sw_corner()
+    local = np.linspace(0, TileID.TILE_SIZE, grid_size)
+    local_x, local_y = np.meshgrid(local, local)
+    heights = dem.interpolate_many(sw_x + local_x, sw_y + local_y).reshape(grid_size, grid_size)
+    if edge_cache is not None:
+        edge_cache.apply(tile, heights)
+    return heights
+
+def terrain_lod_meshes(dem, tile, grid_size, max_errors, edge_cache=None):
+    """
+    Build one simplified terrain mesh per entry of max_errors. LOD k is
+    built from a grid that is 2^k times coarser than grid_size. Its edges
+    are simplified with edge_stride, so neighboring tiles at the same LOD
+    meet without cracks. Each mesh is (vertices, uvs, faces)
+    with vertices in the tile's local OBJ coordinates and 0-based faces.
+    """
+    heights = sample_terrain_grid(dem, tile, grid_size, edge_cache)
+    meshes = []
+    for lod, max_error in enumerate(max_errors):
+        stride = 2 ** lod
+        lod_heights = heights[::stride, ::stride]
+        lod_grid_size = lod_heights.shape[0]
+        # Each edge is simplified on its own, so the tile on the other side of
+        # it makes the same choice, and the vertices the inside of the tile
+        # adds to an edge are moved onto it
+        strides = [edge_stride(edge, max_error) for edge in (lod_heights[0, :], lod_heights[-1, :], lod_heights[:, 0], lod_heights[:, -1])]
+        rtin = RtinTerrain(lod_grid_size)
+        errors = rtin.compute_errors(lod_heights, strides)
+        vertex_indices, faces = rtin.extract_mesh(errors, max_error)
+        lod_heights = snap_edges(lod_heights, strides)
+
+        grid_y, grid_x = np.divmod(vertex_indices, lod_grid_size)
+        local_x = grid_x * TileID.TILE_SIZE / (lod_grid_size - 1)
+        local_y = grid_y * TileID.TILE_SIZE / (lod_grid_size - 1)
+        # The z (y) coordinate is flipped, like in the uniform terrain grid
+        vertices = np.column_stack((local_x, lod_heights.ravel()[vertex_indices], TileID.TILE_SIZE - local_y))
+        uvs = np.column_stack((local_x / TileID.TILE_SIZE, local_y / TileID.TILE_SIZE))
+        meshes.append((vertices, uvs, faces))
+    return meshes
+
+def write_terrain_mesh(f, vertices, uvs, faces, material_name):
+    """
+    Write a terrain mesh to an open OBJ file. Vertex i uses UV i, so this
+    must be the first thing in the file after the header.
+    """
+    f.write("# Terrain vertices\n")
+    lines = np.empty((len(vertices), 5))
+    lines[:, :3] = vertices
+    lines[:, 3:] = uvs
+    f.write(("v    %.6f    %.6f    %.6f\nvt    %.6f    %.6f\n" * len(vertices)) % tuple(lines.ravel()))
+    f.write("g terrain\n")
+    f.write("usemtl %s\n" % (material_name))
+    one_based = np.repeat(faces + 1, 2, axis=1)
+    f.write(("f %d/%d %d/%d %d/%d\n" * len(faces)) % tuple(one_based.ravel()))
@@ -1,49 +1,402 @@
 #!/usr/bin/env python3
 
 from geotiff import GeoTiff
+import collections
+import hashlib
+import json
 import numpy as np
+import os
+
+from configuration import *
+from tile_id import *
+
+def dem_window(min_x, min_y, res_x, res_y, cols, rows, tile, buffer):
+    """
+    The (i_min, i_max, j_min, j_max) block of raster samples (max excluded)
+    that covers a tile, plus buffer samples on every side. Every point
+    in the tile interpolates between samples inside of the block. Tiles
+    outside of the raster get the block at its nearest edge, since that
+    is what their points are clamped to.
+    """
+    sw_x, sw_y = tile.sw_corner()
+    i_corners = [min(max(int(np.floor((x - min_x) / res_x)), 0), max(cols - 2, 0)) for x in (sw_x, sw_x + TileID.TILE_SIZE)]
+    j_corners = [min(max(int(np.floor((y - min_y) / res_y)), 0), max(rows - 2, 0)) for y in (sw_y, sw_y + TileID.TILE_SIZE)]
+    i_min = max(min(i_corners) - buffer, 0)
+    i_max = min(max(i_corners) + 1 + buffer + 1, cols)
+    j_min = max(min(j_corners) - buffer, 0)
+    j_max = min(max(j_corners) + 1 + buffer + 1, rows)
+    return i_min, i_max, j_min, j_max
+
+def files_source_key(filepaths, extra=None):
+    """
+    A short key that changes whenever one of the files (or extra) does,
+    for naming caches of things computed from the files.
+    """
+    description = []
+    for filepath in filepaths:
+        stat = os.stat(filepath)
+        description.append([os.path.abspath(filepath), stat.st_size, stat.st_mtime_ns])
+    return hashlib.sha256(json.dumps([description, extra]).encode()).hexdigest()[:16]
+
+def fill_nearest_along_rows(array, missing):
+    """
+    Replace the missing values of each row of a 2D array with the
+    nearest value in the same row that isn't missing.
+    """
+    num_cols = array.shape[1]
+    positions = np.broadcast_to(np.arange(num_cols), array.shape)
+    before = np.maximum.accumulate(np.where(missing, -1, positions), axis=1)
+    after = np.minimum.accumulate(np.where(missing, num_cols, positions)[:, ::-1], axis=1)[:, ::-1]
+    distance_before = np.where(before >= 0, positions - before, num_cols + 1)
+    distance_after = np.where(after < num_cols, after - positions, num_cols + 1)
+    nearest = np.where(distance_before <= distance_after, before, after)
+    fillable = missing & (np.minimum(distance_before, distance_after) <= num_cols)
+    rows = np.broadcast_to(np.arange(array.shape[0])[:, np.newaxis], array.shape)
+    filled = array.copy()
+    filled[fillable] = array[rows[fillable], nearest[fillable]]
+    return filled, missing & ~fillable
+
+def fill_nodata(array, nodata=None):
+    """
+    Fill the missing samples of a raster with the nearest sample along its
+    row, or along its column for rows that are entirely missing. NaNs,
+    huge negative values (the float32 minimum some DEMs use), and nodata
+    count as missing. Anything still missing is left as NaN.
+    """
+    array = np.asarray(array, dtype=float)
+    missing = ~np.isfinite(array) | (array < -1e30)
+    if nodata is not None:
+        missing |= array == nodata
+    if not missing.any():
+        return array
+    array, missing = fill_nearest_along_rows(array, missing)
+    if missing.any():
+        filled, missing = fill_nearest_along_rows(array.T, missing.T)
+        array, missing = filled.T, missing.T
+    array[missing] = np.nan
+    return array
 
 class GeoTiffInterpolater:
     """
     This class opens a GeoTiff file and has access methods to
     perform bilinear interpolation. The CRS of the tif must
     be the same UTM zone that the city is in.
+
+    Missing samples are filled in with the nearest sample, and points
+    outside of the raster get the elevation of its nearest edge, so the
+    terrain never drops to 0.
     """
-    def __init__(self, filepath):
+    def __init__(self, filepath, nodata=None):
         self.geo_tiff = GeoTiff(filepath)
+        self.source_key = files_source_key([filepath], nodata)
         self.min_x, self.min_y = self.geo_tiff.tif_bBox[0]
         self.max_x, self.max_y = self.geo_tiff.tif_bBox[1]
         # TODO why is this transpose needed?
-        self.array = np.array(self.geo_tiff.read()).transpose()
+        self.array = fill_nodata(np.array(self.geo_tiff.read()).transpose(), nodata)
         self.cols, self.rows = self.array.shape
         self.res_x = (self.max_x - self.min_x) / self.cols
         self.res_y = (self.max_y - self.min_y) / self.rows
 
     def interpolate(self, x, y):
-        i_below = int((x - self.min_x) / self.res_x)
+        return float(self.interpolate_many(np.array([x]), np.array([y]))[0])
+
+    def corner_values(self, xs, ys, i_below, j_below):
+        """
+        The raster values at (i_below, j_below), (i_below + 1, j_below),
+        (i_below + 1, j_below + 1), and (i_below, j_below + 1). NaN means
+        there is no value.
+        """
         i_above = i_below + 1
-        j_below = int((y - self.min_y) / self.res_y)
         j_above = j_below + 1
+        return self.array[i_below, j_below], self.array[i_above, j_below], self.array[i_above, j_above], self.array[i_below, j_above]
+
+    def interpolate_many(self, xs, ys):
+        """
+        Bilinear interpolation at arrays of x and y. The result only
+        depends on the point, so neighboring tiles that sample the
+        same point get the same elevation.
+        """
+        shape = np.shape(xs)
+        xs = np.asarray(xs, dtype=float).ravel()
+        ys = np.asarray(ys, dtype=float).ravel()
+        grid_xs = (xs - self.min_x) / self.res_x
+        grid_ys = (ys - self.min_y) / self.res_y
 
-        # If out of bounds, return 0
-        if i_below < 0 or i_above >= self.cols or j_below < 0 or j_above >= self.rows:
-            return 0
+        # Clamp points outside of the raster to its edge
+        i_below = np.clip(np.floor(grid_xs), 0, max(self.cols - 2, 0)).astype(np.int64)
+        j_below = np.clip(np.floor(grid_ys), 0, max(self.rows - 2, 0)).astype(np.int64)
+        t_x = np.clip(grid_xs - i_below, 0., 1.)
+        t_y = np.clip(grid_ys - j_below, 0., 1.)
 
         # Access the 4 values we are interpolating between
-        sw = self.array[i_below, j_below]
-        se = self.array[i_above, j_below]
-        ne = self.array[i_above, j_above]
-        nw = self.array[i_below, j_above]
-
-        # Determine how far the point is from the raster grid
-        dist_x_below = abs(x - (self.min_x + self.res_x * i_below))
-        dist_x_above = abs(x - (self.min_x + self.res_x * i_above))
-        dist_y_below = abs(y - (self.min_y + self.res_y * j_below))
-        dist_y_above = abs(y - (self.min_y + self.res_y * j_above))
-
-        # Interpolate along the x-axis
-        interpolated_x_above = nw * dist_x_below / abs(self.res_x) + ne * dist_x_above / abs(self.res_x)
-        interpolated_x_below = sw * dist_x_below / abs(self.res_x) + se * dist_x_above / abs(self.res_x)
-
-        # Interpolate between those two values along the y-axis
-        return interpolated_x_above * dist_y_above / abs(self.res_y) + interpolated_x_below * dist_y_below / abs(self.res_y)
+        values = np.array(self.corner_values(xs, ys, i_below, j_below), dtype=float)
+        weights = np.array(((1 - t_x) * (1 - t_y), t_x * (1 - t_y), t_x * t_y, (1 - t_x) * t_y))
+        interpolated = (values * weights).sum(axis=0)
+
+        # If some of the 4 values are missing, use the others
+        has_value = ~np.isnan(values)
+        partial = has_value.any(axis=0) & ~has_value.all(axis=0)
+        if partial.any():
+            values = np.where(has_value, values, 0.)[:, partial]
+            weights = np.where(has_value, weights, 0.)[:, partial]
+            total_weight = weights.sum(axis=0)
+            average = values.sum(axis=0) / has_value[:, partial].sum(axis=0)
+            interpolated[partial] = np.where(total_weight > 1e-9, (values * weights).sum(axis=0) / np.maximum(total_weight, 1e-9), average)
+
+        # If all of them are, use the nearest value there is
+        none = ~has_value.any(axis=0)
+        if none.any():
+            interpolated[none] = np.nan_to_num(self.nearest_values(xs[none], ys[none], i_below[none], j_below[none]))
+        return interpolated.reshape(shape)
+
+    def nearest_values(self, xs, ys, i_below, j_below):
+        """
+        For points whose 4 values are all missing, the value of a nearby
+        sample that has one. The search goes outward along the point's
+        row and column in doubling steps, so it stays fast over big holes.
+        NaN if nothing was found.
+        """
+        values = np.full(len(xs), np.nan)
+        step = 1
+        while step < 2 * max(self.cols, self.rows) and np.isnan(values).any():
+            for step_i, step_j in ((-step, 0), (step, 0), (0, -step), (0, step)):
+                missing = np.isnan(values)
+                if not missing.any():
+                    break
+                shifted_i = np.clip(i_below[missing] + step_i, 0, max(self.cols - 2, 0))
+                shifted_j = np.clip(j_below[missing] + step_j, 0, max(self.rows - 2, 0))
+                shifted_xs = xs[missing] + step_i * self.res_x
+                shifted_ys = ys[missing] + step_j * self.res_y
+                corners = np.array(self.corner_values(shifted_xs, shifted_ys, shifted_i, shifted_j), dtype=float)
+                found = np.full(len(shifted_xs), np.nan)
+                for corner in corners:
+                    found = np.where(np.isnan(found), corner, found)
+                values[missing] = found
+            step *= 2
+        return values
+
+    def read_block(self, i_min, i_max, j_min, j_max, step=1):
+        """
+        The block of samples [i_min, i_max) x [j_min, j_max) of the raster
+        that keeps every step-th sample of this one.
+        """
+        return self.array[i_min * step:i_max * step:step, j_min * step:j_max * step:step]
+
+class GeoTiffMosaicInterpolater(GeoTiffInterpolater):
+    """
+    Interpolates over many GeoTIFFs as if they were one big raster on the
+    grid of the first one, so interpolation works across the seams between
+    them. Only the rasters that a query needs are read, and at most
+    max_open of them are kept in memory. Rasters that aren't aligned with
+    the first one's grid are sampled at their nearest sample. Places no
+    raster covers have no value, and get the values of the nearest samples
+    that do when interpolating.
+    """
+    # Size (in samples) of the cells of the index over the rasters
+    INDEX_CELL_SIZE = 256
+
+    def __init__(self, filepaths, max_open=8, nodata=None):
+        self.filepaths = filepaths
+        self.nodata = nodata
+        self.source_key = files_source_key(filepaths, nodata)
+        self.max_open = max_open
+        self.arrays = collections.OrderedDict()
+
+        # Read the extent of every raster, without reading the rasters
+        self.bounds = []
+        for filepath in filepaths:
+            geo_tiff = GeoTiff(filepath)
+            x_min, y_min = geo_tiff.tif_bBox[0]
+            x_max, y_max = geo_tiff.tif_bBox[1]
+            rows, cols = geo_tiff.tif_shape[:2]
+            self.bounds.append((x_min, y_min, (x_max - x_min) / cols, (y_max - y_min) / rows, cols, rows))
+
+        # Put the mosaic on the grid of the first raster, extended to cover all of them
+        first_x, first_y, self.res_x, self.res_y, _, _ = self.bounds[0]
+        start_xs = [x_min for x_min, _, _, _, _, _ in self.bounds]
+        end_xs = [x_min + res_x * cols for x_min, _, res_x, _, cols, _ in self.bounds]
+        start_ys = [y_min for _, y_min, _, _, _, _ in self.bounds]
+        end_ys = [y_min + res_y * rows for _, y_min, _, res_y, _, rows in self.bounds]
+        self.min_x = first_x + self.res_x * np.floor(min((x - first_x) / self.res_x for x in start_xs + end_xs) + 1e-6)
+        self.min_y = first_y + self.res_y * np.floor(min((y - first_y) / self.res_y for y in start_ys + end_ys) + 1e-6)
+        self.cols = int(np.ceil(max((x - self.min_x) / self.res_x for x in start_xs + end_xs) - 1e-6))
+        self.rows = int(np.ceil(max((y - self.min_y) / self.res_y for y in start_ys + end_ys) - 1e-6))
+        self.max_x = self.min_x + self.res_x * self.cols
+        self.max_y = self.min_y + self.res_y * self.rows
+
+        # Index the rasters by the cells of the mosaic's grid they overlap
+        self.cell_to_rasters = collections.defaultdict(list)
+        for raster_index in range(len(self.bounds)):
+            i_start, i_end = sorted(((x - self.min_x) / self.res_x for x in (start_xs[raster_index], end_xs[raster_index])))
+            j_start, j_end = sorted(((y - self.min_y) / self.res_y for y in (start_ys[raster_index], end_ys[raster_index])))
+            for cell_i in range(int(i_start) // self.INDEX_CELL_SIZE, int(np.ceil(i_end)) // self.INDEX_CELL_SIZE + 1):
+                for cell_j in range(int(j_start) // self.INDEX_CELL_SIZE, int(np.ceil(j_end)) // self.INDEX_CELL_SIZE + 1):
+                    self.cell_to_rasters[(cell_i, cell_j)].append(raster_index)
+
+        first_res_x, first_res_y = self.res_x, self.res_y
+        if any(abs(res_x - first_res_x) > 1e-6 * abs(first_res_x) or abs(res_y - first_res_y) > 1e-6 * abs(first_res_y)\
+                for _, _, res_x, res_y, _, _ in self.bounds):
+            print("Warning: the DEM rasters have different resolutions. They are resampled to the first one's.")
+
+    def get_array(self, raster_index):
+        if raster_index in self.arrays:
+            self.arrays.move_to_end(raster_index)
+            return self.arrays[raster_index]
+        # TODO why is this transpose needed?
+        array = fill_nodata(np.array(GeoTiff(self.filepaths[raster_index]).read()).transpose(), self.nodata)
+        self.arrays[raster_index] = array
+        while len(self.arrays) > max(self.max_open, 1):
+            self.arrays.popitem(last=False)
+        return array
+
+    def sample_values(self, sample_is, sample_js):
+        """
+        The values of the mosaic's samples (sample_is[k], sample_js[k]),
+        or NaN where no raster covers them.
+        """
+        values = np.full(len(sample_is), np.nan)
+        filled = np.zeros(len(sample_is), dtype=bool)
+        cells = set(zip((sample_is // self.INDEX_CELL_SIZE).tolist(), (sample_js // self.INDEX_CELL_SIZE).tolist()))
+        candidates = sorted(set(raster_index for cell in cells for raster_index in self.cell_to_rasters.get(cell, [])))
+        xs = self.min_x + self.res_x * sample_is
+        ys = self.min_y + self.res_y * sample_js
+        for raster_index in candidates:
+            x_min, y_min, res_x, res_y, cols, rows = self.bounds[raster_index]
+            local_is = np.rint((xs - x_min) / res_x).astype(np.int64)
+            local_js = np.rint((ys - y_min) / res_y).astype(np.int64)
+            inside = ~filled & (local_is >= 0) & (local_is < cols) & (local_js >= 0) & (local_js < rows)
+            if not inside.any():
+                continue
+            array = self.get_array(raster_index)
+            values[inside] = array[local_is[inside], local_js[inside]]
+            filled |= inside
+        return values
+
+    def corner_values(self, xs, ys, i_below, j_below):
+        n = len(i_below)
+        values = self.sample_values(np.concatenate((i_below, i_below + 1, i_below + 1, i_below)),\
+                np.concatenate((j_below, j_below, j_below + 1, j_below + 1)))
+        return values[:n], values[n:2 * n], values[2 * n:3 * n], values[3 * n:]
+
+    def read_block(self, i_min, i_max, j_min, j_max, step=1):
+        # Samples no raster covers get what interpolating there gives
+        sample_is, sample_js = np.meshgrid(np.arange(i_min, i_max) * step, np.arange(j_min, j_max) * step, indexing='ij')
+        block = self.sample_values(sample_is.ravel(), sample_js.ravel()).reshape(sample_is.shape)
+        missing = np.isnan(block)
+        if missing.any():
+            block[missing] = self.interpolate_many(self.min_x + self.res_x * sample_is[missing], self.min_y + self.res_y * sample_js[missing])
+        return block
+
+def open_dem(dem_paths, nodata=None):
+    """
+    Open a DEM that is one GeoTIFF, or a mosaic of several. dem_paths
+    can have GeoTIFFs and directories of them. Samples equal to nodata
+    are treated as missing.
+    """
+    filepaths = []
+    for path in dem_paths:
+        if os.path.isdir(path):
+            filepaths.extend(sorted(os.path.join(path, name) for name in os.listdir(path) if name.lower().endswith((".tif", ".tiff"))))
+        else:
+            filepaths.append(path)
+    if len(filepaths) == 1:
+        return GeoTiffInterpolater(filepaths[0], nodata)
+    return GeoTiffMosaicInterpolater(filepaths, nodata=nodata)
+
+class DemTileInterpolater(GeoTiffInterpolater):
+    """
+    Interpolates the same way as GeoTiffInterpolater, but reads the DEM
+    from the per-tile arrays that cut_dem_into_tiles.py writes into the
+    city's tile directories. The arrays are memory mapped, so only the
+    parts of them that get used are read from disk. At most max_tiles of
+    them are kept open.
+
+    Level 0 is the full resolution DEM, and each level after that keeps
+    every other sample of the one before it. Points outside of the tiles
+    that were cut get the elevation at the edge of the cut area.
+    """
+    def __init__(self, city_directory, zone, level=0, max_tiles=64):
+        index_path = os.path.join(city_directory, DEM_INDEX_FILENAME)
+        f = open(index_path, 'r')
+        index = json.load(f)
+        f.close()
+        if level >= len(index["levels"]):
+            raise ValueError("The DEM tiles only have %d levels." % (len(index["levels"])))
+        if not "tiles" in index:
+            raise ValueError("The DEM tiles in %s are from an older version. Run cut_dem_into_tiles.py again." % (city_directory))
+        self.city_directory = city_directory
+        self.zone = zone
+        self.level = level
+        # The index is written last, so it changes whenever the tiles do
+        self.source_key = files_source_key([index_path], level)
+        self.buffer = index["buffer"]
+        self.max_tiles = max_tiles
+        self.chunks = collections.OrderedDict()
+        self.warned_outside = False
+        # (min_i, min_j, max_i, max_j) of the tiles that were cut
+        self.tile_bounds = tuple(index["tiles"])
+        self.min_x = index["min_x"]
+        self.min_y = index["min_y"]
+        self.res_x = index["levels"][level]["res_x"]
+        self.res_y = index["levels"][level]["res_y"]
+        self.cols = index["levels"][level]["cols"]
+        self.rows = index["levels"][level]["rows"]
+
+    def covers_tiles(self, min_i, min_j, max_i, max_j):
+        """
+        Whether every tile of the area was cut.
+        """
+        cut_min_i, cut_min_j, cut_max_i, cut_max_j = self.tile_bounds
+        return cut_min_i <= min_i and cut_min_j <= min_j and max_i <= cut_max_i and max_j <= cut_max_j
+
+    def interpolate_many(self, xs, ys):
+        # Clamp points outside of the cut tiles to their edge
+        shape = np.shape(xs)
+        xs = np.asarray(xs, dtype=float).ravel()
+        ys = np.asarray(ys, dtype=float).ravel()
+        min_i, min_j, max_i, max_j = self.tile_bounds
+        clamped_xs = np.clip(xs, min_i * TileID.TILE_SIZE, (max_i + 1) * TileID.TILE_SIZE)
+        clamped_ys = np.clip(ys, min_j * TileID.TILE_SIZE, (max_j + 1) * TileID.TILE_SIZE)
+        if not self.warned_outside and ((clamped_xs != xs).any() or (clamped_ys != ys).any()):
+            print("Warning: some points are outside of the tiles the DEM was cut for. They get the elevation at the edge of the cut area."\
+                    " Cut the DEM with a bigger --margin-tiles to fix this.")
+            self.warned_outside = True
+        return GeoTiffInterpolater.interpolate_many(self, clamped_xs, clamped_ys).reshape(shape)
+
+    def get_chunk(self, i, j):
+        """
+        Returns the tile's (array, i_min, j_min).
+        """
+        if (i, j) in self.chunks:
+            self.chunks.move_to_end((i, j))
+            return self.chunks[(i, j)]
+        filepath = os.path.join(self.city_directory, "%d_%d_%d" % (i, j, self.zone), DEM_TILE_FILENAME % (self.level))
+        if not os.path.exists(filepath):
+            raise ValueError("The DEM tile %s is missing. Run cut_dem_into_tiles.py again." % (filepath))
+        tile = TileID.tile_indices_to_object(i, j, self.zone)
+        i_min, _, j_min, _ = dem_window(self.min_x, self.min_y, self.res_x, self.res_y, self.cols, self.rows, tile, self.buffer)
+        chunk = (np.load(filepath, mmap_mode='r'), i_min, j_min)
+        self.chunks[(i, j)] = chunk
+        while len(self.chunks) > max(self.max_tiles, 1):
+            self.chunks.popitem(last=False)
+        return chunk
+
+    def corner_values(self, xs, ys, i_below, j_below):
+        # Each point reads from the array of the tile it's in. The points
+        # on the far edges of the cut area read from the last tile.
+        values = np.full((4, len(xs)), np.nan)
+        min_i, min_j, max_i, max_j = self.tile_bounds
+        tile_is = np.clip(np.floor(xs / TileID.TILE_SIZE).astype(np.int64), min_i, max_i)
+        tile_js = np.clip(np.floor(ys / TileID.TILE_SIZE).astype(np.int64), min_j, max_j)
+        tile_keys, inverse = np.unique(np.column_stack((tile_is, tile_js)), axis=0, return_inverse=True)
+        inverse = inverse.ravel()
+        for k, (i, j) in enumerate(tile_keys):
+            array, i_min, j_min = self.get_chunk(int(i), int(j))
+            in_tile = inverse == k
+            local_i = np.clip(i_below[in_tile] - i_min, 0, array.shape[0] - 2)
+            local_j = np.clip(j_below[in_tile] - j_min, 0, array.shape[1] - 2)
+            values[0, in_tile] = array[local_i, local_j]
+            values[1, in_tile] = array[local_i + 1, local_j]
+            values[2, in_tile] = array[local_i + 1, local_j + 1]
+            values[3, in_tile] = array[local_i, local_j + 1]
+        return values[0], values[1], values[2], values[3]
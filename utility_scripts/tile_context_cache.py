@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+
+# Lazily load the downtown, park, and residential polygons of tiles.
+# They are read the first time a tile is needed and kept in a
+# size-bounded least recently used cache.
+
+import collections
+import os
+import shapely
+
+from configuration import *
+from geojson_utils import *
+
+class TileContext:
+    """
+    The polygons used to classify a tile's buildings. Each one is a list
+    of shapely polygons, so it can be passed to polygon_list_contains.
+    """
+    def __init__(self, downtown, park, residential):
+        self.downtown = downtown
+        self.park = park
+        self.residential = residential
+
+def prepared_union(polygon_list):
+    """
+    Combine a list of polygons into a one element list holding their
+    prepared union, which is much faster to run contains on. Falls back
+    to the original list if the polygons can't be combined.
+    """
+    if len(polygon_list) <= 1:
+        return polygon_list
+    try:
+        union = shapely.union_all(shapely.make_valid(polygon_list))
+    except shapely.errors.GEOSException:
+        return polygon_list
+    shapely.prepare(union)
+    return [union]
+
+class TileContextCache:
+    """
+    Loads the TileContext of a tile the first time it is asked for. At
+    most max_tiles contexts are kept in memory, and the least recently
+    used one is evicted when there are too many. If union is True, each
+    context's polygon lists are replaced by their prepared union.
+    """
+    def __init__(self, city_directory, zone, max_tiles=256, union=False):
+        self.city_directory = city_directory
+        self.zone = zone
+        self.max_tiles = max_tiles
+        self.union = union
+        self.contexts = collections.OrderedDict()
+
+    def load(self, i, j):
+        full_path = os.path.join(self.city_directory, "%d_%d_%d" % (i, j, self.zone))
+        downtown = read_geojson_file_to_shapely_list(full_path, DOWNTOWN_FILENAME)
+        park = read_geojson_file_to_shapely_list(full_path, PARK_FILENAME)
+        residential = read_geojson_file_to_shapely_list(full_path, RESIDENTIAL_FILENAME)
+        if self.union:
+            downtown = prepared_union(downtown)
+            park = prepared_union(park)
+            residential = prepared_union(residential)
+        return TileContext(downtown, park, residential)
+
+    def get(self, i, j):
+        if (i, j) in self.contexts:
+            self.contexts.move_to_end((i, j))
+            return self.contexts[(i, j)]
+        context = self.load(i, j)
+        self.contexts[(i, j)] = context
+        while len(self.contexts) > max(self.max_tiles, 1):
+            self.contexts.popitem(last=False)
+        return context
@@ -31,7 +31,8 @@ class TileID:
 
     def center_lat_lon(self):
         x, y, zone = self.center_utm()
-        return utm.to_latlon(x, y, zone)
+        # The tile could be outside of its zone in extended UTM
+        return utm.to_latlon(x, y, zone, northern=True, strict=False)
 
     def sw_corner(self):
         x, y, zone = self.center_utm()
@@ -64,6 +65,14 @@ class TileID:
         y = (j + 0.5) * size
         return TileID(x, y, zone)
 
+    def lat_lon_to_object(lat, lon, zone):
+        """
+        Like the lat, lon constructor, but the point is projected into
+        the given zone even if it's outside of it (extended UTM).
+        """
+        x, y, _, _ = utm.from_latlon(lat, lon, force_zone_number=zone)
+        return TileID(x, y, zone)
+
     def flip_point_over_tile_center_x(self, x, y):
         sw_x, sw_y = self.sw_corner()
         local_x = x - sw_x
@@ -87,6 +96,22 @@ class TileID:
         local_y = y - sw_y
         return sw_x - local_y, sw_y - local_x
 
+def tile_area(lat1, lon1, lat2, lon2, utm_zone=0):
+    """
+    Get the SW and NE tiles of the area between two lat/lons. If utm_zone
+    is positive, both corners are projected into that zone, so the area
+    can cross zone boundaries. Otherwise they have to be in the same zone,
+    and (None, None) is returned if they aren't.
+    """
+    if utm_zone > 0:
+        return TileID.lat_lon_to_object(lat1, lon1, utm_zone), TileID.lat_lon_to_object(lat2, lon2, utm_zone)
+    tile_min = TileID(lat1, lon1)
+    tile_max = TileID(lat2, lon2)
+    if tile_min.zone != tile_max.zone:
+        print("Crossing from UTM zone %d to %d. Use --utm-zone to put the whole area in one zone. Quitting." % (tile_min.zone, tile_max.zone))
+        return None, None
+    return tile_min, tile_max
+
 def main():
     parser = argparse.ArgumentParser(description="Print out the information of the tile containing the given lat/lon.")
     parser.add_argument('lat') 
@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+
+# Keep the trees of a tile within a triangle budget, by drawing some of
+# them as cheap impostors and thinning them out where that isn't enough.
+# Everything is decided for all of a tile's trees at once.
+
+import numpy as np
+
+from feature_store import concatenated_ranges
+from obj_utils import *
+
+# The choices of --tree-impostor
+TREE_IMPOSTOR_SHAPES = ["cone", "quad"]
+
+# Trees are dense when they have lots of other trees this close (meters)
+TREE_DENSITY_RADIUS = 10.
+
+def tree_impostor_mesh(model, shape):
+    """
+    A cheap stand-in for a tree model, as tall and wide as it: a three
+    sided cone, or two crossed quads that can be seen from both sides.
+    It uses the material that covers the most of the model. Returns
+    (mesh, group_index), where group_index is the model's material group
+    with that material, so the impostor gets the same autumn color.
+    """
+    vertices = np.asarray(model.vertices)
+    bottom = vertices[:, 1].min()
+    top = vertices[:, 1].max()
+    radius = np.sqrt(vertices[:, 0] ** 2 + vertices[:, 2] ** 2).max()
+    group_starts, group_materials = material_groups(model)
+    corners = vertices[np.asarray(model.faces)]
+    face_areas = np.linalg.norm(np.cross(corners[:, 1] - corners[:, 0], corners[:, 2] - corners[:, 0]), axis=1) / 2
+    group_areas = np.add.reduceat(face_areas, group_starts[:-1]) if len(group_materials) > 0 else np.zeros(0)
+    group_index = int(np.argmax(group_areas)) if len(group_materials) > 0 else 0
+    material_index = group_materials[group_index] if len(group_materials) > 0 else -1
+
+    if shape == "cone":
+        angles = 2 * np.pi * np.arange(3) / 3
+        impostor_vertices = np.vstack((np.column_stack((radius * np.cos(angles), np.full(3, bottom), radius * np.sin(angles))), [[0., top, 0.]]))
+        # Counter-clockwise from the outside, like the tree model
+        faces = np.array([[1, 0, 3], [2, 1, 3], [0, 2, 3]])
+    elif shape == "quad":
+        impostor_vertices = np.array([[-radius, bottom, 0.], [radius, bottom, 0.], [radius, top, 0.], [-radius, top, 0.],\
+                [0., bottom, -radius], [0., bottom, radius], [0., top, radius], [0., top, -radius]])
+        # Each quad faces both ways
+        faces = np.array([[0, 1, 2], [0, 2, 3], [0, 2, 1], [0, 3, 2], [4, 5, 6], [4, 6, 7], [4, 6, 5], [4, 7, 6]])
+    else:
+        raise ValueError("Unknown tree impostor shape %s." % (shape))
+    mesh = ObjMesh(impostor_vertices, np.zeros((0, 2)), faces, np.full(faces.shape, -1, dtype=np.int64),\
+            np.full(len(faces), material_index, dtype=np.int64), list(model.materials))
+    return mesh, group_index
+
+def local_densities(xs, ys, radius):
+    """
+    How many other points are within radius of each point. Only points in
+    the same or neighboring grid cells of size radius are compared.
+    """
+    xs = np.asarray(xs, dtype=float)
+    ys = np.asarray(ys, dtype=float)
+    num_points = len(xs)
+    if num_points == 0:
+        return np.zeros(0, dtype=np.int64)
+    cell_is = np.floor(xs / radius).astype(np.int64)
+    cell_js = np.floor(ys / radius).astype(np.int64)
+    # Leave room for the neighbors of the cells on the edges
+    cell_is -= cell_is.min() - 1
+    cell_js -= cell_js.min() - 1
+    span = cell_js.max() + 2
+    cell_keys = cell_is * span + cell_js
+    order = np.argsort(cell_keys, kind='stable')
+    sorted_keys = cell_keys[order]
+
+    densities = np.zeros(num_points, dtype=np.int64)
+    for di in (-1, 0, 1):
+        for dj in (-1, 0, 1):
+            neighbor_keys = cell_keys + di * span + dj
+            starts = np.searchsorted(sorted_keys, neighbor_keys, side='left')
+            ends = np.searchsorted(sorted_keys, neighbor_keys, side='right')
+            points = np.repeat(np.arange(num_points), ends - starts)
+            neighbors = order[concatenated_ranges(starts, ends)]
+            close = ((xs[points] - xs[neighbors]) ** 2 + (ys[points] - ys[neighbors]) ** 2 <= radius ** 2) & (points != neighbors)
+            densities += np.bincount(points[close], minlength=num_points)
+    return densities
+
+def poisson_disk_thin(xs, ys, min_distance, priorities):
+    """
+    Keep points so that no two kept points are closer than min_distance,
+    like Poisson disk sampling that draws from the points. Returns a mask
+    of the kept points.
+
+    The points go in grid cells small enough to hold one kept point each.
+    Cells are split into 9 phases so cells of the same phase are too far
+    apart to conflict, and each phase's cells try their next point (lowest
+    priority first) all at once.
+    """
+    xs = np.asarray(xs, dtype=float)
+    ys = np.asarray(ys, dtype=float)
+    num_points = len(xs)
+    if num_points == 0 or min_distance <= 0:
+        return np.ones(num_points, dtype=bool)
+    cell_size = min_distance / np.sqrt(2)
+    cell_is = np.floor(xs / cell_size).astype(np.int64)
+    cell_js = np.floor(ys / cell_size).astype(np.int64)
+    cell_is -= cell_is.min() - 2
+    cell_js -= cell_js.min() - 2
+    span = cell_js.max() + 3
+    cells, point_cells = np.unique(cell_is * span + cell_js, return_inverse=True)
+    point_cells = point_cells.ravel()
+
+    # The order each cell tries its points in
+    order = np.lexsort((priorities, point_cells))
+    cell_starts = np.searchsorted(point_cells[order], np.arange(len(cells)), side='left')
+    cell_counts = np.bincount(point_cells, minlength=len(cells))
+    cell_phases = (cells // span % 3) * 3 + cells % span % 3
+
+    # The cells (or -1) within 2 cells of each cell, where a kept point can be too close
+    neighbor_cells = np.full((len(cells), 25), -1, dtype=np.int64)
+    for k, (di, dj) in enumerate([(di, dj) for di in range(-2, 3) for dj in range(-2, 3)]):
+        neighbor_keys = cells + di * span + dj
+        found = np.minimum(np.searchsorted(cells, neighbor_keys), len(cells) - 1)
+        neighbor_cells[:, k] = np.where(cells[found] == neighbor_keys, found, -1)
+
+    # Every cell without a kept point tries its next point, until every
+    # cell has one or is out of points
+    kept_points = np.full(len(cells), -1, dtype=np.int64)
+    next_ranks = np.zeros(len(cells), dtype=np.int64)
+    trying = True
+    while trying:
+        trying = False
+        for phase in range(9):
+            active = np.flatnonzero((kept_points < 0) & (next_ranks < cell_counts) & (cell_phases == phase))
+            if len(active) == 0:
+                continue
+            trying = True
+            candidates = order[cell_starts[active] + next_ranks[active]]
+            neighbors = neighbor_cells[active]
+            neighbor_points = np.where(neighbors >= 0, kept_points[neighbors], -1)
+            distances = (xs[neighbor_points] - xs[candidates][:, np.newaxis]) ** 2 + (ys[neighbor_points] - ys[candidates][:, np.newaxis]) ** 2
+            too_close = ((neighbor_points >= 0) & (distances < min_distance ** 2)).any(axis=1)
+            kept_points[active[~too_close]] = candidates[~too_close]
+            next_ranks[active[too_close]] += 1
+
+    keep = np.zeros(num_points, dtype=bool)
+    keep[kept_points[kept_points >= 0]] = True
+    return keep
+
+def poisson_disk_thin_to_budget(xs, ys, priorities, costs, budget, num_steps=16):
+    """
+    Thin points with poisson_disk_thin, using the smallest distance (found
+    by bisection) that brings the total cost of the kept points within
+    budget. Returns a mask of the kept points.
+    """
+    xs = np.asarray(xs, dtype=float)
+    ys = np.asarray(ys, dtype=float)
+    if costs.sum() <= budget:
+        return np.ones(len(xs), dtype=bool)
+    if budget < costs.min():
+        return np.zeros(len(xs), dtype=bool)
+    low = 0.
+    high = np.hypot(xs.max() - xs.min(), ys.max() - ys.min())
+    best = None
+    for _ in range(num_steps):
+        middle = (low + high) / 2
+        keep = poisson_disk_thin(xs, ys, middle, priorities)
+        if costs[keep].sum() <= budget:
+            high = middle
+            best = keep
+        else:
+            low = middle
+    if best is None:
+        best = poisson_disk_thin(xs, ys, high, priorities)
+    # Points on top of each other can't be thinned by distance
+    if costs[best].sum() > budget:
+        order = np.flatnonzero(best)[np.argsort(priorities[best], kind='stable')]
+        best = np.zeros(len(xs), dtype=bool)
+        best[order[np.cumsum(costs[order]) <= budget]] = True
+    return best
+
+def plan_tree_lods(xs, ys, priorities, full_costs, impostor_costs, budget):
+    """
+    Decide how to draw a tile's trees so they have at most budget faces,
+    where drawing tree k costs full_costs[k] faces, or impostor_costs[k]
+    as an impostor. Trees in the densest parts of forests (where they are
+    hardest to tell apart) become impostors first. If every tree being an
+    impostor is still too much, they are also thinned out evenly with
+    Poisson disk sampling. priorities break ties. Returns (keep,
+    use_impostor) masks.
+    """
+    num_trees = len(xs)
+    keep = np.ones(num_trees, dtype=bool)
+    use_impostor = np.zeros(num_trees, dtype=bool)
+    excess = full_costs.sum() - budget
+    if num_trees == 0 or excess <= 0:
+        return keep, use_impostor
+
+    densities = local_densities(xs, ys, TREE_DENSITY_RADIUS)
+    order = np.lexsort((priorities, -densities))
+    savings = np.cumsum(np.maximum(full_costs - impostor_costs, 0)[order])
+    if savings[-1] >= excess:
+        use_impostor[order[:np.searchsorted(savings, excess) + 1]] = True
+        return keep, use_impostor
+
+    use_impostor = impostor_costs < full_costs
+    costs = np.where(use_impostor, impostor_costs, full_costs)
+    keep = poisson_disk_thin_to_budget(xs, ys, priorities, costs, max(budget, 0))
+    return keep, use_impostor